@@ -1,46 +1,113 @@
 import asyncio_redis
 import asyncio
+import codecs
 import logging
+import math
+import os
 import signal
 import time
 
 from functools import partial
 
-from sensors.utils import now
+from sensors.utils import now, get_shard
 from sensors.settings import SETTINGS
 
+from storage.redis import TaskStorage
+
 logging.basicConfig()
 log = logging.getLogger('taskqueue.dispatcher')
 
-# Lua script for redis to move tasks from scheduled queue to dispatched in transaction
+# Lua script for redis to move tasks from scheduled queue to dispatched in transaction.
+# Moves only as many tasks as there is free room in dispatched queue, the rest
+# stays in scheduled queue (backlog) and will be dispatched later.
+# Dispatched queue is list or stream, depends on TASK_TRANSPORT.
 SCRIPT_CODE = """
 local scheduled_queue = KEYS[1]
 local dispatched_queue = KEYS[2]
-local ctime = ARGV[1]
-local jobs_limit = ARGV[2]
+local stats_hash = KEYS[3]
+local wakeup_queue = KEYS[4]
+local dispatched_set = KEYS[5]
+local ctime = tonumber(ARGV[1])
+local jobs_limit = tonumber(ARGV[2])
+local stats_channel = ARGV[3]
+local backlog_field = ARGV[4]
+local transport = ARGV[5]
+local wakeup_limit = tonumber(ARGV[6])
 local jobs
 
-local tcount = function(T)
-  local count = 0
-  for _ in pairs(T) do count = count + 1 end
-  return count
-end
-
 local not_empty = function(x)
   return (type(x) == "table") and (not x.err) and (#x ~= 0)
 end
 
-jobs = redis.pcall('zrangebyscore', scheduled_queue, '-inf', ctime, 'LIMIT', '0', '1000')
+local room
+if transport == 'stream' then
+  room = jobs_limit - redis.call('XLEN', dispatched_queue)
+else
+  room = jobs_limit - redis.call('LLEN', dispatched_queue)
+end
+if room > 0 then
+  jobs = redis.pcall('zrangebyscore', scheduled_queue, '-inf', ctime, 'WITHSCORES', 'LIMIT', '0', math.min(room, 1000))
+end
 
+local count = 0
+local max_lag = 0
 if not_empty(jobs) then
-  redis.call('ZREM', scheduled_queue, unpack(jobs))
-  redis.call('LPUSH', dispatched_queue, unpack(jobs))
-  redis.call('LTRIM', dispatched_queue, 0, jobs_limit)
+  local ids = {}
+  local total_lag = 0
+  for i = 1, #jobs, 2 do
+    local lag = ctime - tonumber(jobs[i + 1])
+    ids[#ids + 1] = jobs[i]
+    total_lag = total_lag + lag
+    if lag > max_lag then max_lag = lag end
+  end
+  redis.call('ZREM', scheduled_queue, unpack(ids))
+  -- Dispatch time, scheduler doesn't take waiting task for lost one
+  for _, id in ipairs(ids) do
+    redis.call('ZADD', dispatched_set, ctime, id)
+  end
+  if transport == 'stream' then
+    for _, id in ipairs(ids) do
+      redis.call('XADD', dispatched_queue, '*', 'task', id)
+    end
+  else
+    redis.call('LPUSH', dispatched_queue, unpack(ids))
+    -- Wake up idle workers, they claim tasks atomically
+    for k = 1, math.min(#ids, wakeup_limit) do
+      redis.call('LPUSH', wakeup_queue, 1)
+    end
+    redis.call('LTRIM', wakeup_queue, 0, wakeup_limit - 1)
+  end
+  count = #ids
 
-  return tcount(jobs)
-else
-  return 0
+  -- Dispatch lag counters (ms): now minus task score
+  redis.call('HINCRBY', stats_hash, 'dispatched', count)
+  redis.call('HINCRBY', stats_hash, 'lag_total', total_lag)
+  -- Running max, not max of last batch only
+  if max_lag > tonumber(redis.call('HGET', stats_hash, 'lag_max') or 0) then
+    redis.call('HSET', stats_hash, 'lag_max', max_lag)
+  end
+end
+
+-- Due tasks left in scheduled queue; overflow if dispatched queue is full
+local backlog = redis.call('ZCOUNT', scheduled_queue, '-inf', ctime)
+local overflow = 0
+if backlog > 0 and room - count <= 0 then
+  overflow = backlog
+  redis.call('HINCRBY', stats_hash, 'overflows', 1)
 end
+redis.call('HSET', stats_hash, backlog_field, backlog)
+if backlog > 0 then
+  redis.call('PUBLISH', stats_channel, backlog)
+end
+
+-- Earliest score left in scheduled queue, dispatcher arms timer for it
+local next_run = -1
+local head = redis.call('ZRANGE', scheduled_queue, 0, 0, 'WITHSCORES')
+if #head > 0 then
+  next_run = tonumber(head[2])
+end
+
+return {count, max_lag, next_run, backlog, overflow}
 """
 
 
@@ -50,31 +117,68 @@ class Dispatcher(object):
         self.connection = None
         self.current_loop = None
         self.script = None
+        self.tq_storage = None
         self.run = True
 
+        # Shards of scheduled queue we hold leases for
+        self.dispatcher_id = codecs.encode(os.urandom(8), 'hex_codec')
+        self.shards = set()
+        self._leases_last_update = 0
+
         self.subscription = None
         self.sleep_task = None
+        self.wakeup = None
+        self.loop_task = None
 
     @asyncio.coroutine
     def bootstrap(self):
         log.info("Running dispatcher loop")
         self.connection = yield from asyncio_redis.Pool.create(host='localhost', port=6379, encoder=asyncio_redis.encoders.BytesEncoder(), poolsize=3)
+        self.tq_storage = TaskStorage(self.current_loop, self.connection)
         yield from self.reload_script()
 
         # Initialize scheduler-dispatcher feedback subscription
         self.subscription = yield from self.connection.start_subscribe()
         yield from self.subscription.subscribe([SETTINGS.SCHEDULER_TO_DISPATCHER_CHANNEL])
+        self.wakeup = asyncio.Event()
         self.sleep_task = asyncio.Task(self.sleep())
 
     def start(self, loop):
         self.current_loop = loop
         loop.add_signal_handler(signal.SIGINT, partial(self.stop, 'SIGINT'))
         loop.add_signal_handler(signal.SIGTERM, partial(self.stop, 'SIGTERM'))
-        asyncio.Task(self.loop())
+        self.loop_task = asyncio.Task(self.loop())
 
     def stop(self, sig):
         log.info("Got {} signal, we should finish all tasks and stop daemon".format(sig))
         self.run = False
+        asyncio.Task(self._shutdown())
+
+    @asyncio.coroutine
+    def _shutdown(self):
+        """ Finish current dispatch, release leases of shards and leave
+        alive dispatchers, so other dispatchers take shards over without
+        waiting for lease expiry, and stop event loop """
+        if self.wakeup:
+            self.wakeup.set()
+        if self.loop_task:
+            yield from asyncio.wait([self.loop_task], timeout=SETTINGS.DISPATCHER_PULL_TIMEOUT + 1)
+        if self.tq_storage:
+            for shard in sorted(self.shards):
+                key = SETTINGS.DISPATCHER_LEASE_KEY.format(shard).encode('utf-8')
+                try:
+                    yield from asyncio.wait_for(self.tq_storage.release_lease(key, self.dispatcher_id), 1)
+                    log.info("Release shard {}".format(shard))
+                except Exception:
+                    log.error('Cannot release shard {}'.format(shard), exc_info=True)
+            self.shards = set()
+            try:
+                yield from asyncio.wait_for(self.tq_storage.leave(SETTINGS.DISPATCHERS_SET, self.dispatcher_id), 1)
+            except Exception:
+                log.error('Cannot leave alive dispatchers', exc_info=True)
+        if self.connection:
+            self.connection.close()
+        log.info('Bye-bye!')
         self.current_loop.stop()
 
     @asyncio.coroutine
@@ -82,25 +186,117 @@ class Dispatcher(object):
         yield from self.bootstrap()
         # Inside a while loop, fetch scheduled tasks
         while self.run:
-            # move tasks from scheduled to dispatched queue
-            try:
-                script_reply = yield from self.script.run(keys=[SETTINGS.SCHEDULED_QUEUE, SETTINGS.DISPATCHED_QUEUE], args=[now(), str(SETTINGS.DISPATCHED_QUEUE_LIMIT).encode('utf-8')])
-                result = yield from script_reply.return_value()
-                if result > 0:
-                    log.info("Dispatched {} tasks".format(result))
-            except asyncio_redis.ScriptKilledError as ex:
-                log.error('Unexpected exception!', exc_info=True)
-                yield from self.reload_script()
-
-            # Sleep for timeout or new push from scheduler
+            # Pings received from now on should wake up next sleep
+            self.wakeup.clear()
+            # Take or renew shards of scheduled queue
+            yield from self._update_leases()
+
+            next_run = None
+            overflow = 0
+            for shard in sorted(self.shards):
+                # move tasks from scheduled to dispatched queue
+                shard_next_run, shard_overflow = yield from self._dispatch(shard)
+                if shard_next_run >= 0 and (next_run is None or shard_next_run < next_run):
+                    next_run = shard_next_run
+                overflow += shard_overflow
+
+            # Sleep until earliest scheduled task, new push from scheduler or timeout
+            if overflow > 0:
+                # Backpressure, give workers time to drain dispatched queue
+                timeout = SETTINGS.DISPATCHER_BACKPRESSURE_SLEEP
+            else:
+                timeout = self._get_sleep_timeout(next_run)
+            if timeout <= 0:
+                continue
             try:
-                yield from asyncio.wait([self.sleep_task], timeout=SETTINGS.DISPATCHER_PULL_TIMEOUT)
+                yield from asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
             except GeneratorExit:
                 pass
-        # yield from self.connection.script_flush()
-        self.current_loop.stop()
-        self.connection.close()
-        log.info('Bye-bye!')
+        # Leases are released and loop is stopped by _shutdown
+
+    @asyncio.coroutine
+    def _dispatch(self, shard):
+        """ Move due tasks of one shard to dispatched queue, returns
+        (next_run, overflow) """
+        if SETTINGS.SCHEDULED_QUEUE_SHARDS > 1:
+            backlog_field = 'backlog:{}'.format(shard).encode('utf-8')
+        else:
+            backlog_field = b'backlog'
+        if SETTINGS.TASK_TRANSPORT == 'stream':
+            dispatched_queue = SETTINGS.DISPATCHED_STREAM
+        else:
+            dispatched_queue = SETTINGS.DISPATCHED_QUEUE
+        try:
+            script_reply = yield from self.script.run(keys=[TaskStorage.get_scheduled_queue(shard), dispatched_queue, SETTINGS.DISPATCHER_STATS_HASH,
+                                                            SETTINGS.DISPATCHED_WAKEUP_QUEUE, SETTINGS.DISPATCHED_TASKS_SET],
+                                                      args=[now(), str(SETTINGS.DISPATCHED_QUEUE_LIMIT).encode('utf-8'), SETTINGS.DISPATCHER_BACKLOG_CHANNEL,
+                                                            backlog_field, SETTINGS.TASK_TRANSPORT.encode('utf-8'),
+                                                            str(SETTINGS.DISPATCHED_WAKEUP_LIMIT).encode('utf-8')])
+            dispatched, max_lag, next_run, backlog, overflow = yield from script_reply.return_value()
+            if dispatched > 0:
+                log.info("Dispatched {} tasks from shard {}, max lag {}ms".format(dispatched, shard, max_lag))
+            if overflow > 0:
+                log.warning("Dispatched queue is full, {} due tasks wait in scheduled queue shard {}".format(overflow, shard))
+            return next_run, overflow
+        except asyncio_redis.ScriptKilledError as ex:
+            log.error('Unexpected exception!', exc_info=True)
+            yield from self.reload_script()
+        return -1, 0
+
+    @asyncio.coroutine
+    def _update_leases(self):
+        """ Renew leases of our shards and take free shards up to fair share
+        (shards count / alive dispatchers count). Shards of dead dispatcher
+        are taken over when its leases expire. """
+        time_now = int(now())
+        if not self.run or time_now - self._leases_last_update < SETTINGS.DISPATCHER_LEASE_TTL * 1000 / 3:
+            return
+        self._leases_last_update = time_now
+
+        shards_count = SETTINGS.SCHEDULED_QUEUE_SHARDS
+        try:
+            alive = yield from self.tq_storage.heartbeat(SETTINGS.DISPATCHERS_SET, self.dispatcher_id, SETTINGS.DISPATCHER_LEASE_TTL)
+            fair_share = int(math.ceil(shards_count / max(alive, 1)))
+
+            shards = set()
+            # Renew our leases, give away shards above fair share
+            for shard in sorted(self.shards):
+                key = SETTINGS.DISPATCHER_LEASE_KEY.format(shard).encode('utf-8')
+                if len(shards) >= fair_share:
+                    log.info("Release shard {}, {} dispatchers alive".format(shard, alive))
+                    yield from self.tq_storage.release_lease(key, self.dispatcher_id)
+                elif (yield from self.tq_storage.hold_lease(key, self.dispatcher_id, SETTINGS.DISPATCHER_LEASE_TTL)):
+                    shards.add(shard)
+                else:
+                    log.warning("Lost lease for shard {}".format(shard))
+
+            # Take free shards, start from own offset to avoid races with other dispatchers
+            offset = get_shard(self.dispatcher_id.decode('utf-8'), shards_count)
+            for i in range(shards_count):
+                if len(shards) >= fair_share:
+                    break
+                shard = (offset + i) % shards_count
+                if shard in shards:
+                    continue
+                key = SETTINGS.DISPATCHER_LEASE_KEY.format(shard).encode('utf-8')
+                if (yield from self.tq_storage.hold_lease(key, self.dispatcher_id, SETTINGS.DISPATCHER_LEASE_TTL)):
+                    log.info("Took lease for shard {}".format(shard))
+                    shards.add(shard)
+            self.shards = shards
+        except Exception:
+            log.error('Cannot update shard leases', exc_info=True)
+
+    def _get_sleep_timeout(self, next_run):
+        """ Seconds to sleep before the earliest scheduled task is due,
+        limited by DISPATCHER_PULL_TIMEOUT and leases renewal """
+        leases_delay = (self._leases_last_update + SETTINGS.DISPATCHER_LEASE_TTL * 1000 / 3 - int(now())) / 1000
+        timeout = min(SETTINGS.DISPATCHER_PULL_TIMEOUT, max(0, leases_delay))
+        if next_run is None or next_run < 0:
+            return timeout
+        delay = (next_run - int(now())) / 1000
+        return max(0, min(delay, timeout))
 
     @asyncio.coroutine
     def reload_script(self):
@@ -121,6 +317,8 @@ class Dispatcher(object):
     def sleep(self):
         try:
             reply = yield from self.subscription.next_published()
+            # New task scheduled, re-arm timer
+            self.wakeup.set()
         except GeneratorExit:
             log.info('Stop subscription')
         except:
@@ -13,7 +13,7 @@ from functools import partial
 from sensors.utils import now, datetime_to_timestamp, parse_timetable
 from sensors.settings import SETTINGS
 
-from storage.redis import ConfigStorage
+from storage.redis import ConfigCache
 from storage.influx import MetricsStorage, LoggingStorage
 
 SPLIT_RE = re.compile(r"( +|\t+|\(|\)|\.|\:|\=|,|\%|\/|\\|\[|\]|;|\"|\')|(-(?!\d))")
@@ -33,7 +33,7 @@ class MetricsCollector(object):
         self.config_version = 0
         self.run = True
 
-        self.storage = ConfigStorage()
+        self.storage = None
         self.metrics_storage = MetricsStorage()
         self.db_log = LoggingStorage()
 
@@ -48,6 +48,7 @@ class MetricsCollector(object):
     def bootstrap(self):
         log.info("Running metrics collector loop")
         self.connection = yield from asyncio_redis.Pool.create(host='localhost', port=6379, encoder=asyncio_redis.encoders.BytesEncoder(), poolsize=3)
+        self.storage = ConfigCache(self.connection)
 
         # Setup subscription to action results
         self.subscription = yield from self.connection.start_subscribe()
@@ -128,14 +129,14 @@ class MetricsCollector(object):
         if time_now - self._reload_metrics_config_last_run < 1000:  # 1000 = 1sec
             return
         self._reload_metrics_config_last_run = time_now
-        config_version = self.storage.get_config_version()
+        config_version = yield from self.storage.get_config_version()
         if config_version != self.config_version:
             yield from self._reload_metrics()
             self.config_version = config_version
 
     @asyncio.coroutine
     def _reload_metrics(self):
-        new_metrics = self.storage.list_metrics()
+        new_metrics = yield from self.storage.list_metrics()
         self.metrics = new_metrics
         self.actions_id_to_metrics = defaultdict(list)
         self.connections_id_to_metrics = defaultdict(list)
@@ -2,22 +2,24 @@ import asyncio
 import asyncio_redis
 import codecs
 import hashlib
+import heapq
 import logging
 import os
 import pickle
 import time
 import signal
+import socket
 import ujson
 
 from collections import defaultdict, OrderedDict
 from functools import partial
 
 from sensors.utils import (datetime_to_timestamp, timestamp_to_datetime, now,
-                           parse_timetable)
+                           parse_timetable, get_shard)
 from sensors.settings import SETTINGS
 
 from storage.models import Task, SchedulerTaskHistory
-from storage.redis import ConfigStorage, TaskStorage
+from storage.redis import ConfigStorage, ConfigCache, TaskStorage, FencingError
 
 logging.basicConfig()
 log = logging.getLogger('taskqueue.scheduler')
@@ -38,12 +40,62 @@ class Scheduler(object):
         self.scheduler_tasks = dict()
         self.scheduler_tasks_history = defaultdict(dict)
 
+        # Min-heap of (deadline, task name) for not scheduled tasks, task
+        # is looked at only when its deadline comes. Outdated heap entries
+        # are skipped, actual deadline of task is in deadlines_index.
+        self.deadlines = []
+        self.deadlines_index = {}
+
+        # Min-heap of (deadline, task name, task id) for scheduled tasks,
+        # task is checked for being lost only after its deadline. Entry is
+        # outdated if task is not scheduled task of action anymore.
+        self.lost_deadlines = []
+
+        # Phase offsets of actions assigned by planner (spread mode)
+        self.phases = {}
+
+        # Token bucket for missed runs
+        self.catchup_tokens = 0
+        self._catchup_last_refill = 0
+
         self._ttl_check_last_run = 0
         self._ttl_reload_config_last_run = 0
+        self._history_reconcile_last_run = 0
 
+        # Sync storage writes bootstrap objects, daemon reads config through cache
         self.config = ConfigStorage()
+        self.config_cache = None
         self.tq_storage = None
 
+        # Only leader schedules tasks, standby keeps deadlines and run
+        # history warm to take over without reload
+        self.scheduler_id = '{}:{}'.format(socket.gethostname(), os.getpid()).encode('utf-8')
+        self.leader_token = 0
+        self._leader_last_update = 0
+
+    def install_bootstrap_once(self):
+        """ Install bootstrap objects once for all schedulers: only the
+        process which replaces hash of installed bootstrap file in
+        SCHEDULER_BOOTSTRAP_KEY installs it, so restarts and takeovers
+        don't reinstall objects and don't change config version """
+        try:
+            filename = os.path.join(SETTINGS.BASE_DIR, SETTINGS.BOOTSTRAP_FILE)
+            with open(filename, 'br') as f:
+                digest = hashlib.md5(f.read()).hexdigest().encode('utf-8')
+            installed = self.config.connection.getset(SETTINGS.SCHEDULER_BOOTSTRAP_KEY, digest)
+            if installed == digest:
+                log.info("Bootstrap {} is already installed".format(digest))
+                return
+        except:
+            log.error("Failed to check bootstrap", exc_info=True)
+            return
+        if not self.install_bootstrap():
+            # Let next scheduler start retry
+            try:
+                self.config.connection.delete(SETTINGS.SCHEDULER_BOOTSTRAP_KEY)
+            except:
+                log.error("Failed to reset bootstrap hash", exc_info=True)
+
     def install_bootstrap(self):
         try:
             # Check is it already installed
@@ -84,24 +136,85 @@ class Scheduler(object):
             if not self.config.connection.get(SETTINGS.DEVCONFIG):
                 self.config.connection.set(SETTINGS.DEVCONFIG, ujson.dumps(SETTINGS.DEVCONFIG_DATA))
             log.info("Install bootstrap objects finished")
+            return True
         except:
             log.error("Failed to install bootstrap", exc_info=True)
+            return False
 
     @asyncio.coroutine
-    def schedule_task(self, name, task_type, run_at, ttl, kwargs):
-        """ Create Task object and add to Scheduled queue """
-        # Create and store Task object
-        task = yield from self.tq_storage.create_task(name, task_type,
-                                                      run_at, ttl, kwargs,
-                                                      store_to=Task.STORE_TO_METRICS)
+    def schedule_tasks(self, due_tasks):
+        """ Create Task objects for due tasks and store them with next_run
+        and scheduled_task_id in TaskHistory in one round trip
+
+        :param due_tasks: list of (name, run_at, scheduler_task)
+        """
+        tasks = []
+        # Worker caches commands of action by config version
+        config_version = self.config_version.decode('utf-8') if self.config_version else None
+        for name, run_at, scheduler_task in due_tasks:
+            task = yield from self.tq_storage.create_task(name, Task.TYPE_REGULAR,
+                                                          run_at, scheduler_task.get('ttl') or SETTINGS.WORKER_TASK_TIMEOUT,
+                                                          dict(scheduler_task, config_version=config_version),
+                                                          store_to=Task.STORE_TO_METRICS)
+            history = SchedulerTaskHistory(name=name,
+                                           last_run=self.scheduler_tasks_history[name].get('last_run', 0),
+                                           next_run=datetime_to_timestamp(run_at),
+                                           scheduled_task_id=task.id)
+            tasks.append((task, history))
 
-        yield from self.tq_storage.schedule_task(task)
+        try:
+            dispatched = yield from self.tq_storage.schedule_tasks(tasks, fence=self.leader_token)
+        except FencingError:
+            log.error('Leadership is lost, tasks are not scheduled')
+            self.leader_token = 0
+            for task, history in tasks:
+                self._arm(task.name, int(now()))
+            return
+        except Exception:
+            log.error('Cannot schedule {} tasks, retry later'.format(len(tasks)), exc_info=True)
+            for task, history in tasks:
+                self._arm(task.name, int(now()) + 1000)
+            return
 
-        # Store next_run and scheduled_task_id in TaskHistory
-        task = yield from self.tq_storage.create_scheduler_task_history(task,
-                                                                        last_run=self.scheduler_tasks_history.get(task.name).get('last_run', 0),
-                                                                        next_run=datetime_to_timestamp(run_at),
-                                                                        scheduled_task_id=task.id)
+        for task, history in tasks:
+            self.scheduler_tasks_history[task.name].update(next_run=history.next_run, scheduled_task_id=task.id)
+            self._arm_lost(task.name)
+        if dispatched < len(tasks):
+            yield from self._ping_disptacher()
+
+    @asyncio.coroutine
+    def _schedule_due_tasks(self):
+        """ Leader's work: reap expired tasks, schedule tasks with due
+        deadline """
+        # Kill expired tasks (broken worker)
+        yield from self._check_expired_tasks()
+
+        current_time = int(now())
+        due_tasks = []
+        deferred = 0
+        # Look only at tasks with due deadline
+        for deadline, scheduler_task_name in self._pop_due(current_time):
+            scheduler_task = self.scheduler_tasks.get(scheduler_task_name)
+            scheduled_task_history = self.scheduler_tasks_history[scheduler_task_name]
+            if scheduler_task and (scheduled_task_history.get('next_run', 0) <= scheduled_task_history.get('last_run', 0)):
+                log.debug('Got unscheduled task {}'.format(scheduler_task_name))
+                # Task is not scheduled/executed now, so need to schedule
+                next_run_dt = self._get_next_run_time(scheduler_task_name, scheduler_task, deadline)
+                if datetime_to_timestamp(next_run_dt) > current_time:
+                    # Schedule was changed after deadline was set
+                    self._arm(scheduler_task_name, datetime_to_timestamp(next_run_dt))
+                    continue
+                if (datetime_to_timestamp(next_run_dt) < current_time - SETTINGS.SCHEDULER_CATCHUP_GRACE * 1000
+                  and not self._take_catchup_token(current_time)):
+                    # Too many missed runs, release them in next seconds
+                    self._arm(scheduler_task_name, current_time + (deferred // SETTINGS.SCHEDULER_CATCHUP_RATE + 1) * 1000)
+                    deferred += 1
+                    continue
+                log.debug('Next run {} for task {}'.format(next_run_dt, scheduler_task_name))
+                due_tasks.append((scheduler_task_name, next_run_dt, scheduler_task))
+        # Store all due tasks at once
+        if due_tasks:
+            yield from self.schedule_tasks(due_tasks)
 
     @asyncio.coroutine
     def _reload_config_tasks_list(self):
@@ -111,58 +224,131 @@ class Scheduler(object):
             return
         self._ttl_reload_config_last_run = time_now
 
-        config_version = self.config.get_config_version()
+        config_version = yield from self.config_cache.get_config_version()
         if config_version != self.config_version:
             log.info('Changes in actions list, update.')
-            new_scheduler_tasks = self.config.get_scheduled_actions()
+            new_scheduler_tasks = yield from self.config_cache.get_scheduled_actions()
             new_keys = set(new_scheduler_tasks.keys()) - set(self.scheduler_tasks.keys())
             deleted_keys = set(self.scheduler_tasks.keys()) - set(new_scheduler_tasks.keys())
+            changed_keys = {key for key, scheduler_task in new_scheduler_tasks.items()
+                            if key not in new_keys and scheduler_task != self.scheduler_tasks[key]}
             if new_keys or deleted_keys:
                 log.info('New actions list, new_keys={}, deleted_keys={}'.format(new_keys, deleted_keys))
             self.scheduler_tasks = new_scheduler_tasks
+            rearm_keys = new_keys | changed_keys
+            if SETTINGS.SCHEDULER_PHASE_MODE == 'spread' and (new_keys or deleted_keys or changed_keys):
+                # Phases of all actions are shifted
+                self.phases = self._plan_phases()
+                rearm_keys = set(self.scheduler_tasks.keys())
 
             yield from self._load_scheduler_tasks_history()
-            # Check scheduler_tasks_history here, please
-            # Возможно, интервал запуска изменился с длинного на короткий
-            # А у нас уже next_run стоит далеко в будущем
-            for scheduled_task_name, scheduled_task_history in self.scheduler_tasks_history.items():
-                # Смотри все таски, для которых сохранена инфорамция по шедулингу
-                if scheduled_task_history.get('next_run', 0):  # and (scheduled_task_name in self.scheduler_tasks):
-                    # Если есть запланированный таск
-                    if scheduled_task_name in self.scheduler_tasks:
-                        # Если у таска осталось расписание
-                        possible_next_run = datetime_to_timestamp(self._get_next_run_time(scheduled_task_name, self.scheduler_tasks[scheduled_task_name], int(now())))
-                    else:
-                        # У таска не осталось расписания, next_run надо привести к 0 и больше ничего не делать
-                        possible_next_run = 0
-
-                    if scheduled_task_history.get('next_run', 0) != possible_next_run:
-                        # Cancel scheduled task
-                        # Reset next_run
-                        task_id = scheduled_task_history.get('scheduled_task_id')
-                        log.info('Schedule changed for task with id={}, name={}, reschedule next_task'.format(task_id, scheduled_task_name))
-                        key = SETTINGS.TASK_STORAGE_KEY.format(task_id).encode('utf-8')
-                        task_obj = yield from self.connection.delete([key])
-
-                        scheduled_task_history['next_run'] = 0
-                        scheduled_task_history['scheduled_task_id'] = 0
-
-                        try:
-                            task_scheduler_obj = yield from self.connection.hget(SETTINGS.SCHEDULER_HISTORY_HASH, scheduled_task_name.encode('utf-8'))
-                            task_scheduler = SchedulerTaskHistory.deserialize(task_scheduler_obj)
-                            task_scheduler = task_scheduler._replace(next_run=0, scheduled_task_id=None)
-                            yield from self.connection.hset(SETTINGS.SCHEDULER_HISTORY_HASH, task_scheduler.name.encode('utf-8'), task_scheduler.serialize())
-                        except:
-                            log.error('Broken SchedulerTaskHistory object for task id={}, delete it'.format(scheduled_task_name))
-                            yield from self.connection.hdel(SETTINGS.SCHEDULER_HISTORY_HASH, task_scheduler.name.encode('utf-8'))
+            # Tasks are written to queue only when they are due, so interval
+            # change needs only new deadline. Cancel tasks of deleted actions.
+            for scheduled_task_name in deleted_keys:
+                scheduled_task_history = self.scheduler_tasks_history.get(scheduled_task_name, {})
+                if self.leader_token and scheduled_task_history.get('next_run', 0):
+                    # Cancel scheduled task
+                    # Reset next_run
+                    task_id = scheduled_task_history.get('scheduled_task_id')
+                    log.info('Schedule removed for task with id={}, name={}, cancel it'.format(task_id, scheduled_task_name))
+                    key = SETTINGS.TASK_STORAGE_KEY.format(task_id).encode('utf-8')
+                    task_obj = yield from self.connection.delete([key])
+
+                    try:
+                        task_scheduler_obj = yield from self.connection.hget(SETTINGS.SCHEDULER_HISTORY_HASH, scheduled_task_name.encode('utf-8'))
+                        task_scheduler = SchedulerTaskHistory.deserialize(task_scheduler_obj)
+                        task_scheduler = task_scheduler._replace(next_run=0, scheduled_task_id=None)
+                        yield from self.connection.hset(SETTINGS.SCHEDULER_HISTORY_HASH, task_scheduler.name.encode('utf-8'), task_scheduler.serialize())
+                        yield from self.connection.hset(SETTINGS.SCHEDULER_HISTORY_TASKS_HASH, task_scheduler.name.encode('utf-8'), b'')
+                    except:
+                        log.error('Broken SchedulerTaskHistory object for task id={}, delete it'.format(scheduled_task_name))
+                        yield from self.connection.hdel(SETTINGS.SCHEDULER_HISTORY_HASH, [scheduled_task_name.encode('utf-8')])
 
             # Удалился какой-то таск? Удалим его из мониторинга выполнения
             for key in deleted_keys:
                 if key in self.scheduler_tasks_history:
                     del self.scheduler_tasks_history[key]
+                self.deadlines_index.pop(key, None)
+            for key in rearm_keys:
+                self._rearm(key)
             self.config_version = config_version
 
 
+    @asyncio.coroutine
+    def _reconcile_scheduler_tasks_history(self):
+        """ Full reload of run history, limited to 1 per SCHEDULER_HISTORY_RECONCILE_PERIOD.
+        Changes between reloads come from workers, see _apply_history_delta """
+        time_now = int(now())
+        if time_now - self._history_reconcile_last_run < SETTINGS.SCHEDULER_HISTORY_RECONCILE_PERIOD * 1000:
+            return
+        self._history_reconcile_last_run = time_now
+        yield from self._load_scheduler_tasks_history()
+
+    def _apply_history_delta(self, value):
+        """ Apply run history of finished task published by worker, or
+        history changes published by leader scheduler """
+        try:
+            delta = ujson.loads(value)
+            if 'history' in delta:
+                self._apply_leader_history(delta['history'])
+                return
+            name, task_id, last_run = delta['name'], delta['task_id'], delta['last_run']
+        except (ValueError, TypeError, KeyError):
+            log.error('Wrong message from worker {}, reload history'.format(value))
+            self._history_reconcile_last_run = 0
+            return
+        scheduled_task_history = self.scheduler_tasks_history.get(name)
+        if name not in self.scheduler_tasks or scheduled_task_history is None:
+            return
+        if scheduled_task_history.get('scheduled_task_id') != task_id:
+            # Message about old task
+            return
+        scheduled_task_history.update(last_run=last_run, next_run=0, scheduled_task_id=None)
+        self._rearm(name)
+
+    def _apply_leader_history(self, histories):
+        """ Leader scheduler is source of truth for history it writes """
+        for name, last_run, next_run, scheduled_task_id in histories:
+            if name not in self.scheduler_tasks:
+                continue
+            self.scheduler_tasks_history[name].update(last_run=last_run, next_run=next_run, scheduled_task_id=scheduled_task_id)
+            self._rearm(name)
+
+    @asyncio.coroutine
+    def _update_leadership(self):
+        """ Take or renew leadership, limited to 3 times per lease period """
+        time_now = int(now())
+        if not self.run or time_now - self._leader_last_update < SETTINGS.SCHEDULER_LEADER_TTL * 1000 / 3:
+            return
+        self._leader_last_update = time_now
+        try:
+            token = yield from self.tq_storage.hold_leadership(self.scheduler_id, SETTINGS.SCHEDULER_LEADER_TTL)
+        except Exception:
+            log.error('Cannot update leadership', exc_info=True)
+            token = 0
+        if token and not self.leader_token:
+            log.info('Scheduler {} is leader now, token={}'.format(self.scheduler_id, token))
+            # Tasks scheduled by previous leader
+            self._rebuild_lost_deadlines()
+        elif not token and self.leader_token:
+            log.info('Scheduler {} is standby now'.format(self.scheduler_id))
+        self.leader_token = token
+
+    @asyncio.coroutine
+    def _shutdown(self):
+        """ Release leadership, so restarted scheduler doesn't wait for
+        lease expiry, and stop event loop """
+        if self.leader_token:
+            try:
+                yield from asyncio.wait_for(self.tq_storage.release_lease(SETTINGS.SCHEDULER_LEADER_KEY, self.scheduler_id), 1)
+                log.info('Scheduler {} released leadership'.format(self.scheduler_id))
+            except Exception:
+                log.error('Cannot release leadership', exc_info=True)
+            self.leader_token = 0
+        if self.connection:
+            self.connection.close()
+        self.current_loop.stop()
+
     @asyncio.coroutine
     def _load_scheduler_tasks_history(self):
         """ Load list of scheduled tasks tasks run times """
@@ -182,82 +368,247 @@ class Scheduler(object):
                 except (pickle.UnpicklingError, EOFError, TypeError, ImportError):
                     log.error('Cannot deserialize SchedulerTaskHistory for {}'.format(key), exc_info=True)
                     continue
-                self.scheduler_tasks_history[key].update(dict(last_run=task_history.last_run,
-                                                      next_run=task_history.next_run,
-                                                      scheduled_task_id=task_history.scheduled_task_id))
+                new_history = dict(last_run=task_history.last_run,
+                                   next_run=task_history.next_run,
+                                   scheduled_task_id=task_history.scheduled_task_id)
+                if self.scheduler_tasks_history.get(key) != new_history:
+                    self.scheduler_tasks_history[key].update(new_history)
+                    self._rearm(key)
         for key in set(self.scheduler_tasks_history.keys()) - new_keys:
             del self.scheduler_tasks_history[key]
+            self._rearm(key)
+        self._rebuild_lost_deadlines()
+
+    def _arm(self, name, deadline):
+        """ Set deadline (ms) for task, it replaces previous deadline """
+        self.deadlines_index[name] = deadline
+        heapq.heappush(self.deadlines, (deadline, name))
+        if len(self.deadlines) > 2 * len(self.deadlines_index) + 100:
+            # Standby doesn't pop deadlines, drop outdated entries
+            self.deadlines = [(deadline, name) for name, deadline in self.deadlines_index.items()]
+            heapq.heapify(self.deadlines)
+
+    def _rearm(self, name):
+        """ Set deadline for task by its schedule and run history, or remove
+        it from heap if task is scheduled now (it will be re-armed when
+        history changes) """
+        scheduler_task = self.scheduler_tasks.get(name)
+        scheduled_task_history = self.scheduler_tasks_history.get(name, {})
+        if not scheduler_task or scheduled_task_history.get('next_run', 0) > scheduled_task_history.get('last_run', 0):
+            self.deadlines_index.pop(name, None)
+            return
+        deadline = datetime_to_timestamp(self._get_next_run_time(name, scheduler_task, int(now())))
+        if deadline:
+            self._arm(name, deadline)
+        else:
+            self.deadlines_index.pop(name, None)
+
+    def _pop_due(self, current_time):
+        """ Pop tasks with deadline <= current_time, returns list of
+        (deadline, name) """
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= current_time:
+            deadline, name = heapq.heappop(self.deadlines)
+            if self.deadlines_index.get(name) != deadline:
+                # Outdated entry
+                continue
+            del self.deadlines_index[name]
+            due.append((deadline, name))
+        return due
+
+    def _get_next_deadline(self):
+        """ Earliest deadline in heap or None """
+        while self.deadlines:
+            deadline, name = self.deadlines[0]
+            if self.deadlines_index.get(name) == deadline:
+                return deadline
+            heapq.heappop(self.deadlines)
+        return None
+
+    def _plan_phases(self):
+        """ Spread phases of actions with same period evenly over period,
+        returns dict {name: offset} """
+        periods = defaultdict(list)
+        for name, scheduler_task in self.scheduler_tasks.items():
+            interval = parse_timetable(scheduler_task.get('schedule'))
+            if interval:
+                periods[interval].append(name)
+        phases = {}
+        for interval, names in periods.items():
+            for i, name in enumerate(sorted(names)):
+                phases[name] = i * interval // len(names)
+        return phases
+
+    def _get_phase(self, scheduler_task_name, scheduler_task, interval):
+        """ Offset of action runs within its period (ms), None if action
+        runs right after interval since last run. Action can override
+        mode with 'phase' field: 'none', 'auto' or offset in timetable
+        format (e.g. '15s') """
+        phase = scheduler_task.get('phase')
+        if phase == 'none' or (phase is None and SETTINGS.SCHEDULER_PHASE_MODE == 'none'):
+            return None
+        if phase is not None and phase != 'auto':
+            offset = parse_timetable(phase)
+            if offset is not None:
+                return offset % interval
+            log.error('Wrong phase {} of action {}'.format(phase, scheduler_task_name))
+        if SETTINGS.SCHEDULER_PHASE_MODE == 'spread' and scheduler_task_name in self.phases:
+            return self.phases[scheduler_task_name]
+        # Stable offset between restarts
+        return get_shard(scheduler_task_name, interval)
+
+    def _get_slot(self, scheduler_task_name, scheduler_task, interval):
+        """ Next run of action after its last run by schedule (ms) """
+        last_run = self.scheduler_tasks_history[scheduler_task_name].get('last_run', 0)
+        phase = self._get_phase(scheduler_task_name, scheduler_task, interval)
+        if phase is None:
+            return last_run + interval
+        # First slot of action phase after last run, so interval between
+        # runs is never longer than period
+        return last_run + (phase - last_run - 1) % interval + 1
 
     def _get_next_run_time(self, scheduler_task_name, scheduler_task, current_time):
         interval = parse_timetable(scheduler_task['schedule'])
         if not interval:
             return timestamp_to_datetime(0)
 
-        scheduled_task_history = self.scheduler_tasks_history[scheduler_task_name]
-        next_run = scheduled_task_history.get('last_run', 0) + interval
-        return timestamp_to_datetime(next_run if next_run > current_time else current_time)
+        next_run = self._get_slot(scheduler_task_name, scheduler_task, interval)
+        if next_run >= current_time - SETTINGS.SCHEDULER_CATCHUP_GRACE * 1000:
+            return timestamp_to_datetime(next_run)
+
+        # Runs were missed (scheduler downtime), action can override policy
+        # with 'catchup' and 'catchup_limit' fields
+        policy = scheduler_task.get('catchup') or SETTINGS.SCHEDULER_CATCHUP_POLICY
+        if policy == 'skip':
+            # Wait for next slot
+            next_run += -(-(current_time - next_run) // interval) * interval
+        elif policy == 'replay':
+            # Run missed slots one by one, oldest are dropped over limit
+            limit = max(int(scheduler_task.get('catchup_limit') or SETTINGS.SCHEDULER_CATCHUP_REPLAY_LIMIT), 1)
+            oldest = current_time - limit * interval + 1
+            if next_run < oldest:
+                next_run += -(-(oldest - next_run) // interval) * interval
+        else:
+            if policy != 'coalesce':
+                log.error('Wrong catchup policy {} of action {}'.format(policy, scheduler_task_name))
+            # One run for all missed slots, at the last of them
+            next_run += (current_time - next_run) // interval * interval
+        return timestamp_to_datetime(next_run)
+
+    def _take_catchup_token(self, current_time):
+        """ Token bucket, limits missed runs to SCHEDULER_CATCHUP_RATE per
+        second, returns True if run can be released now """
+        rate = SETTINGS.SCHEDULER_CATCHUP_RATE
+        if not rate:
+            return True
+        self.catchup_tokens = min(rate, self.catchup_tokens + (current_time - self._catchup_last_refill) * rate / 1000)
+        self._catchup_last_refill = current_time
+        if self.catchup_tokens < 1:
+            return False
+        self.catchup_tokens -= 1
+        return True
 
     @asyncio.coroutine
     def _check_expired_tasks(self):
+        """ Finish tasks with expired TTL in inprogress set, regular and
+        triggered ones """
         time_now = int(now())
         if time_now - self._ttl_check_last_run < 1000:  # 1000 = 1sec
             return
         self._ttl_check_last_run = time_now
 
-        TTL = SETTINGS.WORKER_TASK_TIMEOUT * 1000
-        for scheduled_task_name, scheduled_task_history in self.scheduler_tasks_history.items():
-            scheduled_task = self.scheduler_tasks.get(scheduled_task_name)
-            if (scheduled_task_history.get('next_run')
-              and scheduled_task_history.get('scheduled_task_id')
-              and (time_now - scheduled_task_history.get('next_run')) > (scheduled_task.get('ttl') or SETTINGS.WORKER_TASK_TIMEOUT)*1000):
-                task_id = scheduled_task_history.get('scheduled_task_id')
-                log.info('Fix broken task id={}, name={}'.format(task_id, scheduled_task_name))
-                # Get task object from redis key
-                key = SETTINGS.TASK_STORAGE_KEY.format(scheduled_task_history.get('scheduled_task_id')).encode('utf-8')
-                task_obj = yield from self.connection.get(key)
-                # Deserialize task object
-                try:
-                    if not task_obj:
-                        raise TypeError()
-                    task = Task.deserialize(task_obj)
-                    if task.status != Task.SUCCESSFUL:
-                        # Update task object status
-                        task = task._replace(status=Task.FAILED)
-                        # Set new status to redis
-                        yield from self.connection.set(key, task.serialize(), expire=SETTINGS.TASK_STORAGE_EXPIRE)
-                except TypeError as ex:
-                    task = None
-                    log.error("Wrong task id={}".format(scheduled_task_history.get('scheduled_task_id')), exc_info=True)
-                    yield from self.connection.delete([key])
-
-                # Publish message about finish (FAILED)
-                if task:
-                    yield from self.connection.publish(SETTINGS.TASK_CHANNEL.format(task_id).encode('utf-8'), task.status.encode('utf-8'))
-                else:
-                    yield from self.connection.publish(SETTINGS.TASK_CHANNEL.format(task_id).encode('utf-8'), Task.FAILED.encode('utf-8'))
+        yield from self._reset_lost_tasks(time_now)
 
-                # Update scheduler information
-                # Store next_run in scheduled
-                try:
-                    task_scheduler_obj = yield from self.connection.hget(SETTINGS.SCHEDULER_HISTORY_HASH, scheduled_task_name.encode('utf-8'))
-                    task_scheduler = SchedulerTaskHistory.deserialize(task_scheduler_obj)
-                    if task and task.status == Task.SUCCESSFUL:
-                        scheduled_task_history['last_run'] = scheduled_task_history.get('next_run', 0)
-                        scheduled_task_history['next_run'] = 0
-                        task_scheduler = task_scheduler._replace(last_run=task_scheduler.next_run, next_run=0, scheduled_task_id=None)
-                    else:
-                        scheduled_task_history['next_run'] = 0
-                        scheduled_task_history['scheduled_task_id'] = None
-                        task_scheduler = task_scheduler._replace(next_run=0, scheduled_task_id=None)
-                    yield from self.connection.hset(SETTINGS.SCHEDULER_HISTORY_HASH, task_scheduler.name.encode('utf-8'), task_scheduler.serialize())
-                except:
-                    # We lost SCHEDULER_HISTORY_HASH in db
-                    if task and task.status == Task.SUCCESSFUL:
-                        scheduled_task_history['last_run'] = scheduled_task_history.get('next_run', 0)
-                        scheduled_task_history['next_run'] = 0
-                    else:
-                        scheduled_task_history['next_run'] = 0
-                        scheduled_task_history['scheduled_task_id'] = None
+        expired = yield from self.tq_storage.get_expired_tasks(time_now)
+        if not expired:
+            return
+
+        reaped = []
+        histories = {}
+        for task_id, task in expired:
+            log.info('Fix broken task id={}'.format(task_id))
+            if task is None:
+                log.error("Wrong task id={}".format(task_id))
+                reaped.append((task_id, None, None))
+                continue
+            if task.status != Task.SUCCESSFUL:
+                task = task._replace(status=Task.FAILED)
+
+            # Update scheduler information
+            history = None
+            scheduled_task_history = self.scheduler_tasks_history.get(task.name)
+            if task.type == Task.TYPE_REGULAR and scheduled_task_history and scheduled_task_history.get('scheduled_task_id') == task.id:
+                last_run = scheduled_task_history.get('last_run', 0)
+                if task.status == Task.SUCCESSFUL:
+                    last_run = scheduled_task_history.get('next_run', 0)
+                history = SchedulerTaskHistory(name=task.name, last_run=last_run, next_run=0, scheduled_task_id=None)
+                histories[task.name] = history
+            reaped.append((task_id, task, history))
+
+        try:
+            yield from self.tq_storage.reap_tasks(reaped, fence=self.leader_token)
+        except FencingError:
+            log.error('Leadership is lost, expired tasks are left to new leader')
+            self.leader_token = 0
+            return
+
+        for name, history in histories.items():
+            self.scheduler_tasks_history[name].update(last_run=history.last_run, next_run=0, scheduled_task_id=None)
+            self._rearm(name)
+
+    def _arm_lost(self, name):
+        """ Push lost check deadline of scheduled task of action: its run
+        time, ttl and SCHEDULER_LOST_TASK_MARGIN """
+        scheduled_task_history = self.scheduler_tasks_history.get(name, {})
+        task_id = scheduled_task_history.get('scheduled_task_id')
+        next_run = scheduled_task_history.get('next_run', 0)
+        if not task_id or not next_run:
+            return
+        ttl = self.scheduler_tasks.get(name, {}).get('ttl') or SETTINGS.WORKER_TASK_TIMEOUT
+        heapq.heappush(self.lost_deadlines, (next_run + (ttl + SETTINGS.SCHEDULER_LOST_TASK_MARGIN) * 1000, name, task_id))
+
+    def _rebuild_lost_deadlines(self):
+        """ Rebuild lost check heap from run history (takeover, reload) """
+        self.lost_deadlines = []
+        for name in list(self.scheduler_tasks_history.keys()):
+            self._arm_lost(name)
+
+    @asyncio.coroutine
+    def _reset_lost_tasks(self, time_now):
+        """ Reset run history of tasks which never reached worker, otherwise
+        action never runs again. Only tasks with passed lost check deadline
+        are checked, in one fenced script, see TaskStorage.reset_lost_tasks """
+        candidates = []
+        while self.lost_deadlines and self.lost_deadlines[0][0] <= time_now:
+            deadline, name, task_id = heapq.heappop(self.lost_deadlines)
+            scheduled_task_history = self.scheduler_tasks_history.get(name)
+            if not scheduled_task_history or scheduled_task_history.get('scheduled_task_id') != task_id:
+                # Outdated entry
+                continue
+            history = SchedulerTaskHistory(name=name, last_run=scheduled_task_history.get('last_run', 0), next_run=0, scheduled_task_id=None)
+            candidates.append((task_id, history))
+        if not candidates:
+            return
+
+        try:
+            reset = yield from self.tq_storage.reset_lost_tasks(candidates, fence=self.leader_token)
+        except FencingError:
+            log.error('Leadership is lost, lost tasks are left to new leader')
+            self.leader_token = 0
+            return
+        except Exception:
+            log.error('Cannot check {} lost tasks, retry later'.format(len(candidates)), exc_info=True)
+            reset = []
+
+        reset = set(reset)
+        for task_id, history in candidates:
+            if history.name in reset:
+                log.info('Reset lost task id={}, name={}'.format(task_id, history.name))
+                self.scheduler_tasks_history[history.name].update(next_run=0, scheduled_task_id=None)
+                self._rearm(history.name)
+            else:
+                # Pending or dispatched recently, check it again later
+                heapq.heappush(self.lost_deadlines, (time_now + SETTINGS.SCHEDULER_LOST_TASK_MARGIN * 1000, history.name, task_id))
 
     @asyncio.coroutine
     def _ping_disptacher(self):
@@ -268,6 +619,7 @@ class Scheduler(object):
     def sleep(self):
         try:
             reply = yield from self.subscription.next_published()
+            self._apply_history_delta(reply.value)
         except GeneratorExit:
             log.info('Stop subscription')
             return
@@ -278,22 +630,49 @@ class Scheduler(object):
 
     @asyncio.coroutine
     def _cleanup_scheduled_history(self):
-        # Clean hash table in redis for task with very old last-run and without next_run
+        # Clean hash table in redis for task with very old last-run and without next_run.
+        # Incremental sweep with HSCAN, every slice takes at most
+        # SCHEDULED_HISTORY_CLEANUP_SLICE of loop time
         log.info("Run cleanup task for table Scheduled History")
-        tasks_history = yield from self.connection.hgetall(SETTINGS.SCHEDULER_HISTORY_HASH)
-        for f in tasks_history:
-            key, value = yield from f
+        try:
+            if self.leader_token:
+                yield from self._sweep_scheduled_history()
+        except Exception:
+            log.error('Cleanup of Scheduled History table failed', exc_info=True)
+        self.current_loop.call_later(SETTINGS.SCHEDULED_HISTORY_CLEANUP_PERIOD, self._create_asyncio_task, self._cleanup_scheduled_history)
+
+    @asyncio.coroutine
+    def _sweep_scheduled_history(self):
+        cursor = yield from self.connection.hscan(SETTINGS.SCHEDULER_HISTORY_HASH)
+        stale_keys = []
+        slice_start = time.time()
+        min_last_run = int(now()) - SETTINGS.SCHEDULED_HISTORY_CLEANUP_MAX_TTL * 1000
+        while True:
+            item = yield from cursor.fetchone()
+            if item is None:
+                break
+            key, value = item.popitem()
             # Iterate over all tasks in history and deserialize
             try:
                 task_history = SchedulerTaskHistory.deserialize(value)
             except (pickle.UnpicklingError, EOFError, TypeError, ImportError):
                 log.error('Cannot deserialize SchedulerTaskHistory for {}'.format(key), exc_info=True)
                 continue
-            if not task_history.next_run and (int(now()) - task_history.last_run) > (SETTINGS.SCHEDULED_HISTORY_CLEANUP_MAX_TTL * 1000):
+            if not task_history.next_run and task_history.last_run < min_last_run:
                 # task is too old, remove it
                 log.info('Cleanup for Scheduled History table. Remove task, name={}'.format(task_history.name))
-                yield from self.connection.hdel(SETTINGS.SCHEDULER_HISTORY_HASH, [key])
-        self.current_loop.call_later(SETTINGS.SCHEDULED_HISTORY_CLEANUP_PERIOD, self._create_asyncio_task, self._cleanup_scheduled_history)
+                stale_keys.append(key)
+            if len(stale_keys) >= SETTINGS.SCHEDULED_HISTORY_CLEANUP_BATCH:
+                yield from self.connection.hdel(SETTINGS.SCHEDULER_HISTORY_HASH, stale_keys)
+                yield from self.connection.hdel(SETTINGS.SCHEDULER_HISTORY_TASKS_HASH, stale_keys)
+                stale_keys = []
+            if time.time() - slice_start > SETTINGS.SCHEDULED_HISTORY_CLEANUP_SLICE:
+                # Give loop to scheduling
+                yield from asyncio.sleep(SETTINGS.SCHEDULED_HISTORY_CLEANUP_PAUSE)
+                slice_start = time.time()
+        if stale_keys:
+            yield from self.connection.hdel(SETTINGS.SCHEDULER_HISTORY_HASH, stale_keys)
+            yield from self.connection.hdel(SETTINGS.SCHEDULER_HISTORY_TASKS_HASH, stale_keys)
 
     def _create_asyncio_task(self, f, args=None, kwargs=None):
         # XXX Should be at BaseEventLoop, but i can't find it!!!
@@ -306,9 +685,11 @@ class Scheduler(object):
         self.connection = yield from asyncio_redis.Pool.create(host='localhost', port=6379, encoder=asyncio_redis.encoders.BytesEncoder(), poolsize=5)
 
         self.tq_storage = TaskStorage(self.current_loop, self.connection)
+        self.config_cache = ConfigCache(self.connection)
 
-        # Update objects in storage
-        self.install_bootstrap()
+        # Sync storage works in executor, don't block first ticks
+        self.current_loop.run_in_executor(None, self.install_bootstrap_once)
+        yield from self._update_leadership()
 
         # Initialize worker-scheduler feedback subscription
         self.subscription = yield from self.connection.start_subscribe()
@@ -316,7 +697,8 @@ class Scheduler(object):
         self.sleep_task = asyncio.Task(self.sleep())
 
         # Run scheduled history cleanup
-        yield from self._cleanup_scheduled_history()
+        # Cleanup runs in background, don't delay first schedule
+        asyncio.Task(self._cleanup_scheduled_history())
 
     def start(self, loop):
         self.current_loop = loop
@@ -327,7 +709,7 @@ class Scheduler(object):
     def stop(self, sig):
         log.info("Got {} signal, we should finish all tasks and stop daemon".format(sig))
         self.run = False
-        self.current_loop.stop()
+        asyncio.Task(self._shutdown())
 
     @asyncio.coroutine
     def loop(self):
@@ -337,33 +719,24 @@ class Scheduler(object):
                 # Inside a while loop, fetch scheduled tasks
                 t_start = time.time()
 
+                # Take or renew leadership
+                yield from self._update_leadership()
+
                 # May be reload config (limited to 1 per second)
                 yield from self._reload_config_tasks_list()
 
-                # Refresh scheduler run history
-                yield from self._load_scheduler_tasks_history()
-
-                # Kill expired tasks (broken worker)
-                yield from self._check_expired_tasks()
-
-                current_time = now()
-                for scheduler_task_name, scheduler_task in self.scheduler_tasks.items():
-                    scheduled_task_history = self.scheduler_tasks_history[scheduler_task_name]
-                    # Iterate over all recurrent tasks
-                    if (scheduled_task_history.get('next_run', 0) <= scheduled_task_history.get('last_run', 0)):
-                        log.debug('Got unscheduled task {}'.format(scheduler_task_name))
-                        # Task is not scheduled/executed now, so need to schedule
-                        next_run_dt = self._get_next_run_time(scheduler_task_name, scheduler_task, int(current_time))
-                        log.debug('Next run {} for task {}'.format(next_run_dt, scheduler_task_name))
-                        yield from self.schedule_task(name=scheduler_task_name,
-                                                    task_type=Task.TYPE_REGULAR,
-                                                    run_at=next_run_dt,
-                                                    ttl=scheduler_task.get('ttl') or SETTINGS.WORKER_TASK_TIMEOUT,
-                                                    kwargs=scheduler_task)
-                        yield from self._ping_disptacher()
+                # Refresh scheduler run history (slow periodic full reload)
+                yield from self._reconcile_scheduler_tasks_history()
+
+                if self.leader_token:
+                    yield from self._schedule_due_tasks()
 
                 t_end = time.time()
                 delay = SETTINGS.SCHEDULER_PULL_TIMEOUT - (t_end - t_start)
+                next_deadline = self._get_next_deadline()
+                if self.leader_token and next_deadline is not None:
+                    # Wake up right at the next deadline
+                    delay = min(delay, (next_deadline - int(now())) / 1000)
                 if delay > 0:
                     # Sleep for timeout or new push from scheduler
                     try:
@@ -373,8 +746,6 @@ class Scheduler(object):
             except:
                 log.error("Unexpected error in scheduler loop!", exc_info=True)
 
-        self.current_loop.stop()
-        self.connection.close()
         log.info('Bye-bye!')
 
 
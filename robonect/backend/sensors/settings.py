@@ -10,10 +10,21 @@ __all__ = 'SETTINGS',
 SETTINGS_DICT = dict(
     BASE_DIR=os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../')),
 
-    SCHEDULED_QUEUE=b'queue:scheduled',
+    SCHEDULED_QUEUE=b'queue:scheduled',  # Shard 0 of scheduled queue
+    SCHEDULED_QUEUE_SHARD='queue:scheduled:{}',  # Other shards of scheduled queue
+    SCHEDULED_QUEUE_SHARDS=1,  # Tasks are spread over shards by hash of task name
     DISPATCHED_QUEUE=b'queue:dispatched',
+    DISPATCHED_PRIORITY_QUEUE=b'queue:dispatched:priority',  # Triggered tasks, workers drain it first
+    DISPATCHED_WAKEUP_QUEUE=b'queue:dispatched:wakeup',  # Token is pushed for each dispatched task, idle workers block on it and claim tasks
+    DISPATCHED_WAKEUP_LIMIT=100,  # How many wakeup tokens are kept at most
     INPROGRESS_QUEUE=b'queue:inprogress',
     INPROGRESS_TASKS_SET=b'queue:set:inprogress',
+    DISPATCHED_TASKS_SET=b'queue:set:dispatched',  # Task id -> dispatch time (ms), until task is finished
+
+    TASK_TRANSPORT='list',  # 'list' -- dispatched lists and BRPOP, 'stream' -- dispatched streams and consumer group
+    DISPATCHED_STREAM=b'queue:stream:dispatched',
+    DISPATCHED_PRIORITY_STREAM=b'queue:stream:dispatched:priority',
+    WORKER_CONSUMER_GROUP=b'workers',
 
     LAST_VALUES_HASH=b'robonect:metrics-last_values',  # Store pickled last_value for metrics (key=metric_id)
     TRIGGER_STATES=b'queue:triggers:states',  # Store trigger lock/uncloked state
@@ -27,13 +38,36 @@ SETTINGS_DICT = dict(
     SCHEDULER_TO_DISPATCHER_CHANNEL=b'queue:scheduler-dispatcher-notifications',
     WORKER_TO_SCHEDULER_CHANNEL=b'queue:worker-scheduler-notifications',
 
-    DISPATCHER_PULL_TIMEOUT=1,
-    DISPATCHED_QUEUE_LIMIT=4000,
+    DISPATCHER_PULL_TIMEOUT=1,  # Upper bound of sleep, dispatcher wakes up on earliest task run_at or scheduler ping
+    DISPATCHED_QUEUE_LIMIT=4000,  # Dispatcher stops moving tasks when dispatched queue is full, tasks wait in scheduled queue
+    DISPATCHER_BACKPRESSURE_SLEEP=0.1,  # How long to sleep when dispatched queue is full
+    DISPATCHER_STATS_HASH=b'queue:dispatcher:stats',  # Counters: dispatched, lag_total (ms), lag_max (ms), backlog, overflows
+    DISPATCHER_BACKLOG_CHANNEL=b'queue:dispatcher-backlog',  # Due tasks count waiting in scheduled queue
+    DISPATCHER_LEASE_KEY='queue:dispatcher:lease:{}',  # Dispatcher owns shard of scheduled queue while holds its lease
+    DISPATCHER_LEASE_TTL=5,  # (sec) Shard is taken over by other dispatcher if lease is not renewed
+    DISPATCHERS_SET=b'queue:dispatchers',  # Alive dispatchers heartbeats, used to split shards between them
 
     SCHEDULER_PULL_TIMEOUT=1,
     SCHEDULER_HISTORY_HASH=b'scheduler:queue:scheduler-tasks-history',
+    SCHEDULER_HISTORY_TASKS_HASH=b'scheduler:queue:scheduler-tasks-ids',  # Action -> id of its scheduled task ('' when it is finished), worker updates history only for this task
+    SCHEDULER_PHASE_MODE='hash',  # Phase of action runs within its period: none, hash (of action id), spread (evenly between actions with same period)
+    SCHEDULER_CATCHUP_POLICY='coalesce',  # Missed runs of action after downtime: skip, coalesce (one run), replay (run each)
+    SCHEDULER_CATCHUP_REPLAY_LIMIT=10,  # How many missed runs replay at most
+    SCHEDULER_CATCHUP_GRACE=5,  # (sec) Run is missed if it is late more than this
+    SCHEDULER_CATCHUP_RATE=20,  # How many missed runs release per second, 0 - no limit
+    SCHEDULER_BOOTSTRAP_KEY=b'scheduler:bootstrap',  # Hash of installed bootstrap file, it is installed once for all schedulers
+    SCHEDULER_LEADER_KEY=b'scheduler:leader',  # Only scheduler holding this lease schedules tasks, others are hot standby
+    SCHEDULER_LEADER_FENCE_KEY=b'scheduler:leader:fence',  # Fencing token, incremented by every new leader
+    SCHEDULER_LEADER_TTL=5,  # (sec) Standby takes over leadership if lease is not renewed
+    SCHEDULER_LOST_TASK_MARGIN=10,  # (sec) Task which isn't scheduled or in progress after run time + ttl + margin is lost, its action is rescheduled
+    SCHEDULER_HISTORY_RECONCILE_PERIOD=60,  # (sec) Full reload of history, changes come from workers on WORKER_TO_SCHEDULER_CHANNEL
     SCHEDULED_HISTORY_CLEANUP_PERIOD=7200,  # (sec) 2 hours (too often)
     SCHEDULED_HISTORY_CLEANUP_MAX_TTL=1209600,  # (sec) 14 days
+    SCHEDULED_HISTORY_CLEANUP_BATCH=100,  # How many stale entries remove with one HDEL
+    SCHEDULED_HISTORY_CLEANUP_SLICE=0.01,  # (sec) How long cleanup may run without giving control back to loop
+    SCHEDULED_HISTORY_CLEANUP_PAUSE=0.05,  # (sec) Pause between cleanup slices
+
+    CONFIG_CACHE_CHECK_INTERVAL=1,  # (sec) How often daemons check configuration version (lastChanged), config is reloaded only when it changes
 
     COMPORT_STATE_HASH=b'robonect:comports-state',
     COMPORT_LOCK_HASH=b'robonect:comports-lock',
@@ -47,6 +81,36 @@ SETTINGS_DICT = dict(
     WORKER_TASK_TIMEOUT=30,  # How long task can be executed, default value for TTL of scheduled action
     WORKER_TASKS_LIMIT=50,  # How many tasks can take worker in parallel processing
     WORKER_PULL_SLEEP=0.05,  # How long to sleep after unsuccesfull blocking pop (50ms)
+    WORKER_CLAIM_BATCH=10,  # How many tasks worker claims from dispatched lists at once
+    WORKER_STREAM_BATCH=10,  # How many tasks worker reads from dispatched streams at once
+    WORKER_STREAM_CLAIM_IDLE=120,  # (sec) Take over tasks of dead worker after this time, should be greater than max action ttl
+    WORKER_READ_CHUNK=4096,  # How many bytes read from session at once
+    WORKER_READ_IDLE_TTL=1,  # (sec) Command output is finished if there is no new data for this time
+    WORKER_READ_TIMEOUT=10,  # (sec) Idle timeout for connections with 'prompt' or 'sentinel', output end is detected by them
+    WORKER_SENTINEL='__robo_end_{}__',  # Echoed after command to mark end of its output
+    WORKER_OUTPUT_LIMIT=1024 * 1024,  # How many bytes of output of command (and joined output of action) are kept, action can set own 'output_limit'
+    WORKER_OUTPUT_SPOOL_SIZE=64 * 1024,  # Output over this size is spooled to temporary file
+    WORKER_OUTPUT_TRUNCATED='\n[... {} bytes truncated]\n',  # Appended to output cut by limit
+    WORKER_SESSION_POOL_TYPES=('ssh',),  # Sessions of these connection types are reused between tasks by default, connection can set 'pool': true/false
+    WORKER_SESSION_IDLE_TTL=60,  # (sec) Close session not used for this time, COM-port is locked while its session is open
+    WORKER_SESSIONS_PER_HOST=4,  # How many sessions worker can open to one host
+    WORKER_STOP_TIMEOUT=30,  # (sec) On SIGTERM worker stops claiming tasks and waits for running ones this time
+    WORKER_LAG_HASH=b'queue:workers:lag',  # Event loop lag of workers for supervisor, consumer -> [lag (sec), timestamp]
+    WORKER_LAG_REPORT_PERIOD=1,  # (sec) How often worker measures and reports lag of its event loop
+    WORKER_TYPE_LIMITS={'local': 10},  # How many commands of connection type can run at once, type -> limit
+    WORKER_HOST_LIMIT=4,  # How many commands can run on one host at once (0 - no limit)
+    WORKER_CONNECTION_LIMIT=2,  # How many commands can run through one connection at once, connection can set own 'max_sessions' (0 - no limit)
+    WORKER_PLAN_CACHE_SIZE=256,  # How many compiled command plans of actions worker keeps
+    WORKER_PARALLEL_CONNECTIONS=False,  # Run commands to different connections of scenario concurrently (action can override with 'parallel')
+
+    SUPERVISOR_MIN_WORKERS=1,  # Supervisor keeps at least this many worker processes
+    SUPERVISOR_MAX_WORKERS=0,  # Upper bound of worker processes, 0 - number of CPU cores
+    SUPERVISOR_CHECK_PERIOD=5,  # (sec) How often supervisor checks workers and their load
+    SUPERVISOR_SCALE_UP_QUEUE=100,  # Start one more worker when dispatched queue has more tasks than this per worker
+    SUPERVISOR_SCALE_UP_LAG=0.5,  # (sec) Start one more worker when event loop of any worker lags more than this
+    SUPERVISOR_SCALE_DOWN_DELAY=60,  # (sec) Stop one worker when load is low for this time
+    SUPERVISOR_RESTART_DELAY=1,  # (sec) Pause before restart of crashed worker
+    SUPERVISOR_STOP_TIMEOUT=40,  # (sec) Kill worker if it is not stopped in this time after SIGTERM, should be greater than WORKER_STOP_TIMEOUT
 
     METRICS_TYPES_MAP={'string': str,
                        'float': float,
@@ -0,0 +1,187 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import ujson
+
+import redis
+
+from sensors import worker
+from sensors.settings import SETTINGS
+
+
+__all__ = 'Supervisor',
+
+
+log = logging.getLogger('taskqueue.supervisor')
+
+
+class Supervisor():
+    """ Pre-forks worker processes and keeps their number between min and
+    max workers: one more worker is started when dispatched queue grows or
+    event loops of workers lag, one worker is stopped when load is low for
+    SUPERVISOR_SCALE_DOWN_DELAY. Crashed workers are restarted. """
+    _connection = None
+    _settings = {
+        'host': 'localhost',
+        'port': 6379,
+        'db': 0,
+    }
+
+    def __init__(self, min_workers=None, max_workers=None, target=worker.run):
+        self.min_workers = max(min_workers or SETTINGS.SUPERVISOR_MIN_WORKERS, 1)
+        self.max_workers = max(max_workers or SETTINGS.SUPERVISOR_MAX_WORKERS or multiprocessing.cpu_count(), self.min_workers)
+        self.target = target
+        self.count = self.min_workers
+        self.workers = []
+        # Workers got SIGTERM, process -> kill deadline
+        self.stopping = {}
+        self.low_load_since = None
+        self.last_crash = 0
+        self.run = True
+
+    @property
+    def connection(self):
+        if not self._connection:
+            self._connection = redis.StrictRedis(**self._settings)
+        return self._connection
+
+    def start(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        log.info("Running supervisor, workers: {}..{}".format(self.min_workers, self.max_workers))
+        while self.run:
+            self.check_workers()
+            try:
+                self.scale(self.get_queue_depth(), self.get_max_lag())
+            except redis.RedisError:
+                log.error("Cannot get load of workers", exc_info=True)
+            self.spawn()
+            deadline = time.time() + SETTINGS.SUPERVISOR_CHECK_PERIOD
+            while self.run and time.time() < deadline:
+                time.sleep(0.1)
+        self.stop_workers()
+        log.info('Bye-bye!')
+
+    def stop(self, signum, frame):
+        log.info("Got {} signal, stop workers".format(signum))
+        self.run = False
+
+    def scale(self, depth, lag):
+        """ scale -- change number of workers by load
+
+        :param depth: tasks waiting in dispatched queue
+        :param lag: (sec) max event loop lag of workers
+        """
+        if depth > SETTINGS.SUPERVISOR_SCALE_UP_QUEUE * self.count or lag > SETTINGS.SUPERVISOR_SCALE_UP_LAG:
+            self.low_load_since = None
+            if self.count < self.max_workers:
+                self.count += 1
+                log.info("Scale up to {} workers, queue={}, lag={:.3f}s".format(self.count, depth, lag))
+        elif (self.count > self.min_workers and lag < SETTINGS.SUPERVISOR_SCALE_UP_LAG / 2
+              and depth <= SETTINGS.SUPERVISOR_SCALE_UP_QUEUE * (self.count - 1) / 2):
+            if self.low_load_since is None:
+                self.low_load_since = time.time()
+            elif time.time() - self.low_load_since >= SETTINGS.SUPERVISOR_SCALE_DOWN_DELAY:
+                self.low_load_since = None
+                self.count -= 1
+                log.info("Scale down to {} workers, queue={}, lag={:.3f}s".format(self.count, depth, lag))
+        else:
+            self.low_load_since = None
+
+    def spawn(self):
+        """ Start or stop workers to match wanted count """
+        while len(self.workers) > self.count:
+            # Newest worker has the least tasks in progress
+            self.stop_worker(self.workers.pop())
+        while len(self.workers) < self.count:
+            if time.time() - self.last_crash < SETTINGS.SUPERVISOR_RESTART_DELAY:
+                # Don't fork in loop if workers crash on start
+                break
+            self.workers.append(self.start_worker())
+
+    def start_worker(self):
+        process = multiprocessing.Process(target=self.target, name='worker')
+        process.start()
+        log.info("Started worker pid={}".format(process.pid))
+        return process
+
+    def stop_worker(self, process):
+        log.info("Stop worker pid={}".format(process.pid))
+        try:
+            os.kill(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.stopping[process] = time.time() + SETTINGS.SUPERVISOR_STOP_TIMEOUT
+
+    def check_workers(self):
+        """ Forget exited workers, crashed ones are restarted by spawn(),
+        kill workers which don't stop in time """
+        for process in self.workers[:]:
+            if not process.is_alive():
+                log.error("Worker pid={} exited with code {}, restart it".format(process.pid, process.exitcode))
+                self.workers.remove(process)
+                self.last_crash = time.time()
+                self._forget(process)
+        for process, deadline in list(self.stopping.items()):
+            if not process.is_alive():
+                del self.stopping[process]
+                self._forget(process)
+            elif time.time() > deadline:
+                log.error("Worker pid={} is not stopped in {}s, kill it".format(process.pid, SETTINGS.SUPERVISOR_STOP_TIMEOUT))
+                process.kill()
+
+    def stop_workers(self):
+        for process in self.workers:
+            self.stop_worker(process)
+        self.workers = []
+        while self.stopping:
+            self.check_workers()
+            time.sleep(0.1)
+
+    def get_queue_depth(self):
+        if SETTINGS.TASK_TRANSPORT == 'stream':
+            depth = 0
+            for stream in (SETTINGS.DISPATCHED_PRIORITY_STREAM, SETTINGS.DISPATCHED_STREAM):
+                for group in self.connection.xinfo_groups(stream):
+                    if group['name'] == SETTINGS.WORKER_CONSUMER_GROUP:
+                        depth += group.get('lag') or 0
+            return depth
+        return self.connection.llen(SETTINGS.DISPATCHED_QUEUE) + self.connection.llen(SETTINGS.DISPATCHED_PRIORITY_QUEUE)
+
+    def get_max_lag(self):
+        """ Max event loop lag reported by our workers, outdated reports
+        are ignored """
+        fields = [self._get_consumer(process) for process in self.workers]
+        if not fields:
+            return 0
+        min_time = time.time() - SETTINGS.WORKER_LAG_REPORT_PERIOD * 3
+        lags = [0]
+        for value in self.connection.hmget(SETTINGS.WORKER_LAG_HASH, fields):
+            if value:
+                lag, reported_at = ujson.loads(value)
+                if reported_at >= min_time:
+                    lags.append(lag)
+        return max(lags)
+
+    def _forget(self, process):
+        try:
+            self.connection.hdel(SETTINGS.WORKER_LAG_HASH, self._get_consumer(process))
+        except redis.RedisError:
+            log.error("Cannot remove lag of worker pid={}".format(process.pid), exc_info=True)
+
+    @staticmethod
+    def _get_consumer(process):
+        return '{}:{}'.format(socket.gethostname(), process.pid).encode('utf-8')
+
+
+def run():
+    try:
+        supervisor = Supervisor()
+        supervisor.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info("Stopping daemon...")
@@ -1,3 +1,96 @@
 from sensors.scheduler import Scheduler
+from sensors.settings import SETTINGS
+from sensors.utils import now, datetime_to_timestamp
 
 from sensors.tests.base import AsyncTestCase, async
+
+
+class SchedulerTestCase(AsyncTestCase):
+
+    def setUp(self):
+        super(SchedulerTestCase, self).setUp()
+        self.scheduler = Scheduler()
+
+    def test_deadlines(self):
+        """ Test deadlines heap """
+        time_now = int(now())
+        self.scheduler.scheduler_tasks = {'A1': {'schedule': '10s', 'phase': 'none'},
+                                          'A2': {'schedule': '1m', 'phase': 'none'},
+                                          'A3': {'schedule': '1m', 'phase': 'none'}}
+        self.scheduler.scheduler_tasks_history['A1'].update(last_run=time_now, next_run=0)
+        self.scheduler.scheduler_tasks_history['A2'].update(last_run=time_now, next_run=0)
+        # Scheduled task has no deadline
+        self.scheduler.scheduler_tasks_history['A3'].update(last_run=time_now, next_run=time_now + 60000)
+        for name in ('A1', 'A2', 'A3'):
+            self.scheduler._rearm(name)
+
+        self.assertEquals(self.scheduler._get_next_deadline(), time_now + 10000)
+        self.assertListEqual(self.scheduler._pop_due(time_now + 9999), [])
+        self.assertListEqual(self.scheduler._pop_due(time_now + 10000), [(time_now + 10000, 'A1')])
+        self.assertEquals(self.scheduler._get_next_deadline(), time_now + 60000)
+
+        # New deadline replaces old one
+        self.scheduler._arm('A2', time_now + 20000)
+        self.assertEquals(self.scheduler._get_next_deadline(), time_now + 20000)
+        self.assertListEqual(self.scheduler._pop_due(time_now + 120000), [(time_now + 20000, 'A2')])
+        self.assertIsNone(self.scheduler._get_next_deadline())
+
+    def test_apply_history_delta(self):
+        """ Test run history changes from worker """
+        time_now = int(now())
+        self.scheduler.scheduler_tasks = {'A1': {'schedule': '10s', 'phase': 'none'}}
+        self.scheduler.scheduler_tasks_history['A1'].update(last_run=time_now - 10000, next_run=time_now, scheduled_task_id='T1')
+        self.scheduler._rearm('A1')
+        self.assertIsNone(self.scheduler._get_next_deadline())
+
+        # Message about other task is skipped
+        self.scheduler._apply_history_delta(b'{"name": "A1", "task_id": "T0", "last_run": 1}')
+        self.assertEquals(self.scheduler.scheduler_tasks_history['A1']['scheduled_task_id'], 'T1')
+        self.assertIsNone(self.scheduler._get_next_deadline())
+
+        self.scheduler._apply_history_delta('{{"name": "A1", "task_id": "T1", "last_run": {}}}'.format(time_now).encode('utf-8'))
+        self.assertDictEqual(self.scheduler.scheduler_tasks_history['A1'], dict(last_run=time_now, next_run=0, scheduled_task_id=None))
+        self.assertEquals(self.scheduler._get_next_deadline(), time_now + 10000)
+
+        # History written by leader scheduler
+        self.scheduler._apply_history_delta('{{"history": [["A1", {}, {}, "T2"]]}}'.format(time_now, time_now + 10000).encode('utf-8'))
+        self.assertDictEqual(self.scheduler.scheduler_tasks_history['A1'], dict(last_run=time_now, next_run=time_now + 10000, scheduled_task_id='T2'))
+        self.assertIsNone(self.scheduler._get_next_deadline())
+
+        # Broken message forces full reload of history
+        self.scheduler._history_reconcile_last_run = time_now
+        self.scheduler._apply_history_delta(b'')
+        self.assertEquals(self.scheduler._history_reconcile_last_run, 0)
+
+    def test_phase(self):
+        """ Test next run time with phase offset """
+        self.scheduler.scheduler_tasks = {'A1': {'schedule': '1m', 'phase': '15s'},
+                                          'A2': {'schedule': '1m'}, 'A3': {'schedule': '1m'}}
+        get_next_run = lambda name, current_time: datetime_to_timestamp(
+            self.scheduler._get_next_run_time(name, self.scheduler.scheduler_tasks[name], current_time))
+
+        # Next slot after last run
+        self.scheduler.scheduler_tasks_history['A1'].update(last_run=600000)
+        self.assertEquals(get_next_run('A1', 600000), 615000)
+        self.scheduler.scheduler_tasks_history['A1'].update(last_run=615000)
+        self.assertEquals(get_next_run('A1', 615000), 675000)
+        # Missed slots
+        self.assertEquals(get_next_run('A1', 800000), 795000)
+        self.scheduler.scheduler_tasks['A1']['catchup'] = 'skip'
+        self.assertEquals(get_next_run('A1', 800000), 855000)
+        self.scheduler.scheduler_tasks['A1'].update(catchup='replay', catchup_limit=2)
+        self.assertEquals(get_next_run('A1', 700000), 675000)
+        self.assertEquals(get_next_run('A1', 800000), 735000)
+
+        # Evenly spread actions
+        self.scheduler.scheduler_tasks['A1'] = {'schedule': '1m', 'phase': 'auto'}
+        self.assertDictEqual(self.scheduler._plan_phases(), {'A1': 0, 'A2': 20000, 'A3': 40000})
+
+    def test_catchup_rate(self):
+        """ Test rate limit of missed runs """
+        time_now = int(now())
+        for i in range(SETTINGS.SCHEDULER_CATCHUP_RATE):
+            self.assertTrue(self.scheduler._take_catchup_token(time_now))
+        self.assertFalse(self.scheduler._take_catchup_token(time_now))
+        self.assertTrue(self.scheduler._take_catchup_token(time_now + 1000 // SETTINGS.SCHEDULER_CATCHUP_RATE))
+        self.assertFalse(self.scheduler._take_catchup_token(time_now + 1000 // SETTINGS.SCHEDULER_CATCHUP_RATE))
@@ -0,0 +1,26 @@
+import time
+import unittest
+
+from sensors.settings import SETTINGS
+from sensors.supervisor import Supervisor
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def test_scale(self):
+        """ Test number of workers follows load """
+        supervisor = Supervisor(min_workers=1, max_workers=3)
+        supervisor.scale(SETTINGS.SUPERVISOR_SCALE_UP_QUEUE + 1, 0)
+        self.assertEquals(supervisor.count, 2)
+        supervisor.scale(0, SETTINGS.SUPERVISOR_SCALE_UP_LAG + 1)
+        self.assertEquals(supervisor.count, 3)
+        # Never more than max workers
+        supervisor.scale(0, SETTINGS.SUPERVISOR_SCALE_UP_LAG + 1)
+        self.assertEquals(supervisor.count, 3)
+
+        # Low load should last for scale down delay
+        supervisor.scale(0, 0)
+        self.assertEquals(supervisor.count, 3)
+        supervisor.low_load_since = time.time() - SETTINGS.SUPERVISOR_SCALE_DOWN_DELAY
+        supervisor.scale(0, 0)
+        self.assertEquals(supervisor.count, 2)
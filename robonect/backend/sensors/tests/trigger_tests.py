@@ -15,6 +15,7 @@ class TriggerTestCase(AsyncTestCase):
         self.trigger = Trigger()
         self.trigger.tq_storage = mock.Mock()
         self.trigger.connection = mock.Mock()
+        self.trigger.config = redis.ConfigCache(self.trigger.connection)
         self.trigger.db_log = mock.Mock()
 
     def test_check_condition(self):
@@ -80,13 +81,13 @@ class TriggerTestCase(AsyncTestCase):
     @async
     def test_reload_triggers(self):
         """ Test reload triggers """
-        with mock.patch.object(redis.ConfigStorage, 'list_triggers', return_value={}) as m:
+        with mock.patch.object(redis.ConfigCache, 'list_triggers', side_effect=mock_coroutine([{}])) as m:
             yield from self.trigger._reload_triggers()
             self.assertEquals(len(self.trigger.triggers), 0)
             self.assertEquals(len(self.trigger.metrics_id_to_triggers.keys()), 0)
 
         triggers = {'T1': {'title': 'T1', 'conditions': [{'metric_id': 'M1', 'function': 'eq', 'value': '1'}]}}
-        with mock.patch.object(redis.ConfigStorage, 'list_triggers', return_value=triggers) as m:
+        with mock.patch.object(redis.ConfigCache, 'list_triggers', side_effect=mock_coroutine([triggers])) as m:
             yield from self.trigger._reload_triggers()
             self.assertEquals(len(self.trigger.triggers), 1)
             self.assertEquals(len(self.trigger.metrics_id_to_triggers.keys()), 1)
@@ -94,7 +95,7 @@ class TriggerTestCase(AsyncTestCase):
 
         triggers = {'T1': {'title': 'T1', 'conditions': [{'metric_id': 'M1', 'function': 'eq', 'value': '1'},
                                                          {'metric_id': 'M2', 'function': 'eq', 'value': '2'}]}}
-        with mock.patch.object(redis.ConfigStorage, 'list_triggers', return_value=triggers) as m:
+        with mock.patch.object(redis.ConfigCache, 'list_triggers', side_effect=mock_coroutine([triggers])) as m:
             yield from self.trigger._reload_triggers()
             self.assertEquals(len(self.trigger.triggers), 1)
             self.assertEquals(len(self.trigger.metrics_id_to_triggers.keys()), 2)
@@ -105,7 +106,7 @@ class TriggerTestCase(AsyncTestCase):
                                                          {'metric_id': 'M2', 'function': 'eq', 'value': '2'}]},
                     'T2': {'title': 'T2', 'conditions': [{'metric_id': 'M2', 'function': 'eq', 'value': '3'},
                                                          {'metric_id': 'M3', 'function': 'eq', 'value': '4'}]},}
-        with mock.patch.object(redis.ConfigStorage, 'list_triggers', return_value=triggers) as m:
+        with mock.patch.object(redis.ConfigCache, 'list_triggers', side_effect=mock_coroutine([triggers])) as m:
             yield from self.trigger._reload_triggers()
             self.assertEquals(len(self.trigger.triggers), 2)
             self.assertEquals(len(self.trigger.metrics_id_to_triggers.keys()), 3)
@@ -119,26 +120,32 @@ class TriggerTestCase(AsyncTestCase):
         action2 = {'title': 'Выполнить команду', '_id': 'act2', 'params': [{'param': 'Команда', 'value': 'V2'}]}
         trigger1 = {'_id': 'T1', 'scenario': [{'action_id': 'exec', 'params': [{'param': 'Команда', 'value': 'V1'}]}]}
 
-        with mock.patch.object(redis.ConfigStorage, 'get_action', return_value=action1) as m1, \
+        with mock.patch.object(redis.ConfigCache, 'get_action', side_effect=mock_coroutine([action1])) as m1, \
             mock.patch.object(self.trigger.tq_storage, 'create_task', side_effect=mock_coroutine()) as m2, \
-            mock.patch.object(self.trigger.tq_storage, 'schedule_task', side_effect=mock_coroutine()) as m3:
+            mock.patch.object(self.trigger.tq_storage, 'schedule_task', side_effect=mock_coroutine()) as m3, \
+            mock.patch.object(self.trigger.tq_storage, 'ping_dispatcher', side_effect=mock_coroutine()) as m4:
             yield from self.trigger._activate_trigger(trigger1)
 
             self.assertEquals(m1.call_count, 1)
             self.assertEquals(m2.call_count, 1)
             self.assertEquals(m2.call_count, 1)
+            # Dispatched directly, without dispatcher ping
+            self.assertEquals(m4.call_count, 0)
 
         trigger2 = {'_id': 'T2', 'scenario': [{'action_id': 'exec', 'params': [{'param': 'Команда', 'value': 'V1'}]},
                                              {'action_id': 'act2', 'params': [{'param': 'Команда', 'value': 'V2'}]},]}
-        with mock.patch.object(redis.ConfigStorage, 'get_action', side_effect=[action1, action2]) as m1, \
+        with mock.patch.object(redis.ConfigCache, 'get_action', side_effect=mock_coroutine([action1, action2])) as m1, \
             mock.patch.object(self.trigger.tq_storage, 'create_task', side_effect=mock_coroutine()) as m2, \
-            mock.patch.object(self.trigger.tq_storage, 'schedule_task', side_effect=mock_coroutine()) as m3:
+            mock.patch.object(self.trigger.tq_storage, 'schedule_task', side_effect=mock_coroutine([False, False])) as m3, \
+            mock.patch.object(self.trigger.tq_storage, 'ping_dispatcher', side_effect=mock_coroutine()) as m4:
 
             yield from self.trigger._activate_trigger(trigger2)
 
             self.assertEquals(m1.call_count, 2)
             self.assertEquals(m2.call_count, 2)
             self.assertEquals(m2.call_count, 2)
+            # Scheduled to scheduled queue, ping dispatcher for every task
+            self.assertEquals(m4.call_count, 2)
 
             self.assertEquals(m1.call_args_list[0][0][0], 'exec')
             self.assertEquals(m2.call_args_list[0][1]['name'], 'exec')
@@ -1,3 +1,208 @@
-from sensors.worker import BaseWorker, MultiActionRunnerWorker
+import asyncio
+import mock
+import re
+import unittest
 
+from sensors.worker import BaseWorker, MultiActionRunnerWorker, SessionPool, FairSemaphore, ConcurrencyLimits, OutputBuffer, OutputEnd, find_output_end, get_input_echo, get_read_output, join_outputs, split_output
+
+from sensors.settings import SETTINGS
 from sensors.tests.base import AsyncTestCase, async
+
+
+class OutputEndTestCase(unittest.TestCase):
+
+    def test_sentinel(self):
+        """ Test output end by echoed sentinel """
+        text = 'ls\r\necho __end__\r\nfile1\r\n$ echo __end__\r\n'
+        self.assertIsNone(find_output_end(text, 0, sentinel='__end__'))
+        self.assertEquals(find_output_end(text + '__end__\r\n$ ', len(text), sentinel='__end__'), 'ls\r\nfile1\r')
+
+    def test_prompt(self):
+        """ Test output end by prompt """
+        prompt = re.compile(r'[$#] ?$')
+        self.assertIsNone(find_output_end('ls\r\nfile1\r\n', 0, prompt=prompt))
+        self.assertEquals(find_output_end('ls\r\nfile1\r\nhost# ', 0, prompt=prompt), 'ls\r\nfile1\r\nhost# ')
+
+    def test_prompt_after_echo(self):
+        """ Test initial prompt doesn't end output, prompt after echo of command does """
+        end = OutputEnd(re.compile(r'[$#] ?$'), echo=get_input_echo(['uptime\r']))
+        self.assertFalse(end.feed('host# '))
+        self.assertFalse(end.feed('upt'))
+        self.assertFalse(end.feed('ime\r\n up 5 days\r\n'))
+        self.assertTrue(end.feed('host# '))
+
+    def test_split_output(self):
+        """ Test output of pipelined commands is split by sentinels """
+        text = 'uptime\necho __s1__\nup 5 days\n__s1__\ndf\necho __s2__\n/dev/sda1 50%'
+        self.assertEquals(split_output(text, ['__s1__', '__s2__']), ['uptime\nup 5 days', 'df\n/dev/sda1 50%'])
+        self.assertEquals(split_output('file1', None), ['file1'])
+
+
+class OutputBufferTestCase(unittest.TestCase):
+
+    def test_limit(self):
+        """ Test output over limit is dropped and marked """
+        buffer = OutputBuffer(limit=10)
+        buffer.write(b'0123456')
+        buffer.write('789abc')
+        self.assertTrue(buffer.truncated)
+        self.assertTrue(buffer.getvalue().startswith('0123456789\n'))
+        self.assertIn('3 bytes', buffer.getvalue())
+        buffer.close()
+
+    def test_read_output(self):
+        """ Test read output is cut at sentinel """
+        buffer = OutputBuffer()
+        buffer.write('ls\r\necho __end__\r\nfile1\r\n__end__\r\n$ ')
+        self.assertEquals(get_read_output(buffer, '__end__'), 'ls\nfile1')
+        self.assertEquals(get_read_output(buffer), 'ls\necho __end__\nfile1\n__end__\n$ ')
+        buffer.close()
+
+    def test_join_outputs(self):
+        """ Test outputs of commands are joined line by line up to limit """
+        outputs = [(stdout, len(stdout.encode('utf-8'))) for stdout in ('abc', 'def\n', '', '0123456789')]
+        self.assertEquals(join_outputs(outputs[:3]), 'abc\ndef')
+        text = join_outputs(outputs, limit=10)
+        self.assertTrue(text.startswith('abc\ndef\n01\n'))
+        self.assertIn('9 bytes', text)
+
+
+class SessionPoolTestCase(AsyncTestCase):
+
+    def setUp(self):
+        super(SessionPoolTestCase, self).setUp()
+        self.pool = SessionPool(self.loop)
+        self.closed = []
+
+    def _opener(self, name):
+        @asyncio.coroutine
+        def opener():
+            return dict(stdout=name), lambda: self.closed.append(name), lambda ttl: True
+        return opener
+
+    @async
+    def test_reuse(self):
+        """ Test session is reused by next task """
+        connection = {'_id': 'C1', 'type': 'ssh', 'ip': '10.0.0.1', 'login': 'root'}
+        session = yield from self.pool.checkout(connection, self._opener('S1'), 30)
+        self.pool.checkin(session)
+        session2 = yield from self.pool.checkout(connection, self._opener('S2'), 30)
+        self.assertIs(session2, session)
+        self.assertEquals(self.pool.host_sessions['10.0.0.1'], 1)
+
+        # Changed connection config invalidates session
+        self.pool.checkin(session)
+        connection['login'] = 'admin'
+        session3 = yield from self.pool.checkout(connection, self._opener('S3'), 30)
+        self.assertEquals(session3.streams['stdout'], 'S3')
+        self.assertListEqual(self.closed, ['S1'])
+        self.assertEquals(self.pool.host_sessions['10.0.0.1'], 1)
+
+    @async
+    def test_telnet_opt_in(self):
+        """ Test telnet session is reused only if connection asks for it """
+        connection = {'_id': 'C2', 'type': 'telnet', 'ip': '10.0.0.2'}
+        session = yield from self.pool.checkout(connection, self._opener('S1'), 30)
+        self.assertFalse(session.reusable)
+        connection['pool'] = True
+        session = yield from self.pool.checkout(connection, self._opener('S2'), 30)
+        self.assertTrue(session.reusable)
+
+    @async
+    def test_host_limit(self):
+        """ Test task waits for session to full host until other task returns
+        one, and gives back its own session instead of waiting for itself """
+        held = {}
+        for i in range(SETTINGS.WORKER_SESSIONS_PER_HOST):
+            connection = {'_id': 'C{}'.format(i), 'type': 'ssh', 'ip': '10.0.0.3'}
+            held[connection['_id']] = yield from self.pool.checkout(connection, self._opener('S{}'.format(i)), 30)
+
+        connection = {'_id': 'CW', 'type': 'ssh', 'ip': '10.0.0.3'}
+        waiter = asyncio.Task(self.pool.checkout(connection, self._opener('SW'), 30))
+        yield from asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        self.pool.checkin(held.pop('C0'))
+        session = yield from asyncio.wait_for(waiter, 1)
+        self.assertEquals(session.streams['stdout'], 'SW')
+        self.assertListEqual(self.closed, ['S0'])
+
+        connection = {'_id': 'CN', 'type': 'ssh', 'ip': '10.0.0.3'}
+        session = yield from asyncio.wait_for(self.pool.checkout(connection, self._opener('SN'), 30, held), 1)
+        self.assertEquals(session.streams['stdout'], 'SN')
+        self.assertEquals(len(held), SETTINGS.WORKER_SESSIONS_PER_HOST - 2)
+        self.assertEquals(self.pool.host_sessions['10.0.0.3'], SETTINGS.WORKER_SESSIONS_PER_HOST)
+
+
+class FairSemaphoreTestCase(AsyncTestCase):
+
+    @async
+    def test_order(self):
+        """ Test waiters get free slot in order of arrival """
+        semaphore = FairSemaphore(1)
+        order = []
+
+        @asyncio.coroutine
+        def worker(name):
+            yield from semaphore.acquire()
+            order.append(name)
+            yield from asyncio.sleep(0.01)
+            semaphore.release()
+
+        yield from asyncio.gather(*[worker(name) for name in ('T1', 'T2', 'T3')])
+        self.assertListEqual(order, ['T1', 'T2', 'T3'])
+        self.assertEquals(semaphore.value, 1)
+
+
+class ConcurrencyLimitsTestCase(unittest.TestCase):
+
+    def test_local_limits(self):
+        """ Test local commands are limited by type only """
+        limits = ConcurrencyLimits()
+        self.assertListEqual([key for key, limit in limits.get_limits({'_id': 'L1', 'type': 'local'})], [('type', 'local')])
+        self.assertListEqual([key for key, limit in limits.get_limits({'_id': 'C1', 'type': 'ssh', 'ip': '10.0.0.1'})],
+                             [('host', '10.0.0.1'), ('connection', 'C1')])
+
+
+class ShutdownTestCase(AsyncTestCase):
+
+    @async
+    def test_wait_tasks(self):
+        """ Test worker stops event loop only when running task finishes """
+        worker = MultiActionRunnerWorker()
+        worker.current_loop = self.loop
+        task_future = asyncio.Task(asyncio.sleep(0.05))
+        worker.TASKS.append(task_future)
+        with mock.patch.object(self.loop, 'stop') as stop:
+            yield from worker._shutdown()
+        self.assertTrue(task_future.done())
+        stop.assert_called_once_with()
+
+
+class PlanCacheTestCase(unittest.TestCase):
+
+    def _command(self, _id, value):
+        return {'action': {'_id': _id, 'title': 'Выполнить команду', 'connection_id': 'C1', 'params': [{'value': value}]}}
+
+    def test_plan(self):
+        """ Test action tree is flattened in order and plan is cached """
+        worker = MultiActionRunnerWorker()
+        action = {'_id': 'A1', 'scenario': [self._command('A2', 'ls<ENTER>'),
+                                            {'action': {'_id': 'A3', 'scenario': [self._command('A4', '%robo(pause=5)%')]}},
+                                            self._command('A5', 'df')]}
+        plan = worker._get_plan(action)
+        self.assertListEqual([(command, return_queue, pause) for cur_action, command, return_queue, pause in plan],
+                             [('ls\r', ('A1', 'A2'), None), ('%robo(pause=5)%', ('A1', 'A3', 'A4'), 5), ('df', ('A1', 'A5'), None)])
+        self.assertIs(worker._get_plan(action), plan)
+
+        # Changed params give new plan
+        action['scenario'][2]['action']['params'][0]['value'] = 'df -h'
+        self.assertEquals(worker._get_plan(action)[2][1], 'df -h')
+
+    def test_plan_version(self):
+        """ Test plan of action with config version is keyed by version and bound params """
+        worker = MultiActionRunnerWorker()
+        action = {'_id': 'A1', 'config_version': '1', 'bound_params': {'dir': '/'}, 'scenario': [self._command('A2', 'ls /')]}
+        plan = worker._get_plan(action)
+        self.assertIs(worker._get_plan(dict(action, scenario=[self._command('A2', 'ls /')])), plan)
+        self.assertEquals(worker._get_plan(dict(action, bound_params={'dir': '/tmp'}, scenario=[self._command('A2', 'ls /tmp')]))[0][1], 'ls /tmp')
+        self.assertEquals(worker._get_plan(dict(action, config_version='2', scenario=[self._command('A2', 'df')]))[0][1], 'df')
@@ -14,7 +14,7 @@ from sensors.utils import now
 from sensors.settings import SETTINGS
 
 from storage.influx import LoggingStorage
-from storage.redis import ConfigStorage, TaskStorage
+from storage.redis import ConfigCache, TaskStorage
 from storage.models import Task
 
 logging.basicConfig()
@@ -30,7 +30,7 @@ class Trigger(object):
 
         self.run = True
 
-        self.config = ConfigStorage()
+        self.config = None
         self.db_log = LoggingStorage()
         self.tq_storage = None
 
@@ -43,6 +43,7 @@ class Trigger(object):
         log.info("Running trigger loop")
         self.connection = yield from asyncio_redis.Pool.create(host='localhost', port=6379, encoder=asyncio_redis.encoders.BytesEncoder(), poolsize=3)
         self.tq_storage = TaskStorage(self.current_loop, self.connection)
+        self.config = ConfigCache(self.connection)
 
         # Setup subscription to action results
         self.subscription = yield from self.connection.start_subscribe()
@@ -109,14 +110,14 @@ class Trigger(object):
         if time_now - self._reload_triggers_config_last_run < 1000:  # 1000 = 1sec
             return
         self._reload_triggers_config_last_run = time_now
-        config_version = self.config.get_config_version()
+        config_version = yield from self.config.get_config_version()
         if config_version != self.config_version:
             yield from self._reload_triggers()
             self.config_version = config_version
 
     @asyncio.coroutine
     def _reload_triggers(self):
-        new_triggers = self.config.list_triggers()
+        new_triggers = yield from self.config.list_triggers()
         self.triggers = new_triggers
         self.metrics_id_to_triggers = defaultdict(list)
         for trigger_id, trigger in new_triggers.items():
@@ -132,7 +133,7 @@ class Trigger(object):
             # Extract values from trigger into dict (param_name -> param_value)
             params_values = {param.get('param'): param.get('value') for param in action_obj['params']}
             # Get action with binded params
-            action = self.config.get_action(action_obj['action_id'],
+            action = yield from self.config.get_action(action_obj['action_id'],
                                             initial_param_values=params_values,
                                             connection_id=trigger.get('connection_id'))
 
@@ -143,7 +144,9 @@ class Trigger(object):
                                                           ttl=action.get('ttl') or SETTINGS.WORKER_TASK_TIMEOUT,
                                                           kwargs=action,
                                                           store_to=Task.STORE_TO_METRICS)
-            yield from self.tq_storage.schedule_task(task)
+            dispatched = yield from self.tq_storage.schedule_task(task)
+            if not dispatched:
+                yield from self.tq_storage.ping_dispatcher()
 
     """ TASKS """
 
@@ -1,10 +1,11 @@
 import datetime
 import time
+import zlib
 
 from threading import Lock
 
 
-__all__ = 'TasksList', 'datetime_to_timestamp', 'timestamp_to_datetime', 'now'
+__all__ = 'TasksList', 'datetime_to_timestamp', 'timestamp_to_datetime', 'now', 'get_shard'
 
 
 class TasksList(list):
@@ -38,6 +39,13 @@ def now():
     return bytes("{}".format(int(time.time() * 1000)), encoding='ascii')
 
 
+def get_shard(name, shards):
+    """ Stable (between processes) shard number for name, returns int"""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(name.encode('utf-8')) % shards
+
+
 def parse_timetable(value):
     if not isinstance(value, str):
         return None
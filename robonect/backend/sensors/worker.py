@@ -1,16 +1,23 @@
 import asyncio_redis
 import asyncio
 import asyncssh
+import codecs
 import datetime
+import hashlib
 import logging
+import os
 import pickle
 import re
 import signal
+import socket
+import tempfile
+import time
+import ujson
+import uuid
 
 from abc import ABCMeta, abstractmethod
 from asyncio import subprocess
-from copy import deepcopy
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from functools import partial
 
 from comport.state import ComPortState
@@ -19,7 +26,7 @@ from sensors.utils import TasksList, datetime_to_timestamp
 from sensors.settings import SETTINGS
 
 from storage.influx import LoggingStorage
-from storage.redis import ConfigStorage
+from storage.redis import ConfigCache, TaskStorage, StreamTaskQueue
 from storage.models import Task, SchedulerTaskHistory
 
 from roboutils import parse_host
@@ -36,6 +43,203 @@ PARSE_COMMAND_NEWLINE_RE = re.compile(r'\<ENTER\>')
 PARSE_COMMAND_WAIT_RE = re.compile(r'%robo\(pause=(\d+)\)%')
 
 
+def get_output_markers(connection, count=1):
+    """ Markers of command output end for connection: compiled prompt
+    regex (connection 'prompt'), unique sentinels to echo after each of
+    `count` commands (connection 'sentinel' or 'pipeline') and idle timeout
+    used as fallback """
+    prompt = re.compile(connection['prompt']) if connection.get('prompt') else None
+    sentinels = None
+    if connection.get('sentinel') or connection.get('pipeline'):
+        sentinels = [SETTINGS.WORKER_SENTINEL.format(uuid.uuid4().hex) for i in range(count)]
+    ttl = SETTINGS.WORKER_READ_TIMEOUT if prompt or sentinels else SETTINGS.WORKER_READ_IDLE_TTL
+    return prompt, sentinels, ttl
+
+
+def format_input(commands, sentinels=None):
+    """ Input for session: commands, each one is followed by echo of its
+    sentinel """
+    if not sentinels:
+        return ''.join('{}\r'.format(command) for command in commands)
+    return ''.join('{}\recho {}\r'.format(command, sentinel) for command, sentinel in zip(commands, sentinels))
+
+
+def split_output(text, sentinels=None):
+    """ Split output of pipelined commands by sentinels echoed after each
+    of them, reader has already cut output at the last sentinel
+
+    :returns: list of outputs of commands
+    """
+    if not sentinels:
+        return [text]
+    outputs = []
+    for sentinel in sentinels[:-1]:
+        match = get_sentinel_re(sentinel).search(text)
+        if match:
+            outputs.append(text[:match.start()])
+            text = text[match.end():]
+        else:
+            outputs.append(text)
+            text = ''
+    outputs.append(text)
+    # Drop terminal echo of sentinel commands
+    return ['\n'.join(line for line in output.split('\n') if not any(sentinel in line for sentinel in sentinels))
+            for output in outputs]
+
+
+def get_sentinel_re(sentinel):
+    """ Output of echo of sentinel is a line of its own, terminal echo of
+    command line contains sentinel too """
+    return re.compile(r'(?:^|\n){}\r?\n'.format(re.escape(sentinel)))
+
+
+def get_input_echo(commands, sentinels=None):
+    """ Tail of terminal echo of the last input line, prompt is accepted
+    only after it. Long lines are wrapped by terminal, so only short tail
+    is used
+
+    :returns: string or None if input has no printable line
+    """
+    if sentinels:
+        return sentinels[-1][-16:]
+    parts = [part.strip() for part in re.split(r'[\x00-\x1f]', commands[-1]) if part.strip()]
+    return parts[-1][-16:] if parts else None
+
+
+def find_output_end(text, start, prompt=None, sentinel=None, sentinel_re=None):
+    """ Check is command output finished, new data starts at `start`
+
+    :param sentinel_re: compiled get_sentinel_re(sentinel), to not compile
+                        it for each chunk
+    :returns: output without sentinel or None if output is not finished
+    """
+    if sentinel:
+        match = (sentinel_re or get_sentinel_re(sentinel)).search(text, max(start - len(sentinel) - 3, 0))
+        if match:
+            return '\n'.join(line for line in text[:match.start()].split('\n') if sentinel not in line)
+    if prompt and prompt.search(text[text.rfind('\n') + 1:]):
+        return text
+    return None
+
+
+def trim_output_window(text):
+    """ Tail of output enough to find prompt or sentinel in next chunks:
+    last line, but not more than WORKER_READ_CHUNK chars """
+    return text[max(text.rfind('\n'), len(text) - SETTINGS.WORKER_READ_CHUNK, 0):]
+
+
+class OutputEnd():
+    """ Detects end of command output in chunks read from session. Prompt
+    is accepted only on a line after terminal echo of input, so initial
+    prompt of session or prompt before the command doesn't end output """
+
+    def __init__(self, prompt=None, sentinel=None, echo=None):
+        self.prompt = prompt
+        self.sentinel = sentinel
+        self.sentinel_re = get_sentinel_re(sentinel) if sentinel else None
+        self.echo = echo if prompt else None
+        self.window = ''
+
+    def feed(self, chunk):
+        """ :returns: True if output is finished """
+        start = len(self.window)
+        self.window += chunk
+        if self.echo:
+            pos = self.window.find(self.echo)
+            newline = self.window.find('\n', pos + len(self.echo)) if pos >= 0 else -1
+            if newline >= 0:
+                self.echo = None
+                self.window = self.window[newline:]
+                start = 0
+        prompt = None if self.echo else self.prompt
+        if find_output_end(self.window, start, prompt, self.sentinel, self.sentinel_re) is not None:
+            return True
+        self.window = trim_output_window(self.window)
+        return False
+
+
+class OutputBuffer():
+    """ Bounded capture of command output: first `limit` bytes are kept,
+    the rest is only counted. Data over WORKER_OUTPUT_SPOOL_SIZE is spooled
+    to temporary file, so memory of worker doesn't depend on output size """
+
+    def __init__(self, limit=None):
+        self.limit = limit or SETTINGS.WORKER_OUTPUT_LIMIT
+        self.file = tempfile.SpooledTemporaryFile(max_size=SETTINGS.WORKER_OUTPUT_SPOOL_SIZE)
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        free = max(self.limit - self.size, 0)
+        if free:
+            self.file.write(data[:free])
+            self.size += min(len(data), free)
+        self.dropped += max(len(data) - free, 0)
+
+    @property
+    def truncated(self):
+        return self.dropped > 0
+
+    def getvalue(self):
+        """ Captured output with truncation marker """
+        self.file.seek(0)
+        text = self.file.read().decode('utf-8', 'ignore')
+        self.file.seek(0, os.SEEK_END)
+        if self.dropped:
+            text += SETTINGS.WORKER_OUTPUT_TRUNCATED.format(self.dropped)
+        return text
+
+    def close(self):
+        self.file.close()
+
+
+def join_outputs(outputs, limit=None):
+    """ Join outputs of commands line by line, first `limit` bytes are
+    kept like in OutputBuffer. Outputs are joined in memory once, without
+    spooling, only output on the limit is encoded
+
+    :param outputs: list of (stdout, size in bytes)
+    """
+    limit = limit or SETTINGS.WORKER_OUTPUT_LIMIT
+    parts = []
+    size = dropped = 0
+    for stdout, stdout_size in outputs:
+        if not stdout:
+            continue
+        pieces = [(stdout, stdout_size)]
+        if not stdout.endswith('\n'):
+            pieces.append(('\n', 1))
+        for data, data_size in pieces:
+            free = max(limit - size, 0)
+            if data_size > free:
+                if free:
+                    parts.append(data.encode('utf-8')[:free].decode('utf-8', 'ignore'))
+                    size += free
+                dropped += data_size - free
+                continue
+            parts.append(data)
+            size += data_size
+    text = ''.join(parts)
+    if dropped:
+        text += SETTINGS.WORKER_OUTPUT_TRUNCATED.format(dropped)
+    return text.strip()
+
+
+def get_read_output(buffer, sentinel=None):
+    """ Output of session read into buffer, cut at `sentinel` if it was
+    found. Sentinel of truncated output is past the limit, only terminal
+    echo of it is removed """
+    text = buffer.getvalue()
+    if sentinel:
+        output = find_output_end(text, 0, sentinel=sentinel)
+        if output is None:
+            output = '\n'.join(line for line in text.split('\n') if sentinel not in line)
+        text = output
+    return text.replace('\r', '')
+
+
 class BaseWorker(metaclass=ABCMeta):
 
     def __init__(self):
@@ -44,32 +248,74 @@ class BaseWorker(metaclass=ABCMeta):
         self.comport_state = None
         self.config = None
         self.db_log = None
+        self.tq_storage = None
+        self.sessions = None
+        self.limits = ConcurrencyLimits()
 
         self.run = True
 
+        # Stream transport: claimed but not started tasks, task_id -> (stream, entry_id, reclaimed)
+        self.stream_queue = None
+        self.stream_entries = {}
+
         # List of current worker tasks; we use it for tasks per worker limitation
         self.TASKS = TasksList()
 
         # List for temporary storage completed task for clenup
         self.COMPLETED_TASKS = TasksList()
 
+        self.loop_task = None
+
     @asyncio.coroutine
     def bootstrap(self):
         log.info("Running worker loop")
         self.connection = yield from asyncio_redis.Pool.create(host='localhost', port=6379, encoder=asyncio_redis.encoders.BytesEncoder(), poolsize=3)
-        self.config = ConfigStorage()
+        self.config = ConfigCache(self.connection)
         self.comport_state = ComPortState()
         self.db_log = LoggingStorage()
+        self.tq_storage = TaskStorage(self.current_loop, self.connection)
+        self.sessions = SessionPool(self.current_loop)
+        consumer = '{}:{}'.format(socket.gethostname(), os.getpid()).encode('utf-8')
+        if SETTINGS.TASK_TRANSPORT == 'stream':
+            self.stream_queue = StreamTaskQueue(self.current_loop, consumer)
+            yield from self.stream_queue.create_groups()
+        asyncio.Task(self._report_lag(consumer))
 
     def start(self, loop):
         self.current_loop = loop
         loop.add_signal_handler(signal.SIGINT, partial(self.stop, 'SIGINT'))
         loop.add_signal_handler(signal.SIGTERM, partial(self.stop, 'SIGTERM'))
-        asyncio.Task(self.loop())
+        self.loop_task = asyncio.Task(self.loop())
 
     def stop(self, sig):
+        if not self.run:
+            log.info("Got {} signal again, stop daemon now".format(sig))
+            self.current_loop.stop()
+            return
         log.info("Got {} signal, we should finish all tasks and stop daemon".format(sig))
         self.run = False
+        asyncio.Task(self._shutdown())
+
+    @asyncio.coroutine
+    def _shutdown(self):
+        """ Stop claiming tasks, wait for running tasks and their cleanup
+        up to WORKER_STOP_TIMEOUT, then stop event loop. Tasks which are
+        not finished in time are left for reaper of scheduler """
+        deadline = self.current_loop.time() + SETTINGS.WORKER_STOP_TIMEOUT
+        # Loop may be in the middle of claiming tasks, they are run too
+        for futures in ([self.loop_task] if self.loop_task else [], self.TASKS, self.COMPLETED_TASKS):
+            timeout = deadline - self.current_loop.time()
+            if futures and timeout > 0:
+                log.info("Wait for {} tasks to finish".format(len(futures)))
+                yield from asyncio.wait(list(futures), timeout=timeout)
+        if self.TASKS:
+            log.warning("Stop worker with {} unfinished tasks".format(len(self.TASKS)))
+        if self.sessions:
+            self.sessions.close_all()
+        if self.stream_queue:
+            self.stream_queue.close()
+        if self.connection:
+            self.connection.close()
         self.current_loop.stop()
 
     @asyncio.coroutine
@@ -91,55 +337,119 @@ class BaseWorker(metaclass=ABCMeta):
                 except GeneratorExit:
                     break
 
-            # Pop new task from dispatched queue
+            # Pop batch of new tasks from dispatched queue
             try:
-                raw_task = yield from self._pop_task()
+                raw_tasks = yield from self._pop_tasks()
             except GeneratorExit:
                 break
-            if not raw_task:
+            if not raw_tasks:
                 continue
 
             # Deserialize
-            task = yield from self._deserialize_task(raw_task)
-            if not task:
-                continue
+            tasks = []
+            for raw_task, task_obj in raw_tasks:
+                task = yield from self._deserialize_task(raw_task, task_obj)
+                if not task:
+                    if self.stream_queue:
+                        # Drop broken task from stream
+                        yield from self._ack_stream_task(raw_task.decode('utf-8'))
+                    continue
+                tasks.append(task)
 
             # Set new status
-            task = yield from self._move_to_inprogress(task)
+            tasks = yield from self._move_to_inprogress(tasks)
 
-            # Run task
-            try:
-                task_future = yield from self._run_task(task)
-            except Exception as ex:
-                log.error(ex, exc_info=True)
-                pass
-        # When finished, close the connection.
-        self.current_loop.stop()
-        self.connection.close()
+            # Run tasks
+            for task in tasks:
+                try:
+                    task_future = yield from self._run_task(task)
+                except Exception as ex:
+                    log.error(ex, exc_info=True)
+                    pass
+        # Event loop is stopped by _shutdown() when running tasks finish
         log.info('Bye-bye!')
 
     @asyncio.coroutine
-    def _pop_task(self):
-        # Blocking pop task from dispatched list (and atomic push to inprogress list)
+    def _report_lag(self, consumer):
+        """ Measure lag of event loop and report it to supervisor """
+        while self.run:
+            started = self.current_loop.time()
+            yield from asyncio.sleep(SETTINGS.WORKER_LAG_REPORT_PERIOD)
+            lag = self.current_loop.time() - started - SETTINGS.WORKER_LAG_REPORT_PERIOD
+            try:
+                yield from self.connection.hset(SETTINGS.WORKER_LAG_HASH, consumer, ujson.dumps([round(lag, 3), time.time()]).encode('utf-8'))
+            except Exception:
+                log.error('Cannot report loop lag', exc_info=True)
+
+    @asyncio.coroutine
+    def _pop_tasks(self):
+        """ Take batch of dispatched tasks
+
+        :returns: list of (task_id, body), body is None if it should be read
+                  from storage
+        """
+        if self.stream_queue:
+            return (yield from self._pop_stream_tasks())
         try:
-            raw_task = yield from self.connection.brpoplpush(SETTINGS.DISPATCHED_QUEUE, SETTINGS.INPROGRESS_QUEUE, SETTINGS.WORKER_BPOP_TIMEOUT)
-            log.debug("Got new tasks from queue {}".format(raw_task))
-            return raw_task
+            # Claim ready tasks, their bodies are read at once
+            count = max(1, min(SETTINGS.WORKER_CLAIM_BATCH, SETTINGS.WORKER_TASKS_LIMIT - len(self.TASKS)))
+            claimed = yield from self.tq_storage.claim_tasks(count)
+            if claimed:
+                log.debug("Claimed {} new tasks from queue".format(len(claimed)))
+                return claimed
+            # Queues are empty, wait for wakeup token of new task in blocking
+            # pop, then claim it, so task is never popped but not in progress
+            yield from self.connection.brpop([SETTINGS.DISPATCHED_WAKEUP_QUEUE], SETTINGS.WORKER_BPOP_TIMEOUT)
+            claimed = yield from self.tq_storage.claim_tasks(count)
+            if claimed:
+                log.debug("Claimed {} new tasks from queue after wakeup".format(len(claimed)))
+            return claimed
         except asyncio_redis.TimeoutError:
-            # No new tasks? Sleep for a while
-            yield from asyncio.sleep(SETTINGS.WORKER_PULL_SLEEP)
             return
         except Exception:
             log.error('Unexpected error', exc_info=True)
+            yield from asyncio.sleep(SETTINGS.WORKER_PULL_SLEEP)
 
     @asyncio.coroutine
-    def _deserialize_task(self, raw_task):
+    def _pop_stream_tasks(self):
+        # Read batch of tasks from dispatched streams with their bodies
         try:
-            task_obj = yield from self.connection.get(SETTINGS.TASK_STORAGE_KEY.format(raw_task.decode('utf-8')).encode('utf-8'))
+            count = max(1, min(SETTINGS.WORKER_STREAM_BATCH, SETTINGS.WORKER_TASKS_LIMIT - len(self.TASKS)))
+            entries = yield from self.stream_queue.claim(count)
+            if not entries:
+                return
+            keys = [SETTINGS.TASK_STORAGE_KEY.format(raw_task.decode('utf-8')).encode('utf-8') for stream, entry_id, raw_task, reclaimed in entries]
+            bodies = yield from self.connection.mget_aslist(keys)
+        except Exception:
+            log.error('Unexpected error', exc_info=True)
+            yield from asyncio.sleep(SETTINGS.WORKER_PULL_SLEEP)
+            return
+        for stream, entry_id, raw_task, reclaimed in entries:
+            self.stream_entries[raw_task.decode('utf-8')] = (stream, entry_id, reclaimed)
+        log.debug("Got {} new tasks from streams".format(len(entries)))
+        return [(raw_task, body) for (stream, entry_id, raw_task, reclaimed), body in zip(entries, bodies)]
+
+    @asyncio.coroutine
+    def _ack_stream_task(self, task_id):
+        entry = self.stream_entries.pop(task_id, None)
+        if entry:
+            stream, entry_id, reclaimed = entry
+            return (yield from self.tq_storage.ack_stream_task(stream, entry_id))
+
+    @asyncio.coroutine
+    def _deserialize_task(self, raw_task, task_obj=None):
+        try:
+            if task_obj is None:
+                task_obj = yield from self.connection.get(SETTINGS.TASK_STORAGE_KEY.format(raw_task.decode('utf-8')).encode('utf-8'))
             if not task_obj:
                 raise TypeError()
             task = Task.deserialize(task_obj)
             log.info("Got new task id={}, type={}, status={}".format(task.id, task.type, task.status))
+            reclaimed = self.stream_entries.get(task.id, (None, None, False))[2]
+            if reclaimed and task.status == Task.INPROGRESS:
+                # Worker died during task execution, run it again
+                log.info("Took over task id={} of dead worker".format(task.id))
+                return task
             if not task.status == Task.SCHEDULED:
                 log.error("Wrong status={} for task id={}, type={}; Should be SCHEDULED".format(task.status, task.id, task.type))
                 return
@@ -153,21 +463,22 @@ class BaseWorker(metaclass=ABCMeta):
             return
 
     @asyncio.coroutine
-    def _move_to_inprogress(self, task):
-        """ move_to_inprogress -- Change task status to 'in progress'
-        Store task in sorted set with TTL
+    def _move_to_inprogress(self, tasks):
+        """ move_to_inprogress -- Change status of tasks to 'in progress'
+        Store tasks in sorted set with TTL, in one round trip
 
-        :param task: `sensors.models.Task` instance
+        :param tasks: list of `sensors.models.Task` instances
         """
-        ttl = task.ttl or SETTINGS.WORKER_TASK_TIMEOUT
-        expires_at = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
-        new_task = task._replace(status=Task.INPROGRESS)
+        new_tasks = []
+        for task in tasks:
+            ttl = task.ttl or SETTINGS.WORKER_TASK_TIMEOUT
+            expires_at = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+            new_tasks.append((task._replace(status=Task.INPROGRESS), datetime_to_timestamp(expires_at)))
 
-        # XXX may be transaction here?
-        yield from self.connection.zadd(SETTINGS.INPROGRESS_TASKS_SET, {task.bid(): datetime_to_timestamp(expires_at)})
-        yield from self.connection.set(SETTINGS.TASK_STORAGE_KEY.format(new_task.id).encode('utf-8'), new_task.serialize(), expire=SETTINGS.TASK_STORAGE_EXPIRE)
+        # Stream transport keeps inprogress tasks in pending entries list of consumer group
+        yield from self.tq_storage.start_tasks(new_tasks, track=not self.stream_queue)
 
-        return new_task
+        return [task for task, expires_at in new_tasks]
 
     @asyncio.coroutine
     def _throttle(self, task):
@@ -253,49 +564,22 @@ class BaseWorker(metaclass=ABCMeta):
 
     @asyncio.coroutine
     def _cleanup_task(self, task):
-        """ clenaup_task -- Task for cleanup completed tasks from redis queue.
+        """ clenaup_task -- Store completed task, remove it from redis queue,
+        update scheduler information and publish message about finish in one
+        round trip.
 
         :param task: `sensors.models.Task` instance
         :return: None
         """
         log.debug("_cleanup_task task_id={}".format(task.id))
-        # Remove task from inprogress queue
-        # XXX may be transaction here?
-        cnt1 = yield from self.connection.lrem(SETTINGS.INPROGRESS_QUEUE, value=task.bid())
-        # Remove task from sorted set
-        cnt2 = yield from self.connection.zrem(SETTINGS.INPROGRESS_TASKS_SET, [task.bid()])
-        # Update scheduler information
-        # Store next_run in scheduled
-        task_scheduler_obj = yield from self.connection.hget(SETTINGS.SCHEDULER_HISTORY_HASH, task.name.encode('utf-8'))
-        try:
-            task_scheduler = SchedulerTaskHistory.deserialize(task_scheduler_obj)
-        except (pickle.UnpicklingError, EOFError, TypeError, ImportError):
-            task_scheduler = None
-        if task_scheduler and task_scheduler.scheduled_task_id == task.id:
-            #if task.status == Task.SUCCESSFUL:
-            #    # Update last_run only on success
-            #    last_run = datetime_to_timestamp(task.run_at)
-            #else:
-            #    # If task failed, do not update last_run (last_run is about SUCCESSFUL task exectuion)
-            #    last_run = task_scheduler.last_run
-            last_run = datetime_to_timestamp(task.run_at)
-            task_scheduler = task_scheduler._replace(last_run=last_run, next_run=0, scheduled_task_id=None)
-            yield from self.connection.hset(SETTINGS.SCHEDULER_HISTORY_HASH, task.name.encode('utf-8'), task_scheduler.serialize())
-
-        # Publish message about finish
-        yield from self.connection.publish(SETTINGS.TASK_CHANNEL.format(task.id).encode('utf-8'), task.status.encode('utf-8'))
-        log.debug('Publish message about task {} to {}'.format(task.id, SETTINGS.TASK_CHANNEL.format(task.id)))
-        log.debug("_cleanup_task lrem result {}".format(cnt1))
-        log.debug("_cleanup_task zrem result {}".format(cnt2))
-
-        # Ping scheduler
-        yield from self._ping_scheduler(task)
-
-    @asyncio.coroutine
-    def _ping_scheduler(self, task):
-        # Publish message about new finished task
+        history = None
         if task.type == Task.TYPE_REGULAR:
-            yield from self.connection.publish(SETTINGS.WORKER_TO_SCHEDULER_CHANNEL, b'')
+            # Stored only if task is still scheduled task of action
+            history = SchedulerTaskHistory(name=task.name, last_run=datetime_to_timestamp(task.run_at), next_run=0, scheduled_task_id=None)
+        entry = self.stream_entries.pop(task.id, None)
+        updated = yield from self.tq_storage.complete_task(task, history, entry[:2] if entry else None)
+        log.debug('Publish message about task {} to {}'.format(task.id, SETTINGS.TASK_CHANNEL.format(task.id)))
+        log.debug("_cleanup_task history updated {}".format(updated))
 
     @asyncio.coroutine
     def _expire_timer_task(self, task, task_future, _pid, stopper, timeout):
@@ -335,7 +619,7 @@ class BaseWorker(metaclass=ABCMeta):
         log.debug('Mark as completed callback is here!')
         try:
             if task_future.result() is not None:
-                asyncio.Task(self._store_results(task, task_future.result()))
+                self._track_completed(asyncio.Task(self._store_results(task, task_future.result())))
                 new_task = task._replace(status=Task.SUCCESSFUL)
             else:
                 new_task = task._replace(status=Task.FAILED)
@@ -346,12 +630,16 @@ class BaseWorker(metaclass=ABCMeta):
         log.info("Finish task id={}, status={}".format(new_task.id, new_task.status))
 
         log.debug("Update task status as COMPLETED <id={}> status={}".format(new_task.id, new_task.status))
-        asyncio.Task(self.connection.set(SETTINGS.TASK_STORAGE_KEY.format(new_task.id).encode('utf-8'), new_task.serialize(), expire=SETTINGS.TASK_STORAGE_EXPIRE))
-        asyncio.Task(self._cleanup_task(new_task))
+        self._track_completed(asyncio.Task(self._cleanup_task(new_task)))
 
         # Callback вызывается thread-safe — можно выпилить локи и юзать просто лист
         self.TASKS.remove(task_future)
 
+    def _track_completed(self, future):
+        # Worker waits for store and cleanup of finished tasks on stop
+        self.COMPLETED_TASKS.append(future)
+        future.add_done_callback(self.COMPLETED_TASKS.remove)
+
     def _remove_expire_timer_callback(self, task, expire_timer_future, task_future):
         # Remove exire time checker if task is successfully completed
         log.debug("Cancel expire timer Task for task {}".format(task.id))
@@ -375,106 +663,470 @@ class BaseWorker(metaclass=ABCMeta):
         return tmp
 
 
-class TelnetReader():
+class Session():
+    """ Opened connection to device (SSH, telnet or COM), it can be reused
+    by next tasks of worker """
+
+    def __init__(self, key, host, streams, closer, is_alive, reusable=True):
+        self.key = key
+        self.host = host
+        self.streams = streams
+        self.closer = closer
+        self.is_alive = is_alive
+        self.reusable = reusable
+        self.last_used = time.time()
+        self.closed = False
+        self.discarded = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.closer()
+        except ProcessLookupError:
+            pass
+        except:
+            log.error("Cannot close session", exc_info=True)
+
+
+class SessionPool():
+    """ Pool of opened sessions shared by tasks of worker. Session is keyed
+    by connection _id and hash of connection settings, so change of
+    connection config invalidates its sessions. """
+
+    def __init__(self, loop):
+        self.loop = loop
+        # Key -> idle sessions, last used at the end
+        self.idle = defaultdict(list)
+        # Connection _id -> actual key
+        self.keys = {}
+        # Host -> count of opened (idle and busy) sessions
+        self.host_sessions = defaultdict(int)
+        # Host -> events of tasks waiting for free session, in order of arrival
+        self.waiters = defaultdict(deque)
+        self.loop.call_later(SETTINGS.WORKER_SESSION_IDLE_TTL / 2, self.cleanup)
+
+    @staticmethod
+    def get_key(connection):
+        settings = {key: value for key, value in connection.items() if key != 'streams'}
+        return connection['_id'], hashlib.md5(ujson.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_host(connection):
+        return connection.get('ip') or connection.get('device') or connection['_id']
+
+    @asyncio.coroutine
+    def checkout(self, connection, opener, ttl, held=None):
+        """ checkout -- take idle session of connection or open new one
+
+        :param opener: coroutine function, returns (streams, closer, is_alive)
+                       or None if session can't be opened
+        :param ttl: (int) session should be alive during ttl seconds
+        :param held: dict connection _id -> Session, sessions held by task,
+                     task gives back its session to host instead of waiting
+                     for a slot it holds itself
+        :returns: Session or None
+        """
+        key = self.get_key(connection)
+        old_key = self.keys.get(connection['_id'])
+        if old_key != key:
+            if old_key:
+                log.info('Connection {} is changed, close its sessions'.format(connection['_id']))
+                self._close_idle(old_key)
+            self.keys[connection['_id']] = key
+
+        idle = self.idle[key]
+        while idle:
+            session = idle.pop()
+            if session.is_alive(ttl):
+                log.debug('Reuse {} session host={}'.format(connection['type'], session.host))
+                return session
+            self._discard(session)
+
+        # Limit sessions to host, close idle sessions of other connections
+        host = self.get_host(connection)
+        yield from self._reserve(host, held)
+        try:
+            result = yield from opener()
+        except BaseException:
+            self._release(host)
+            raise
+        if result is None:
+            self._release(host)
+            return None
+        streams, closer, is_alive = result
+        # Telnet and COM scenarios usually log in by their first commands,
+        # so their sessions are reused only if connection asks for it
+        reusable = connection.get('pool', connection['type'] in SETTINGS.WORKER_SESSION_POOL_TYPES)
+        return Session(key, host, streams, closer, is_alive, reusable)
+
+    def checkin(self, session):
+        """ checkin -- return session to pool after task, closed, outdated
+        or not reusable session is discarded """
+        if (session.closed or not session.reusable
+          or self.keys.get(session.key[0]) != session.key or not session.is_alive(0)):
+            self._discard(session)
+            return
+        session.last_used = time.time()
+        self.idle[session.key].append(session)
+        # Idle session can be evicted for waiter
+        self._wake(session.host)
+
+    def cleanup(self):
+        """ Close sessions idle for WORKER_SESSION_IDLE_TTL """
+        min_last_used = time.time() - SETTINGS.WORKER_SESSION_IDLE_TTL
+        for key, sessions in list(self.idle.items()):
+            for session in sessions[:]:
+                if session.last_used < min_last_used or not session.is_alive(0):
+                    sessions.remove(session)
+                    self._discard(session)
+            if not sessions:
+                del self.idle[key]
+        self.loop.call_later(SETTINGS.WORKER_SESSION_IDLE_TTL / 2, self.cleanup)
+
+    def close_all(self):
+        for key in list(self.idle.keys()):
+            self._close_idle(key)
+
+    def _close_idle(self, key):
+        for session in self.idle.pop(key, []):
+            self._discard(session)
+
+    def _evict(self, host):
+        """ Close least recently used idle session to host, returns False
+        if there is no idle sessions """
+        candidates = [session for sessions in self.idle.values() for session in sessions if session.host == host]
+        if not candidates:
+            return False
+        session = min(candidates, key=lambda session: session.last_used)
+        self.idle[session.key].remove(session)
+        self._discard(session)
+        return True
+
+    def _discard(self, session):
+        session.close()
+        if not session.discarded:
+            session.discarded = True
+            self._release(session.host)
 
     @asyncio.coroutine
-    def _read_stream_with_ttl(self, reader, ttl=1):
-        buf = []
-        while True and not reader.at_eof():
-            done, pending = yield from asyncio.wait([reader.readline()], timeout=ttl)
-            if done:
-                result = yield from done.pop()
-                buf.append(result.decode('utf-8', 'ignore'))
+    def _reserve(self, host, held):
+        """ Take slot of host, waiters get slots in order of arrival and
+        are woken when session is returned or closed """
+        waiters = self.waiters[host]
+        event = None
+        try:
+            while not ((not waiters or waiters[0] is event) and self._take_slot(host, held)):
+                if event is None:
+                    event = asyncio.Event()
+                    waiters.append(event)
+                yield from event.wait()
+                event.clear()
+        finally:
+            if event is not None:
+                waiters.remove(event)
+                if not waiters:
+                    del self.waiters[host]
+                # Next waiter checks slots itself (more may be free)
+                self._wake(host)
+
+    def _take_slot(self, host, held):
+        """ Count new session to host if there is room, evicts idle session
+        or gives back session held by task itself, returns False if task has
+        to wait for other tasks """
+        while self.host_sessions[host] >= SETTINGS.WORKER_SESSIONS_PER_HOST:
+            if self._evict(host):
+                continue
+            own = [_id for _id, session in (held or {}).items() if session.host == host]
+            if not own:
+                return False
+            # All slots are busy and task holds some of them, it would wait for itself
+            session = held.pop(own[0])
+            log.info('Give back session of connection {} to take new one to host={}'.format(own[0], host))
+            self.checkin(session)
+        self.host_sessions[host] += 1
+        return True
+
+    def _release(self, host):
+        self.host_sessions[host] -= 1
+        self._wake(host)
+
+    def _wake(self, host):
+        waiters = self.waiters.get(host)
+        if waiters:
+            waiters[0].set()
+
+
+class FairSemaphore():
+    """ Semaphore which hands free slot to waiters strictly in order of
+    arrival, so task can't be overtaken by newer tasks """
+
+    def __init__(self, value):
+        self.value = value
+        self.waiters = deque()
+
+    @asyncio.coroutine
+    def acquire(self):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        waiter = asyncio.Future()
+        self.waiters.append(waiter)
+        try:
+            yield from waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
             else:
-                reader._waiter = None
-                pending.pop().cancel()
-                break
-        return ''.join(buf).replace('\r', '')
+                # Slot was already handed to us, pass it to next waiter
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.value += 1
+
 
-    def _telnet_runner(self, connection, task, killers, command, streams):
-        if streams and streams['stdin']:
-            stdin, stdout, stderr, conn = streams['stdin'], streams['stdout'], streams['stderr'], streams['connection']
-            log.debug('Reuse telnet connection')
+class ConcurrencyLimits():
+    """ Limits of commands running at once by connection type, host and
+    connection (WORKER_TYPE_LIMITS, WORKER_HOST_LIMIT,
+    WORKER_CONNECTION_LIMIT, connection can set own limit with
+    'max_sessions'). Local commands are limited by type only, unless
+    connection sets 'max_sessions'. Semaphores are always taken in this
+    order, so tasks can't deadlock. """
+
+    def __init__(self):
+        # (scope, key) -> (limit, FairSemaphore)
+        self.semaphores = {}
+
+    def get_limits(self, connection):
+        limits = []
+        type_limit = SETTINGS.WORKER_TYPE_LIMITS.get(connection['type'])
+        if type_limit:
+            limits.append((('type', connection['type']), type_limit))
+        if connection['type'] == 'local':
+            # There is usually single local connection, host and connection
+            # limits would cap all local commands of worker
+            connection_limit = connection.get('max_sessions')
         else:
-            try:
-                ip, port = parse_host(connection['ip'], 23)
-                process = yield from asyncio.create_subprocess_exec('telnet', '-E', ip, str(port),
-                                                                    stdin=subprocess.PIPE,
-                                                                    stdout=subprocess.PIPE,
-                                                                    stderr=subprocess.STDOUT)
-                stdin, stdout, stderr = process.stdin, process.stdout, process.stderr
-            except Exception as ex:
-                log.error("Cannot open telnet session", exc_info=True)
-                self.db_log.error("Не удалось открыть telnet соединение", str(ex), 'connection', connection['_id'])
-                return -999, "", {}
+            if SETTINGS.WORKER_HOST_LIMIT:
+                limits.append((('host', SessionPool.get_host(connection)), SETTINGS.WORKER_HOST_LIMIT))
+            connection_limit = connection.get('max_sessions') or SETTINGS.WORKER_CONNECTION_LIMIT
+        if connection_limit:
+            limits.append((('connection', connection['_id']), connection_limit))
+        return limits
+
+    def get_semaphore(self, key, limit):
+        current = self.semaphores.get(key)
+        if current is None or current[0] != limit:
+            # New or changed limit, holders release old semaphore
+            current = self.semaphores[key] = (limit, FairSemaphore(limit))
+        return current[1]
+
+    @asyncio.coroutine
+    def acquire(self, connection):
+        """ acquire -- wait for free slot of connection
+
+        :returns: list of acquired semaphores, pass it to release()
+        """
+        acquired = []
+        try:
+            for key, limit in self.get_limits(connection):
+                semaphore = self.get_semaphore(key, limit)
+                yield from semaphore.acquire()
+                acquired.append(semaphore)
+        except BaseException:
+            self.release(acquired)
+            raise
+        return acquired
+
+    def release(self, acquired):
+        for semaphore in reversed(acquired):
+            semaphore.release()
 
-            streams = dict(stdin=stdin, stdout=stdout, stderr=stderr, connection=process)
-            log.debug('Open new telnet connection host={}'.format(connection.get('ip')))
-            killers.append(process.terminate)
 
+class TelnetReader():
+
+    @asyncio.coroutine
+    def _read_stream_with_ttl(self, reader, ttl=1, prompt=None, sentinel=None, limit=None, deadline=None, echo=None):
+        """ Read command output until prompt or sentinel, ttl is idle
+        timeout, it is used if there is no markers or they are not found.
+        Output over `limit` bytes is dropped, reading stops at `deadline`
+        (timestamp) anyway. Prompt is accepted after `echo` of input only """
+        decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+        buffer = OutputBuffer(limit)
+        end = OutputEnd(prompt, sentinel, echo)
+        finished = False
+        try:
+            while not reader.at_eof():
+                timeout = ttl if deadline is None else min(ttl, deadline - time.time())
+                if timeout <= 0:
+                    break
+                done, pending = yield from asyncio.wait([reader.read(SETTINGS.WORKER_READ_CHUNK)], timeout=timeout)
+                if done:
+                    result = yield from done.pop()
+                    chunk = decoder.decode(result)
+                    buffer.write(chunk)
+                    if end.feed(chunk):
+                        finished = True
+                        break
+                else:
+                    reader._waiter = None
+                    pending.pop().cancel()
+                    break
+            return get_read_output(buffer, sentinel if finished else None)
+        finally:
+            buffer.close()
+
+    @asyncio.coroutine
+    def _open_telnet_session(self, connection):
+        try:
+            ip, port = parse_host(connection['ip'], 23)
+            process = yield from asyncio.create_subprocess_exec('telnet', '-E', ip, str(port),
+                                                                stdin=subprocess.PIPE,
+                                                                stdout=subprocess.PIPE,
+                                                                stderr=subprocess.STDOUT)
+        except Exception as ex:
+            log.error("Cannot open telnet session", exc_info=True)
+            self.db_log.error("Не удалось открыть telnet соединение", str(ex), 'connection', connection['_id'])
+            return None
+
+        if connection.get('prompt'):
+            # Login banner and initial prompt aren't output of command
+            try:
+                yield from self._read_stream_with_ttl(process.stdout, ttl=SETTINGS.WORKER_READ_IDLE_TTL,
+                                                      prompt=re.compile(connection['prompt']))
+            except Exception:
+                log.error("Cannot read banner of telnet session", exc_info=True)
+                process.terminate()
+                return None
+            except BaseException:
+                process.terminate()
+                raise
+
+        streams = dict(stdin=process.stdin, stdout=process.stdout, stderr=process.stderr, connection=process)
+        log.debug('Open new telnet connection host={}'.format(connection.get('ip')))
+        is_alive = lambda ttl: process.returncode is None and not process.stdout.at_eof()
+        return streams, process.terminate, is_alive
+
+    def _telnet_runner(self, connection, task, killers, commands, session, limit=None):
+        if session is None:
+            session = yield from self.sessions.checkout(connection, partial(self._open_telnet_session, connection),
+                                                        task.ttl or SETTINGS.WORKER_TASK_TIMEOUT)
+            if session is None:
+                return -999, [], None
+            killers.append(session.close)
+
+        prompt, sentinels, ttl = get_output_markers(connection, len(commands))
         try:
-            stdin.write("{}\r".format(command).encode('utf-8'))
-            results = yield from self._read_stream_with_ttl(stdout)
+            session.streams['stdin'].write(format_input(commands, sentinels).encode('utf-8'))
+            results = yield from self._read_stream_with_ttl(session.streams['stdout'], ttl=ttl, prompt=prompt,
+                                                       sentinel=sentinels[-1] if sentinels else None, limit=limit,
+                                                       echo=get_input_echo(commands, sentinels))
         except:
             log.error("Cannot communicate with TELNET-session", exc_info=True)
-            return -999, "", {}
+            session.close()
+            return -999, [], session
 
-        log.debug('Run telnet command "{}", output:\n--\n{}--'.format(command, results))
+        log.debug('Run telnet commands "{}", output:\n--\n{}--'.format(commands, results))
 
-        return 0, results, streams
+        return 0, split_output(results, sentinels), session
 
 class SSHReader():
 
     @asyncio.coroutine
-    def _read_ssh_with_ttl(self, reader, ttl=1):
-        buf = []
-        while True and not reader.at_eof():
-            done, pending = yield from asyncio.wait([reader.readline()], timeout=ttl)
-            if done:
-                result = yield from done.pop()
-                buf.append(result)
-            else:
-                reader._session._unblock_read(reader._datatype)
-                pending.pop().cancel()
-                break
-        return ''.join(buf).replace('\r', '')
-
-    def _ssh_runner(self, connection, task, killers, command, streams):
-        if streams and streams['stdin'].channel._session:
-            stdin, stdout, stderr, conn = streams['stdin'], streams['stdout'], streams['stderr'], streams['connection']
-            log.debug('Reuse ssh connection')
-        else:
-            try:
-                ip, port = parse_host(connection['ip'], 22)
-                conn, client = yield from asyncssh.create_connection(None, host=ip,
-                                                                     port=port,
-                                                                     username=connection.get('login'),
-                                                                     password=connection.get('password'),
-                                                                     server_host_keys=None)
-                stdin, stdout, stderr = yield from conn.open_session(term_type='xterm-color', term_size=(80, 24))
-            except asyncio.CancelledError:
-                log.error("Cannot open SSH-session", exc_info=False)
-                self.db_log.error("Не удалось открыть ssh соединение", str(ex), 'connection', connection['_id'])
-                return -999, "", {}
-            except Exception as ex:
-                log.error("Cannot open SSH-session", exc_info=True)
-                self.db_log.error("Не удалось открыть ssh соединение", str(ex), 'connection', connection['_id'])
-                return -999, "", {}
+    def _read_ssh_with_ttl(self, reader, ttl=1, prompt=None, sentinel=None, limit=None, deadline=None, echo=None):
+        """ Read command output until prompt or sentinel, ttl is idle
+        timeout, it is used if there is no markers or they are not found.
+        Output over `limit` bytes is dropped, reading stops at `deadline`
+        (timestamp) anyway. Prompt is accepted after `echo` of input only """
+        buffer = OutputBuffer(limit)
+        end = OutputEnd(prompt, sentinel, echo)
+        finished = False
+        try:
+            while not reader.at_eof():
+                timeout = ttl if deadline is None else min(ttl, deadline - time.time())
+                if timeout <= 0:
+                    break
+                done, pending = yield from asyncio.wait([reader.read(SETTINGS.WORKER_READ_CHUNK)], timeout=timeout)
+                if done:
+                    result = yield from done.pop()
+                    buffer.write(result)
+                    if end.feed(result):
+                        finished = True
+                        break
+                else:
+                    reader._session._unblock_read(reader._datatype)
+                    pending.pop().cancel()
+                    break
+            return get_read_output(buffer, sentinel if finished else None)
+        finally:
+            buffer.close()
 
-            streams = dict(stdin=stdin, stdout=stdout, stderr=stderr, connection=conn)
-            log.debug('Open new ssh connectionm host={}'.format(connection.get('ip')))
-            killers.append(conn.close)
+    @asyncio.coroutine
+    def _open_ssh_session(self, connection):
+        try:
+            ip, port = parse_host(connection['ip'], 22)
+            conn, client = yield from asyncssh.create_connection(None, host=ip,
+                                                                 port=port,
+                                                                 username=connection.get('login'),
+                                                                 password=connection.get('password'),
+                                                                 server_host_keys=None)
+            stdin, stdout, stderr = yield from conn.open_session(term_type='xterm-color', term_size=(80, 24))
+        except asyncio.CancelledError:
+            log.error("Cannot open SSH-session", exc_info=False)
+            return None
+        except Exception as ex:
+            log.error("Cannot open SSH-session", exc_info=True)
+            self.db_log.error("Не удалось открыть ssh соединение", str(ex), 'connection', connection['_id'])
+            return None
 
+        if connection.get('prompt'):
+            # Login banner and initial prompt aren't output of command
+            try:
+                yield from self._read_ssh_with_ttl(stdout, ttl=SETTINGS.WORKER_READ_IDLE_TTL,
+                                                   prompt=re.compile(connection['prompt']))
+            except Exception:
+                log.error("Cannot read banner of SSH session", exc_info=True)
+                conn.close()
+                return None
+            except BaseException:
+                conn.close()
+                raise
+
+        streams = dict(stdin=stdin, stdout=stdout, stderr=stderr, connection=conn)
+        log.debug('Open new ssh connectionm host={}'.format(connection.get('ip')))
+        is_alive = lambda ttl: stdin.channel._session is not None and not stdout.at_eof()
+        return streams, conn.close, is_alive
+
+    def _ssh_runner(self, connection, task, killers, commands, session, limit=None):
+        if session is None:
+            session = yield from self.sessions.checkout(connection, partial(self._open_ssh_session, connection),
+                                                        task.ttl or SETTINGS.WORKER_TASK_TIMEOUT)
+            if session is None:
+                return -999, [], None
+            killers.append(session.close)
+
+        prompt, sentinels, ttl = get_output_markers(connection, len(commands))
         try:
-            stdin.write("{}\r".format(command))
-            results = yield from self._read_ssh_with_ttl(stdout)
+            session.streams['stdin'].write(format_input(commands, sentinels))
+            results = yield from self._read_ssh_with_ttl(session.streams['stdout'], ttl=ttl, prompt=prompt,
+                                                       sentinel=sentinels[-1] if sentinels else None, limit=limit,
+                                                       echo=get_input_echo(commands, sentinels))
         except:
             log.error("Cannot communicate with SSH-session", exc_info=True)
-            return -999, "", {}
+            session.close()
+            return -999, [], session
 
-        log.debug('Run ssh command "{}", output:\n--\n{}--'.format(command, results))
+        log.debug('Run ssh commands "{}", output:\n--\n{}--'.format(commands, results))
 
-        return 0, results, streams
+        return 0, split_output(results, sentinels), session
 
 
 class COMPortConnection():
@@ -485,6 +1137,7 @@ class COMPortConnection():
         self.comport_state = comport_state
         self.settings = settings
         self.lock = None
+        self.locked_at = None
         self.writer = None
         self.device = None
 
@@ -507,6 +1160,7 @@ class COMPortConnection():
         if not self.run:
             log.error("COM-Port is locked, device={}".format(device))
             return None, None
+        self.locked_at = time.time()
 
         # Connect to socket
         stdout, stdin = yield from asyncio.open_unix_connection(path=self.socket)
@@ -515,6 +1169,12 @@ class COMPortConnection():
         self.writer = stdin
         return stdout, stdin
 
+    def is_alive(self, ttl):
+        """ Socket is open and our lock of COM-port doesn't expire during
+        next ttl seconds """
+        return (self.run and self.writer is not None and not self.writer.transport.is_closing()
+                and time.time() + ttl < self.locked_at + self.ttl)
+
     def close(self):
         self.run = False
         if self.writer:
@@ -525,174 +1185,166 @@ class COMPortConnection():
 
 class COMPortReader():
 
-    def _comport_runner(self, connection, task, killers, command, streams):
-        if streams and streams['stdin']:
-            stdin, stdout = streams['stdin'], streams['stdout']
-            log.debug('Reuse com-port connection')
-        else:
-            try:
-                conn = COMPortConnection(self.comport_state, connection, ttl=task.ttl or SETTINGS.WORKER_TASK_TIMEOUT)
-                killers.append(conn.close)
-                stdout, stdin = yield from conn.open()
-                if not all([stdout, stdin]):
-                    return -999, "", {}
-            except Exception as ex:
-                log.error("Cannot start COM session with socket={}".format(conn.socket))
-                self.db_log.error("Не удалось установить соединение с COM-портом", str(ex), 'connection', connection['_id'])
-                return -999, "", {}
-
-            streams = dict(stdin=stdin, stdout=stdout, connection=conn)
-            log.debug('Open new COM session with socket={}'.format(conn.socket))
-
+    @asyncio.coroutine
+    def _open_comport_session(self, connection, ttl):
+        # Session may stay in pool after task, keep lock for idle time too
+        conn = COMPortConnection(self.comport_state, connection, ttl=ttl + SETTINGS.WORKER_SESSION_IDLE_TTL)
         try:
-            stdin.write("{}\r".format(command).encode('utf-8'))
-            results = yield from self._read_stream_with_ttl(stdout)
+            stdout, stdin = yield from conn.open()
+            if not all([stdout, stdin]):
+                conn.close()
+                return None
+            if connection.get('prompt'):
+                # Initial prompt isn't output of command
+                yield from self._read_stream_with_ttl(stdout, ttl=SETTINGS.WORKER_READ_IDLE_TTL,
+                                                      prompt=re.compile(connection['prompt']))
+        except Exception as ex:
+            log.error("Cannot start COM session with socket={}".format(conn.socket))
+            self.db_log.error("Не удалось установить соединение с COM-портом", str(ex), 'connection', connection['_id'])
+            conn.close()
+            return None
+        except BaseException:
+            # Task is cancelled, don't leave COM-port locked
+            conn.close()
+            raise
+
+        streams = dict(stdin=stdin, stdout=stdout, connection=conn)
+        log.debug('Open new COM session with socket={}'.format(conn.socket))
+        return streams, conn.close, conn.is_alive
+
+    def _comport_runner(self, connection, task, killers, commands, session, limit=None):
+        if session is None:
+            ttl = task.ttl or SETTINGS.WORKER_TASK_TIMEOUT
+            session = yield from self.sessions.checkout(connection, partial(self._open_comport_session, connection, ttl), ttl)
+            if session is None:
+                return -999, [], None
+            killers.append(session.close)
+
+        prompt, sentinels, ttl = get_output_markers(connection, len(commands))
+        try:
+            session.streams['stdin'].write(format_input(commands, sentinels).encode('utf-8'))
+            results = yield from self._read_stream_with_ttl(session.streams['stdout'], ttl=ttl, prompt=prompt,
+                                                       sentinel=sentinels[-1] if sentinels else None, limit=limit,
+                                                       echo=get_input_echo(commands, sentinels))
         except:
             log.error("Cannot communicate with COM-session", exc_info=True)
-            return -999, "", streams
+            session.close()
+            return -999, [], session
 
-        log.debug('Run COM command "{}", output:\n--\n{}--'.format(command, results))
+        log.debug('Run COM commands "{}", output:\n--\n{}--'.format(commands, results))
 
-        return 0, results, streams
+        return 0, split_output(results, sentinels), session
 
 
 class MultiActionRunnerWorker(BaseWorker, TelnetReader, SSHReader, COMPortReader):
 
+    def __init__(self):
+        super(MultiActionRunnerWorker, self).__init__()
+        # Compiled command plans of actions, LRU
+        self.plans = OrderedDict()
+
     @asyncio.coroutine
     def runner(self, task, _pid, stopper, ttl, kwargs):
         start_time = datetime.datetime.now()
         action_to_run = kwargs
         log.debug('Start action processing for task {}, action {}'.format(task.id, action_to_run.get('_id')))
-        commands = []
         killers = []
         _pid.set_result(killers)
+        # Sessions from pool used by task, connection _id -> Session
+        sessions = {}
 
         try:
             # Prepare command_objs:
-            stack = [(action_to_run, [])]
-            while stack:
-                cur_action, return_queue = stack.pop(0)
-                return_queue = deepcopy(return_queue)
-                return_queue.append(cur_action.get('_id'))
-                if cur_action.get('title') == 'Выполнить команду':
-                    if not cur_action.get('connection_id'):
-                        self.db_log.error("У действия не определено соединение", cur_action.get('title'), 'action', action_to_run.get('_id'))
-                        raise Exception('action {} has no resolved connection!'.format(cur_action['_id']))
-
-                    commands.append((cur_action, self._parse_command(cur_action['params'][0]['value']), return_queue))
-                    continue
-                for in_action in cur_action.get('scenario', [])[::-1]:
-                    if 'action' in in_action:
-                        stack.insert(0, (in_action.get('action'), return_queue) )
+            commands = self._get_plan(action_to_run)
+            # Cap of output of each command and of joined output of action
+            limit = action_to_run.get('output_limit') or SETTINGS.WORKER_OUTPUT_LIMIT
 
-            # Store results here
+            # Output of each command is stored once as (exit_code, stdout,
+            # size), action and its ancestors get indexes of outputs
+            outputs = []
             results = defaultdict(list)
 
             # For non-local actions
-            # Pool of opened connections
-            connections_pool = set()
             # stdout readers from connections, we should drain it at the end
             drain_readers = []
-            connections = self.config.list_connections()
+            connections = yield from self.config.list_connections()
 
-            for cur_action, command, return_queue in commands:
-                if stopper.done():
-                    raise asyncio.CancelledError()
-                # run command step-by-step
+            # Consecutive commands to connection with 'pipeline' are sent at once
+            batches = []
+            for step in commands:
+                cur_action, command, return_queue, pause = step
                 connection = connections.get(cur_action['connection_id'])
-                if not connection:
-                    self.db_log.error("Указанное у действия соединение не существует",
-                                      "Action_id: {}\nConnection_id: {}".format(cur_action.get('_id'), cur_action.get('connection_id')),
-                                      'action',
-                                      action_to_run.get('_id'))
-                    raise Exception('Wrong connection_id {}'.format(cur_action['connection_id']))
-
-                pause = PARSE_COMMAND_WAIT_RE.findall(command)
-                if pause:
-                    try:
-                        yield from asyncio.sleep(int(pause[0]))
-                        continue
-                    except:
-                        # XXX Raise, please
-                        pass
-
-                if connection['type'] == 'local':
-                    exit_code, stdout = yield from self._local_process_runner(task, killers, command)
-                elif connection['type'] in ('ssh', 'com', 'telnet'):
-                    if connection['type'] == 'ssh':
-                        runner = self._ssh_runner
-                    elif connection['type'] == 'com':
-                        runner = self._comport_runner
-                    elif connection['type'] == 'telnet':
-                        runner = self._telnet_runner
-                    # Это SSH/COM
-                    # Набор stdin/stdout'ов от соединения
-                    streams = None
-                    new_connection = True
-                    if connection['_id'] in connections_pool:
-                        # Соединение уже открыто
-                        streams = connection.get('streams')
-                        new_connection = False
-                    connections_pool.add(connection['_id'])
-
-                    exit_code, stdout, streams = yield from runner(connection, task, killers, command, streams)
-                    if exit_code == -999:
-                        continue
-
-                    connection['streams'] = streams
-                    if new_connection:
-                        drain_readers.append( (return_queue, streams['stdout']) )
+                if (batches and connection and connection.get('pipeline') and connection['type'] != 'local'
+                  and batches[-1][-1][0]['connection_id'] == cur_action['connection_id']
+                  and pause is None and batches[-1][-1][3] is None):
+                    batches[-1].append(step)
+                else:
+                    batches.append([step])
+
+            if action_to_run.get('parallel', SETTINGS.WORKER_PARALLEL_CONNECTIONS):
+                # Commands to different connections don't depend on each
+                # other, run group of each connection concurrently
+                groups = OrderedDict()
+                for index, batch in enumerate(batches):
+                    groups.setdefault(batch[0][0]['connection_id'], []).append((index, batch))
+                jobs = [asyncio.Task(self._run_batches(task, killers, stopper, action_to_run, connections, group, sessions, drain_readers))
+                        for group in groups.values()]
+                try:
+                    done = yield from asyncio.gather(*jobs)
+                except BaseException:
+                    # Stop other groups before sessions are released
+                    for job in jobs:
+                        job.cancel()
+                    yield from asyncio.wait(jobs)
+                    raise
+            else:
+                done = [(yield from self._run_batches(task, killers, stopper, action_to_run, connections, list(enumerate(batches)), sessions, drain_readers))]
 
-                if exit_code == -999:
-                    # return None
-                    continue
-                for _id in return_queue:
-                    results[_id].append(dict(exit_code=exit_code, stdout=stdout))
-            drain_time = 0
+            # Results are stored in original order of commands
+            for index, batch, exit_code, batch_outputs in sorted((x for group in done for x in group), key=lambda x: x[0]):
+                for (cur_action, command, return_queue, pause), stdout in zip(batch, batch_outputs):
+                    stdout = stdout or ''
+                    outputs.append((exit_code, stdout, len(stdout.encode('utf-8'))))
+                    for _id in return_queue:
+                        results[_id].append(len(outputs) - 1)
             if drain_readers:
-                drain_time = ((ttl - (datetime.datetime.now() - start_time).total_seconds()) / len(drain_readers)) * 0.5
+                # All readers are drained at once, tail of task takes one
+                # drain window whatever number of connections
+                drain_time = (ttl - (datetime.datetime.now() - start_time).total_seconds()) * 0.5
                 drain_time = min(drain_time, SETTINGS.WORKER_TASK_TIMEOUT*1.0/3, 1.5)
-            for return_queue, reader in drain_readers:
-                stdout = yield from self._drain_reader(reader, drain_time)
+                drained = yield from self._drain_readers(drain_readers, drain_time, limit)
+            else:
+                drained = []
+            for return_queue, stdout in drained:
                 if stdout is not None:
+                    outputs.append((0, stdout, len(stdout.encode('utf-8'))))
                     for _id in return_queue:
-                        results[_id].append(dict(exit_code=0, stdout=stdout))
-            for connection_id in connections_pool:
-                connection = connections.get(connection_id)
-                # Close SSH connections, unlock COM-ports
-                if 'streams' in connection:
-                    if 'connection' in connection['streams']:
-                        if hasattr(connection['streams']['connection'], 'terminate'):
-                            try:
-                                connection['streams']['connection'].terminate()
-                            except:
-                                pass
-                        elif hasattr(connection['streams']['connection'], 'close'):
-                            connection['streams']['connection'].close()
-
-            log.debug('Task output Results: {}'.format(results))
+                        results[_id].append(len(outputs) - 1)
+            # Return sessions to pool for next tasks
+            self._release_sessions(sessions)
+
+            log.debug('Task {} outputs: {}'.format(task.id, len(outputs)))
         except asyncio.CancelledError as ex:
             log.error('Task {} for action {} was stopped by expire timer!'.format(task.id, action_to_run.get('_id')))
+            self._release_sessions(sessions, broken=True)
             return None
         except Exception as ex:
             log.error(ex, exc_info=True)
+            self._release_sessions(sessions, broken=True)
             return None
         log.debug('Finish action processing for task {}, action {}'.format(task.id, action_to_run.get('_id')))
 
         try:
             results2 = {}
-            for key, values in results.items():
-                stdout = []
-                for x in values:
-                    s = x.get('stdout', '')
-                    if len(s) and not s.endswith('\n'):
-                        stdout.extend([s, '\n'])
-                    else:
-                        stdout.extend([s])
-                # stdout = ('\n'.join(x.get('stdout', '') for x in values)).strip()
-                res = {'exit_codes': [x.get('exit_code') for x in values],
-                    'stdout': ''.join(stdout).strip()}
-                results2[key] = res
+            # Actions with the same commands (nested single actions) share
+            # one joined value, it is pickled once too
+            joined = {}
+            for key, indexes in results.items():
+                indexes = tuple(indexes)
+                if indexes not in joined:
+                    joined[indexes] = join_outputs([outputs[i][1:] for i in indexes], limit)
+                results2[key] = {'exit_codes': [outputs[i][0] for i in indexes],
+                                 'stdout': joined[indexes]}
         except:
             log.error("Internal error", exc_info=True)
             results2 = {}
@@ -704,8 +1356,148 @@ class MultiActionRunnerWorker(BaseWorker, TelnetReader, SSHReader, COMPortReader
             log.error('Handle error', exc_info=True)
         return results2
 
+    def _get_plan(self, action_to_run):
+        """ Flattened commands of action tree, cached by action _id, config
+        version, connection and bound params the tree is built with (see
+        ConfigCache.get_action), so plan is built only once per config
+        change. Tree without config version is keyed by hash of its content.
+
+        :returns: list of (action, command, return_queue, pause), command is
+                  parsed, pause (sec) is None for regular command
+        """
+        if action_to_run.get('config_version'):
+            key = (action_to_run.get('_id'), action_to_run['config_version'], action_to_run.get('connection_id'),
+                   ujson.dumps(action_to_run.get('bound_params') or {}, sort_keys=True))
+        else:
+            key = (action_to_run.get('_id'), hashlib.md5(ujson.dumps(action_to_run, sort_keys=True).encode('utf-8')).hexdigest())
+        plan = self.plans.get(key)
+        if plan is not None:
+            self.plans.move_to_end(key)
+            return plan
+
+        plan = []
+        stack = [(action_to_run, ())]
+        while stack:
+            cur_action, return_queue = stack.pop()
+            return_queue = return_queue + (cur_action.get('_id'),)
+            if cur_action.get('title') == 'Выполнить команду':
+                if not cur_action.get('connection_id'):
+                    self.db_log.error("У действия не определено соединение", cur_action.get('title'), 'action', action_to_run.get('_id'))
+                    raise Exception('action {} has no resolved connection!'.format(cur_action['_id']))
+
+                command = self._parse_command(cur_action['params'][0]['value'])
+                pause = PARSE_COMMAND_WAIT_RE.findall(command)
+                plan.append((cur_action, command, return_queue, int(pause[0]) if pause else None))
+                continue
+            for in_action in cur_action.get('scenario', [])[::-1]:
+                if 'action' in in_action:
+                    stack.append((in_action.get('action'), return_queue))
+
+        self.plans[key] = plan
+        if len(self.plans) > SETTINGS.WORKER_PLAN_CACHE_SIZE:
+            self.plans.popitem(last=False)
+        return plan
+
+    @asyncio.coroutine
+    def _run_batches(self, task, killers, stopper, action_to_run, connections, batches, sessions, drain_readers):
+        """ Run batches of commands one by one
+
+        :param batches: list of (index, batch)
+        :returns: list of (index, batch, exit_code, outputs) of finished batches
+        """
+        done = []
+        limit = action_to_run.get('output_limit') or SETTINGS.WORKER_OUTPUT_LIMIT
+        for index, batch in batches:
+            if stopper.done():
+                raise asyncio.CancelledError()
+            # run command step-by-step
+            cur_action, command, return_queue, pause = batch[0]
+            connection = connections.get(cur_action['connection_id'])
+            if not connection:
+                self.db_log.error("Указанное у действия соединение не существует",
+                                  "Action_id: {}\nConnection_id: {}".format(cur_action.get('_id'), cur_action.get('connection_id')),
+                                  'action',
+                                  action_to_run.get('_id'))
+                raise Exception('Wrong connection_id {}'.format(cur_action['connection_id']))
+
+            if pause is not None:
+                yield from asyncio.sleep(pause)
+                continue
+
+            if connection['type'] == 'local':
+                acquired = yield from self.limits.acquire(connection)
+                try:
+                    exit_code, stdout = yield from self._local_process_runner(task, killers, command, limit)
+                finally:
+                    self.limits.release(acquired)
+                outputs = [stdout]
+            elif connection['type'] in ('ssh', 'com', 'telnet'):
+                if connection['type'] == 'ssh':
+                    runner = self._ssh_runner
+                elif connection['type'] == 'com':
+                    runner = self._comport_runner
+                elif connection['type'] == 'telnet':
+                    runner = self._telnet_runner
+                # Это SSH/COM
+                # Сессия из пула, открытая этим или предыдущими тасками
+                session = sessions.get(connection['_id'])
+                new_connection = session is None
+                if new_connection:
+                    # Session is taken before command slots, so holder of
+                    # slot never waits for session of another task
+                    session = yield from self._checkout_session(connection, task, killers, sessions)
+                    if session is None:
+                        continue
+                    sessions[connection['_id']] = session
+
+                acquired = yield from self.limits.acquire(connection)
+                try:
+                    exit_code, outputs, session = yield from runner(connection, task, killers, [command for cur_action, command, return_queue, pause in batch], session, limit)
+                finally:
+                    self.limits.release(acquired)
+                if session is not None and session.closed:
+                    # Broken session, next command opens new one
+                    sessions.pop(connection['_id'], None)
+                    self.sessions.checkin(session)
+                elif session is not None and new_connection:
+                    prompt = re.compile(connection['prompt']) if connection.get('prompt') else None
+                    drain_readers.append( (return_queue, session.streams['stdout'], prompt) )
+                if exit_code == -999:
+                    continue
+
+            if exit_code == -999:
+                # return None
+                continue
+            done.append((index, batch, exit_code, outputs))
+        return done
+
+    @asyncio.coroutine
+    def _checkout_session(self, connection, task, killers, held=None):
+        """ Take session of SSH/COM/telnet connection from pool, `held` are
+        sessions of task """
+        ttl = task.ttl or SETTINGS.WORKER_TASK_TIMEOUT
+        if connection['type'] == 'ssh':
+            opener = partial(self._open_ssh_session, connection)
+        elif connection['type'] == 'com':
+            opener = partial(self._open_comport_session, connection, ttl)
+        elif connection['type'] == 'telnet':
+            opener = partial(self._open_telnet_session, connection)
+        session = yield from self.sessions.checkout(connection, opener, ttl, held)
+        if session is not None:
+            killers.append(session.close)
+        return session
+
+    def _release_sessions(self, sessions, broken=False):
+        """ Return sessions of task to pool, state of session is unknown
+        after failure, so it is closed """
+        for session in sessions.values():
+            if broken:
+                session.close()
+            self.sessions.checkin(session)
+        sessions.clear()
+
     @asyncio.coroutine
-    def _local_process_runner(self, task, killers, command):
+    def _local_process_runner(self, task, killers, command, limit=None):
         log.debug('Run locally cmd for task {}'.format(task.id))
         try:
             process = yield from asyncio.create_subprocess_shell(command,
@@ -714,14 +1506,16 @@ class MultiActionRunnerWorker(BaseWorker, TelnetReader, SSHReader, COMPortReader
             # Add process to list of pids (it is shared object, cool)
             # Add killer method to list
             killers.append(process.kill)
-            lines = []
+            # Output over limit is read and dropped, so process isn't
+            # blocked on full pipe
+            buffer = OutputBuffer(limit)
             stdout = ''
             try:
                 while not process.stdout.at_eof():
-                    line = yield from process.stdout.readline()
-                    lines.append(line)
+                    data = yield from process.stdout.read(SETTINGS.WORKER_READ_CHUNK)
+                    buffer.write(data)
 
-                stdout = ''.join([line.decode('utf-8', 'ignore') for line in lines])
+                stdout = buffer.getvalue()
             except asyncio.CancelledError as ex:
                 log.error('Task {} was stopped by expire timer!'.format(task.id))
                 try:
@@ -738,6 +1532,8 @@ class MultiActionRunnerWorker(BaseWorker, TelnetReader, SSHReader, COMPortReader
                     return (-999, '')
                 yield from process.wait()
                 return (-999, '')
+            finally:
+                buffer.close()
             exitcode = yield from process.wait()
             return (exitcode, stdout)
         except Exception as ex:
@@ -745,12 +1541,32 @@ class MultiActionRunnerWorker(BaseWorker, TelnetReader, SSHReader, COMPortReader
             return (-999, '')
 
     @asyncio.coroutine
-    def _drain_reader(self, reader, ttl):
+    def _drain_readers(self, drain_readers, ttl, limit=None):
+        """ Drain readers concurrently, each one stops on prompt, EOF or
+        idle ttl, all of them stop by one deadline
+
+        :param drain_readers: list of (return_queue, reader, prompt)
+        :returns: list of (return_queue, stdout)
+        """
+        deadline = time.time() + ttl
+        jobs = [asyncio.Task(self._drain_reader(reader, ttl, limit, prompt, deadline))
+                for return_queue, reader, prompt in drain_readers]
+        try:
+            outputs = yield from asyncio.gather(*jobs)
+        except BaseException:
+            for job in jobs:
+                job.cancel()
+            yield from asyncio.wait(jobs)
+            raise
+        return [(return_queue, stdout) for (return_queue, reader, prompt), stdout in zip(drain_readers, outputs)]
+
+    @asyncio.coroutine
+    def _drain_reader(self, reader, ttl, limit=None, prompt=None, deadline=None):
         if isinstance(reader, asyncssh.SSHReader):
-            res = yield from self._read_ssh_with_ttl(reader, ttl=ttl)
+            res = yield from self._read_ssh_with_ttl(reader, ttl=ttl, prompt=prompt, limit=limit, deadline=deadline)
             return res
         elif isinstance(reader, asyncio.StreamReader):
-            res = yield from self._read_stream_with_ttl(reader, ttl=ttl)
+            res = yield from self._read_stream_with_ttl(reader, ttl=ttl, prompt=prompt, limit=limit, deadline=deadline)
             return res
 
     @asyncio.coroutine
@@ -1,3 +1,4 @@
+import asyncio
 import copy
 import hashlib
 import logging
@@ -12,7 +13,7 @@ from sensors.settings import SETTINGS
 from sensors.utils import parse_timetable
 
 
-__all__ = 'StorageException', 'ActionResursion', 'ConfigStorage'
+__all__ = 'StorageException', 'ActionResursion', 'ConfigStorage', 'ConfigCache'
 
 assert SETTINGS
 
@@ -232,3 +233,112 @@ class ConfigStorage(object):
             for connection in connections.values():
                 if connection['type'] == 'local':
                     return connection
+
+
+class ConfigCache(object):
+    """ Read-only configuration for daemons over asyncio connection. Each
+    config type is loaded once per configuration version (lastChanged) and
+    served from memory, version is checked once per
+    CONFIG_CACHE_CHECK_INTERVAL. Returned objects are shared, don't change
+    them. """
+
+    def __init__(self, connection):
+        self.log = logging.getLogger('storage.redis')
+        self.connection = connection
+        self.storage = ConfigStorage()
+        self.version = None
+        self._checked_at = 0
+        # Config type -> list of objects, name -> derived objects, for current version
+        self._configs = {}
+        self._derived = {}
+
+    @asyncio.coroutine
+    def get_config_version(self):
+        time_now = time.time()
+        if time_now - self._checked_at >= SETTINGS.CONFIG_CACHE_CHECK_INTERVAL:
+            self._checked_at = time_now
+            version = yield from self.connection.get(self.storage.CONFIGURATION_VERSION_KEY)
+            if version != self.version:
+                self.log.info('Configuration version is changed to {}, drop cache'.format(version))
+                self.version = version
+                self._configs = {}
+                self._derived = {}
+        return self.version
+
+    @asyncio.coroutine
+    def get_config(self, key):
+        yield from self.get_config_version()
+        # Version may change while config is loaded, loaded config is
+        # stored to cache of version it was loaded for
+        configs = self._configs
+        if key not in configs:
+            # SCAN doesn't block redis like KEYS
+            db_key = ":".join([self.storage.NAMESPACE, key, '*']).encode('utf-8')
+            cursor = yield from self.connection.scan(match=db_key)
+            db_keys = yield from cursor.fetchall()
+            vals = (yield from self.connection.mget_aslist(db_keys)) if db_keys else []
+            configs[key] = [ujson.loads(val) for val in vals if val]
+        return configs[key]
+
+    @asyncio.coroutine
+    def _get_derived(self, name, key, builder):
+        """ Object built from config type, it is built once per version """
+        yield from self.get_config_version()
+        derived = self._derived
+        objects = yield from self.get_config(key)
+        if name not in derived:
+            derived[name] = builder(objects)
+        return derived[name]
+
+    @asyncio.coroutine
+    def list_actions(self):
+        return (yield from self._get_derived('actions', 'action', lambda actions: {action.get('_id'): action for action in actions}))
+
+    @asyncio.coroutine
+    def get_scheduled_actions(self):
+        """ get_scheduled_actions -- see `ConfigStorage.get_scheduled_actions` """
+        def build(actions):
+            actions_dict = {action.get('_id'): action for action in actions}
+            scheduled_dict = {}
+            for action in actions:
+                if not parse_timetable(action.get('schedule', '')):
+                    continue
+                try:
+                    scheduled_dict[action.get('_id')] = self.storage._parse_action(actions_dict, action)
+                except ActionResursion as ex:
+                    self.log.error(ex.value)
+            return scheduled_dict
+        return (yield from self._get_derived('scheduled_actions', 'action', build))
+
+    @asyncio.coroutine
+    def get_action(self, _id, initial_param_values={}, connection_id=None):
+        """ get_action -- see `ConfigStorage.get_action`, action is marked
+        with config version and bound params, worker caches its commands by
+        them """
+        version = yield from self.get_config_version()
+        actions_dict = yield from self.list_actions()
+        action = copy.deepcopy(actions_dict.get(_id))
+        if action and connection_id:
+            action['connection_id'] = connection_id
+        action = self.storage._parse_action(actions_dict, action, initial_param_values=initial_param_values)
+        if action:
+            action['config_version'] = version.decode('utf-8') if version else None
+            action['bound_params'] = dict(initial_param_values)
+        return action
+
+    @asyncio.coroutine
+    def list_metrics(self):
+        return (yield from self._get_derived('metrics', 'metric', lambda metrics: {metric.get('_id'): metric for metric in metrics}))
+
+    @asyncio.coroutine
+    def list_triggers(self):
+        def build(triggers):
+            triggers_dict = {trigger.get('_id'): copy.deepcopy(trigger) for trigger in triggers}
+            for trigger in triggers_dict.values():
+                trigger['depends_on'] = {condition.get('metric_id') for condition in trigger.get('conditions', [])}
+            return triggers_dict
+        return (yield from self._get_derived('triggers', 'trigger', build))
+
+    @asyncio.coroutine
+    def list_connections(self):
+        return (yield from self._get_derived('connections', 'connection', lambda connections: {connection.get('_id'): connection for connection in connections}))
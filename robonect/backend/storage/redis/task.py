@@ -1,18 +1,342 @@
 import asyncio
+import asyncio_redis
 import codecs
+import concurrent.futures
 import hashlib
 import logging
 import os
 import pickle
+import redis
 import ujson
 
 
 from sensors.settings import SETTINGS
-from sensors.utils import datetime_to_timestamp
+from sensors.utils import datetime_to_timestamp, now, get_shard
 from storage.models import Task, SchedulerTaskHistory
 
 
-__all__ = 'StorageException', 'TaskStorage'
+__all__ = 'StorageException', 'FencingError', 'TaskStorage', 'StreamTaskQueue'
+
+
+# Acquire lease if it is free or renew it if we hold it
+LEASE_SCRIPT_CODE = """
+local lease_key = KEYS[1]
+local owner = ARGV[1]
+local ttl = ARGV[2]
+
+local holder = redis.call('GET', lease_key)
+if not holder then
+  redis.call('SET', lease_key, owner, 'PX', ttl)
+  return 1
+elseif holder == owner then
+  redis.call('PEXPIRE', lease_key, ttl)
+  return 1
+end
+return 0
+"""
+
+# Acquire leadership or renew it, returns fencing token (grows with every
+# new leader) or 0 if lease is held by other process
+LEADER_SCRIPT_CODE = """
+local leader_key, fence_key = KEYS[1], KEYS[2]
+local owner = ARGV[1]
+local ttl = ARGV[2]
+
+local holder = redis.call('GET', leader_key)
+if not holder then
+  redis.call('SET', leader_key, owner, 'PX', ttl)
+  return redis.call('INCR', fence_key)
+elseif holder == owner then
+  redis.call('PEXPIRE', leader_key, ttl)
+  local token = redis.call('GET', fence_key)
+  if not token then
+    token = redis.call('INCR', fence_key)
+  end
+  return tonumber(token)
+end
+return 0
+"""
+
+# Release lease only if we hold it
+RELEASE_LEASE_SCRIPT_CODE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Store tasks with scheduler run history in one call. Due tasks are pushed
+# directly to dispatched queue (list or stream) while there is room in it,
+# others go to scheduled queue shard. Priority lane isn't limited, dispatcher
+# moves tasks only to regular lane. Direct pushes are counted in dispatch lag
+# stats like dispatcher does, wakeup token is pushed for each of them and
+# dispatch time is recorded in dispatched set until task is finished.
+# History changes are published before tasks, so they come to schedulers
+# before reports of workers. Id of task with history is stored in task ids
+# hash, worker updates history only if its task is still scheduled one.
+# Returns -1 if fencing token is outdated.
+# KEYS: history hash, fence key, task ids hash, stats hash, wakeup queue,
+#       dispatched set, then (task key, dispatched queue, scheduled queue) for each task
+# ARGV: expire, transport, fencing token or '', channel, history delta or '',
+#       dispatched queue limit, current time (ms), wakeup tokens limit,
+#       then (body, id, score, name, history or '', dispatch) for each task,
+#       dispatch is '' for future task, 'limit' for regular lane, 'priority'
+SCHEDULE_SCRIPT_CODE = """
+local history_hash, fence_key, task_ids_hash, stats_hash, wakeup_queue, dispatched_set = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6]
+local expire = ARGV[1]
+local transport = ARGV[2]
+local jobs_limit = tonumber(ARGV[6])
+local ctime = tonumber(ARGV[7])
+local wakeup_limit = tonumber(ARGV[8])
+local dispatched = 0
+local total_lag = 0
+local max_lag = 0
+local rooms = {}
+
+if ARGV[3] ~= '' and redis.call('GET', fence_key) ~= ARGV[3] then
+  return -1
+end
+if ARGV[5] ~= '' then
+  redis.call('PUBLISH', ARGV[4], ARGV[5])
+end
+
+local has_room = function(queue)
+  if rooms[queue] == nil then
+    if transport == 'stream' then
+      rooms[queue] = jobs_limit - redis.call('XLEN', queue)
+    else
+      rooms[queue] = jobs_limit - redis.call('LLEN', queue)
+    end
+  end
+  return rooms[queue] > 0
+end
+
+for i = 7, #KEYS, 3 do
+  local j = 9 + (i - 7) / 3 * 6
+  local queue, scheduled_queue = KEYS[i + 1], KEYS[i + 2]
+  local task_id, score, name, history, dispatch = ARGV[j + 1], ARGV[j + 2], ARGV[j + 3], ARGV[j + 4], ARGV[j + 5]
+
+  redis.call('SET', KEYS[i], ARGV[j], 'EX', expire)
+  if dispatch == 'priority' or (dispatch == 'limit' and has_room(queue)) then
+    if transport == 'stream' then
+      redis.call('XADD', queue, '*', 'task', task_id)
+    else
+      redis.call('LPUSH', queue, task_id)
+    end
+    if rooms[queue] then
+      rooms[queue] = rooms[queue] - 1
+    end
+    redis.call('ZADD', dispatched_set, ctime, task_id)
+    dispatched = dispatched + 1
+    local lag = math.max(ctime - tonumber(score), 0)
+    total_lag = total_lag + lag
+    if lag > max_lag then max_lag = lag end
+  else
+    redis.call('ZADD', scheduled_queue, score, task_id)
+  end
+  if history ~= '' then
+    redis.call('HSET', history_hash, name, history)
+    redis.call('HSET', task_ids_hash, name, task_id)
+  end
+end
+
+if dispatched > 0 then
+  redis.call('HINCRBY', stats_hash, 'dispatched', dispatched)
+  redis.call('HINCRBY', stats_hash, 'lag_total', total_lag)
+  if max_lag > tonumber(redis.call('HGET', stats_hash, 'lag_max') or 0) then
+    redis.call('HSET', stats_hash, 'lag_max', max_lag)
+  end
+  if transport ~= 'stream' then
+    for k = 1, math.min(dispatched, wakeup_limit) do
+      redis.call('LPUSH', wakeup_queue, 1)
+    end
+    redis.call('LTRIM', wakeup_queue, 0, wakeup_limit - 1)
+  end
+end
+return dispatched
+"""
+
+# Finish expired tasks: store new status, remove from inprogress queue and set,
+# notify waiters and reset scheduler run history. Task id in task ids hash is
+# replaced by empty marker, so late completion of reaped task is rejected.
+# Returns -1 if fencing token is outdated.
+# KEYS: inprogress set, inprogress queue, history hash, fence key, task ids hash, dispatched set,
+#       then task key for each task
+# ARGV: expire, fencing token or '', channel, history delta or '',
+#       then (id, body or '' to delete, channel, status, name, history or '') for each task
+REAP_SCRIPT_CODE = """
+local inprogress_set, inprogress_queue, history_hash, fence_key, task_ids_hash, dispatched_set = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6]
+local expire = ARGV[1]
+
+if ARGV[2] ~= '' and redis.call('GET', fence_key) ~= ARGV[2] then
+  return -1
+end
+if ARGV[4] ~= '' then
+  redis.call('PUBLISH', ARGV[3], ARGV[4])
+end
+
+for i = 7, #KEYS do
+  local j = 5 + (i - 7) * 6
+  local task_id, body, channel, status, name, history = ARGV[j], ARGV[j + 1], ARGV[j + 2], ARGV[j + 3], ARGV[j + 4], ARGV[j + 5]
+
+  if body == '' then
+    redis.call('DEL', KEYS[i])
+  else
+    redis.call('SET', KEYS[i], body, 'EX', expire)
+  end
+  redis.call('ZREM', inprogress_set, task_id)
+  redis.call('ZREM', dispatched_set, task_id)
+  redis.call('LREM', inprogress_queue, 0, task_id)
+  redis.call('PUBLISH', channel, status)
+  if history ~= '' then
+    redis.call('HSET', history_hash, name, history)
+    redis.call('HSET', task_ids_hash, name, '')
+  end
+end
+return #KEYS - 6
+"""
+
+# Finish task completed by worker: store it, remove from inprogress queue and
+# set (or acknowledge in dispatched stream), store run history if task is
+# still scheduled task of action (task ids hash) and notify waiters. Empty
+# task id marks finished or reaped task, any task is accepted only if action
+# has no task id at all (history written before task ids hash existed).
+# KEYS: task key, inprogress queue, inprogress set, stream, history hash, task ids hash, dispatched set
+# ARGV: expire, body, id, consumer group, stream entry id or '', channel, status,
+#       name, history or '', scheduler channel, scheduler message
+# Returns 1 if run history is updated
+COMPLETE_SCRIPT_CODE = """
+local task_key, inprogress_queue, inprogress_set, stream, history_hash, task_ids_hash, dispatched_set = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6], KEYS[7]
+local task_id, entry_id, name, history = ARGV[3], ARGV[5], ARGV[8], ARGV[9]
+local updated = 0
+
+redis.call('SET', task_key, ARGV[2], 'EX', ARGV[1])
+redis.call('ZREM', dispatched_set, task_id)
+if entry_id ~= '' then
+  redis.call('XACK', stream, ARGV[4], entry_id)
+  redis.call('XDEL', stream, entry_id)
+else
+  redis.call('LREM', inprogress_queue, 0, task_id)
+  redis.call('ZREM', inprogress_set, task_id)
+end
+if history ~= '' and redis.call('HEXISTS', history_hash, name) == 1 then
+  local scheduled_id = redis.call('HGET', task_ids_hash, name)
+  if not scheduled_id or scheduled_id == task_id then
+    redis.call('HSET', history_hash, name, history)
+    redis.call('HSET', task_ids_hash, name, '')
+    redis.call('PUBLISH', ARGV[10], ARGV[11])
+    updated = 1
+  end
+end
+redis.call('PUBLISH', ARGV[6], ARGV[7])
+return updated
+"""
+
+# Reset run history of lost scheduled tasks. Task is not lost if it isn't
+# scheduled task of action anymore, waits in scheduled queue, is in progress
+# or was dispatched (and not finished) after `stale` time. History changes
+# are published for standby schedulers. Returns -1 if fencing token is
+# outdated, otherwise list of names of actions with reset history.
+# KEYS: history hash, fence key, task ids hash, inprogress set, dispatched set,
+#       then scheduled queue for each task
+# ARGV: fencing token or '', channel, stale (ms),
+#       then (id, name, history, last_run) for each task
+LOST_SCRIPT_CODE = """
+local history_hash, fence_key, task_ids_hash, inprogress_set, dispatched_set = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local stale = tonumber(ARGV[3])
+local reset = {}
+local histories = {}
+
+if ARGV[1] ~= '' and redis.call('GET', fence_key) ~= ARGV[1] then
+  return -1
+end
+
+for i = 6, #KEYS do
+  local j = 4 + (i - 6) * 4
+  local task_id, name, history, last_run = ARGV[j], ARGV[j + 1], ARGV[j + 2], ARGV[j + 3]
+  local lost = redis.call('HGET', task_ids_hash, name) == task_id
+    and not redis.call('ZSCORE', KEYS[i], task_id)
+    and not redis.call('ZSCORE', inprogress_set, task_id)
+  if lost then
+    local dispatched_at = redis.call('ZSCORE', dispatched_set, task_id)
+    if dispatched_at and tonumber(dispatched_at) >= stale then
+      lost = false
+    elseif dispatched_at then
+      redis.call('ZREM', dispatched_set, task_id)
+    end
+  end
+  if lost then
+    redis.call('HSET', history_hash, name, history)
+    redis.call('HSET', task_ids_hash, name, '')
+    table.insert(reset, name)
+    table.insert(histories, {name, tonumber(last_run), 0, cjson.null})
+  end
+end
+if #histories > 0 then
+  redis.call('PUBLISH', ARGV[2], cjson.encode({history = histories}))
+end
+return reset
+"""
+
+# Claim up to count dispatched tasks, priority queue first: move them to
+# inprogress queue and set (with provisional expiry) and return their ids.
+# Bodies are read after script, task keys aren't known before pop and all
+# keys of script must be passed in KEYS (redis cluster).
+# KEYS: priority queue, dispatched queue, inprogress queue, inprogress set
+# ARGV: count, provisional expiry (ms)
+CLAIM_SCRIPT_CODE = """
+local inprogress_queue, inprogress_set = KEYS[3], KEYS[4]
+local count = tonumber(ARGV[1])
+local result = {}
+
+for i = 1, 2 do
+  while #result < count do
+    local task_id = redis.call('RPOP', KEYS[i])
+    if not task_id then
+      break
+    end
+    redis.call('LPUSH', inprogress_queue, task_id)
+    redis.call('ZADD', inprogress_set, ARGV[2], task_id)
+    table.insert(result, task_id)
+  end
+end
+return result
+"""
+
+# Mark claimed tasks as in progress: store new body and expiry.
+# KEYS: inprogress set, then task key for each task
+# ARGV: expire, '1' to track task in inprogress set or '', then (id, body, expires_at) for each task
+START_SCRIPT_CODE = """
+local inprogress_set = KEYS[1]
+
+for i = 2, #KEYS do
+  local j = 3 + (i - 2) * 3
+  if ARGV[2] ~= '' then
+    redis.call('ZADD', inprogress_set, ARGV[j + 2], ARGV[j])
+  end
+  redis.call('SET', KEYS[i], ARGV[j + 1], 'EX', ARGV[1])
+end
+return #KEYS - 1
+"""
+
+# Acknowledge task in dispatched stream and remove it from stream
+STREAM_ACK_SCRIPT_CODE = """
+local count = redis.call('XACK', KEYS[1], ARGV[1], ARGV[2])
+redis.call('XDEL', KEYS[1], ARGV[2])
+return count
+"""
+
+# Store heartbeat of member, remove dead members, returns count of alive members
+HEARTBEAT_SCRIPT_CODE = """
+local members_set = KEYS[1]
+local member = ARGV[1]
+local ctime = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+
+redis.call('ZADD', members_set, ctime, member)
+redis.call('ZREMRANGEBYSCORE', members_set, '-inf', ctime - ttl)
+return redis.call('ZCARD', members_set)
+"""
 
 
 class StorageException(Exception):
@@ -25,12 +349,17 @@ class StorageException(Exception):
         return repr(self.value)
 
 
+class FencingError(StorageException):
+    """ Other scheduler took leadership, write is rejected """
+
+
 class TaskStorage():
 
     def __init__(self, loop, connection):
         self.loop = loop
         self.log = logging.getLogger('storage.redis.config')
         self.connection = connection
+        self._scripts = {}
 
         if self.connection:
             self.log.info('Storage connected')
@@ -46,13 +375,297 @@ class TaskStorage():
                     store_to=store_to)
         return task
 
+    @asyncio.coroutine
+    def _run_script(self, code, keys, args):
+        """ Run lua-script with EVALSHA, load it into redis when needed """
+        script = self._scripts.get(code)
+        if not script:
+            script = self._scripts[code] = yield from self.connection.register_script(code)
+        try:
+            reply = yield from script.run(keys=keys, args=args)
+        except asyncio_redis.NoScriptError:
+            # Redis was restarted and lost script cache
+            script = self._scripts[code] = yield from self.connection.register_script(code)
+            reply = yield from script.run(keys=keys, args=args)
+        return (yield from reply.return_value())
+
+    @staticmethod
+    def get_scheduled_queue(shard):
+        """ Scheduled queue key for shard number """
+        if not shard:
+            return SETTINGS.SCHEDULED_QUEUE
+        return SETTINGS.SCHEDULED_QUEUE_SHARD.format(shard).encode('utf-8')
+
+    @classmethod
+    def get_task_scheduled_queue(cls, task):
+        """ Scheduled queue shard for task, picked by hash of task name """
+        return cls.get_scheduled_queue(get_shard(task.name, SETTINGS.SCHEDULED_QUEUE_SHARDS))
+
+    @staticmethod
+    def get_dispatched_queue(task):
+        """ Priority lane for triggered tasks, regular lane for others """
+        if SETTINGS.TASK_TRANSPORT == 'stream':
+            if task.type == Task.TYPE_TRIGGERED:
+                return SETTINGS.DISPATCHED_PRIORITY_STREAM
+            return SETTINGS.DISPATCHED_STREAM
+        if task.type == Task.TYPE_TRIGGERED:
+            return SETTINGS.DISPATCHED_PRIORITY_QUEUE
+        return SETTINGS.DISPATCHED_QUEUE
+
     @asyncio.coroutine
     def schedule_task(self, task):
-        self.log.info('Schedule task id={}, name={}, run_at={}'.format(task.id, task.name, task.run_at))
-        # Create task
-        yield from self.connection.set(SETTINGS.TASK_STORAGE_KEY.format(task.id).encode('utf-8'), task.serialize(), expire=SETTINGS.TASK_STORAGE_EXPIRE)
-        # Add tasks to scheduled queue
-        yield from self.connection.zadd(SETTINGS.SCHEDULED_QUEUE, {task.bid(): datetime_to_timestamp(task.run_at)})
+        """ schedule_task -- store task and put it to scheduled queue. Task
+        with run_at in the past skips scheduled queue and goes directly to
+        dispatched queue.
+
+        :returns: (bool) True if task was dispatched directly, there is no
+                  need to ping dispatcher
+        """
+        dispatched = yield from self.schedule_tasks([(task, None)])
+        return bool(dispatched)
+
+    @staticmethod
+    def _history_delta(histories):
+        """ Message with run history changes for standby scheduler """
+        histories = [[h.name, h.last_run, h.next_run, h.scheduled_task_id] for h in histories if h]
+        if not histories:
+            return b''
+        return ujson.dumps(dict(history=histories)).encode('utf-8')
+
+    @asyncio.coroutine
+    def schedule_tasks(self, tasks, fence=None):
+        """ schedule_tasks -- store and schedule batch of tasks in one
+        round trip, see `schedule_task`
+
+        :param tasks: list of (task, history), history is
+                      SchedulerTaskHistory to store or None
+        :param fence: (int) fencing token of leader scheduler
+        :returns: (int) count of tasks dispatched directly
+        :raises: FencingError
+        """
+        time_now = int(now())
+        keys = [SETTINGS.SCHEDULER_HISTORY_HASH, SETTINGS.SCHEDULER_LEADER_FENCE_KEY, SETTINGS.SCHEDULER_HISTORY_TASKS_HASH,
+                SETTINGS.DISPATCHER_STATS_HASH, SETTINGS.DISPATCHED_WAKEUP_QUEUE, SETTINGS.DISPATCHED_TASKS_SET]
+        args = [str(SETTINGS.TASK_STORAGE_EXPIRE).encode('utf-8'), SETTINGS.TASK_TRANSPORT.encode('utf-8'),
+                str(fence).encode('utf-8') if fence else b'', SETTINGS.WORKER_TO_SCHEDULER_CHANNEL,
+                self._history_delta(history for task, history in tasks),
+                str(SETTINGS.DISPATCHED_QUEUE_LIMIT).encode('utf-8'), str(time_now).encode('utf-8'),
+                str(SETTINGS.DISPATCHED_WAKEUP_LIMIT).encode('utf-8')]
+        for task, history in tasks:
+            self.log.info('Schedule task id={}, name={}, run_at={}'.format(task.id, task.name, task.run_at))
+            run_at = datetime_to_timestamp(task.run_at)
+            keys.extend([SETTINGS.TASK_STORAGE_KEY.format(task.id).encode('utf-8'),
+                         self.get_dispatched_queue(task), self.get_task_scheduled_queue(task)])
+            if run_at > time_now:
+                dispatch = b''
+            elif task.type == Task.TYPE_TRIGGERED:
+                dispatch = b'priority'
+            else:
+                # Task is due, skip scheduled queue if dispatched queue
+                # has room, otherwise dispatcher moves it later
+                dispatch = b'limit'
+            args.extend([task.serialize(), task.bid(), str(run_at).encode('utf-8'),
+                         task.name.encode('utf-8'), history.serialize() if history else b'', dispatch])
+        if not tasks:
+            return 0
+        dispatched = yield from self._run_script(SCHEDULE_SCRIPT_CODE, keys=keys, args=args)
+        if dispatched < 0:
+            raise FencingError('Fencing token {} is outdated'.format(fence), fence)
+        return dispatched
+
+    @asyncio.coroutine
+    def get_expired_tasks(self, time_now):
+        """ get_expired_tasks -- tasks with expired TTL in inprogress set
+
+        :param time_now: (int) current time, ms
+        :returns: list of (task_id, task), task is None if it is lost or broken
+        """
+        reply = yield from self.connection.zrangebyscore(SETTINGS.INPROGRESS_TASKS_SET,
+                                                         min=asyncio_redis.ZScoreBoundary.MIN_VALUE,
+                                                         max=asyncio_redis.ZScoreBoundary(time_now))
+        task_ids = list((yield from reply.asdict()).keys())
+        if not task_ids:
+            return []
+        keys = [SETTINGS.TASK_STORAGE_KEY.format(task_id.decode('utf-8')).encode('utf-8') for task_id in task_ids]
+        values = yield from self.connection.mget_aslist(keys)
+        expired = []
+        for task_id, value in zip(task_ids, values):
+            try:
+                task = Task.deserialize(value) if value else None
+            except (pickle.UnpicklingError, EOFError, TypeError, ImportError):
+                self.log.error('Wrong task id={}'.format(task_id), exc_info=True)
+                task = None
+            expired.append((task_id, task))
+        return expired
+
+    @asyncio.coroutine
+    def reap_tasks(self, tasks, fence=None):
+        """ reap_tasks -- finish expired tasks in one round trip
+
+        :param tasks: list of (task_id, task, history), task is None for lost
+                      task, history is SchedulerTaskHistory to store or None
+        :param fence: (int) fencing token of leader scheduler
+        :raises: FencingError
+        """
+        if not tasks:
+            return 0
+        keys = [SETTINGS.INPROGRESS_TASKS_SET, SETTINGS.INPROGRESS_QUEUE, SETTINGS.SCHEDULER_HISTORY_HASH, SETTINGS.SCHEDULER_LEADER_FENCE_KEY,
+                SETTINGS.SCHEDULER_HISTORY_TASKS_HASH, SETTINGS.DISPATCHED_TASKS_SET]
+        args = [str(SETTINGS.TASK_STORAGE_EXPIRE).encode('utf-8'),
+                str(fence).encode('utf-8') if fence else b'', SETTINGS.WORKER_TO_SCHEDULER_CHANNEL,
+                self._history_delta(history for task_id, task, history in tasks)]
+        for task_id, task, history in tasks:
+            keys.append(SETTINGS.TASK_STORAGE_KEY.format(task_id.decode('utf-8')).encode('utf-8'))
+            args.extend([task_id,
+                         task.serialize() if task else b'',
+                         SETTINGS.TASK_CHANNEL.format(task_id.decode('utf-8')).encode('utf-8'),
+                         (task.status if task else Task.FAILED).encode('utf-8'),
+                         task.name.encode('utf-8') if task else b'',
+                         history.serialize() if history else b''])
+        count = yield from self._run_script(REAP_SCRIPT_CODE, keys=keys, args=args)
+        if count < 0:
+            raise FencingError('Fencing token {} is outdated'.format(fence), fence)
+        return count
+
+    @asyncio.coroutine
+    def reset_lost_tasks(self, tasks, fence=None):
+        """ reset_lost_tasks -- reset run history of scheduled tasks which
+        never reached worker, in one round trip. Task dispatched less than
+        TASK_STORAGE_EXPIRE ago waits in dispatched queue, it isn't lost.
+
+        :param tasks: list of (task_id, history), history is reset
+                      SchedulerTaskHistory of action
+        :param fence: (int) fencing token of leader scheduler
+        :returns: list of names of actions with reset history
+        :raises: FencingError
+        """
+        if not tasks:
+            return []
+        stale = int(now()) - SETTINGS.TASK_STORAGE_EXPIRE * 1000
+        keys = [SETTINGS.SCHEDULER_HISTORY_HASH, SETTINGS.SCHEDULER_LEADER_FENCE_KEY, SETTINGS.SCHEDULER_HISTORY_TASKS_HASH,
+                SETTINGS.INPROGRESS_TASKS_SET, SETTINGS.DISPATCHED_TASKS_SET]
+        args = [str(fence).encode('utf-8') if fence else b'', SETTINGS.WORKER_TO_SCHEDULER_CHANNEL, str(stale).encode('utf-8')]
+        for task_id, history in tasks:
+            keys.append(self.get_scheduled_queue(get_shard(history.name, SETTINGS.SCHEDULED_QUEUE_SHARDS)))
+            args.extend([task_id.encode('utf-8'), history.name.encode('utf-8'), history.serialize(),
+                         str(history.last_run).encode('utf-8')])
+        reset = yield from self._run_script(LOST_SCRIPT_CODE, keys=keys, args=args)
+        if reset == -1:
+            raise FencingError('Fencing token {} is outdated'.format(fence), fence)
+        return [name.decode('utf-8') for name in reset]
+
+    @asyncio.coroutine
+    def claim_tasks(self, count):
+        """ claim_tasks -- take up to `count` dispatched tasks with their
+        bodies, priority queue first. Tasks are claimed by script and their
+        bodies are read by one MGET. Tasks are moved to inprogress queue and
+        set, their expiry is provisional until `start_tasks`.
+
+        :returns: list of (task_id, body), body is None for lost task
+        """
+        expires_at = int(now()) + SETTINGS.WORKER_TASK_TIMEOUT * 1000
+        keys = [SETTINGS.DISPATCHED_PRIORITY_QUEUE, SETTINGS.DISPATCHED_QUEUE, SETTINGS.INPROGRESS_QUEUE, SETTINGS.INPROGRESS_TASKS_SET]
+        args = [str(count).encode('utf-8'), str(expires_at).encode('utf-8')]
+        task_ids = yield from self._run_script(CLAIM_SCRIPT_CODE, keys=keys, args=args)
+        if not task_ids:
+            return []
+        bodies = yield from self.connection.mget_aslist([SETTINGS.TASK_STORAGE_KEY.format(task_id.decode('utf-8')).encode('utf-8')
+                                                         for task_id in task_ids])
+        return [(task_id, body or None) for task_id, body in zip(task_ids, bodies)]
+
+    @asyncio.coroutine
+    def start_tasks(self, tasks, track=True):
+        """ start_tasks -- store in progress tasks in one round trip
+
+        :param tasks: list of (task, expires_at), expires_at in ms
+        :param track: add tasks to inprogress set, stream transport keeps
+                      them in pending entries of consumer group instead
+        """
+        if not tasks:
+            return 0
+        keys = [SETTINGS.INPROGRESS_TASKS_SET]
+        args = [str(SETTINGS.TASK_STORAGE_EXPIRE).encode('utf-8'), b'1' if track else b'']
+        for task, expires_at in tasks:
+            keys.append(SETTINGS.TASK_STORAGE_KEY.format(task.id).encode('utf-8'))
+            args.extend([task.bid(), task.serialize(), str(expires_at).encode('utf-8')])
+        return (yield from self._run_script(START_SCRIPT_CODE, keys=keys, args=args))
+
+    @asyncio.coroutine
+    def complete_task(self, task, history=None, stream_entry=None):
+        """ complete_task -- store finished task, remove it from inprogress
+        queue and set (or acknowledge it in stream), update scheduler run
+        history and notify waiters in one round trip
+
+        :param history: SchedulerTaskHistory to store if task is still
+                        scheduled task of action, or None
+        :param stream_entry: (stream, entry_id) for stream transport
+        :returns: (bool) True if run history is updated
+        """
+        stream, entry_id = stream_entry or (SETTINGS.DISPATCHED_STREAM, b'')
+        keys = [SETTINGS.TASK_STORAGE_KEY.format(task.id).encode('utf-8'), SETTINGS.INPROGRESS_QUEUE, SETTINGS.INPROGRESS_TASKS_SET,
+                stream, SETTINGS.SCHEDULER_HISTORY_HASH, SETTINGS.SCHEDULER_HISTORY_TASKS_HASH, SETTINGS.DISPATCHED_TASKS_SET]
+        message = b''
+        if history:
+            message = ujson.dumps(dict(name=task.name, task_id=task.id, last_run=history.last_run)).encode('utf-8')
+        args = [str(SETTINGS.TASK_STORAGE_EXPIRE).encode('utf-8'), task.serialize(), task.bid(),
+                SETTINGS.WORKER_CONSUMER_GROUP, entry_id,
+                SETTINGS.TASK_CHANNEL.format(task.id).encode('utf-8'), task.status.encode('utf-8'),
+                task.name.encode('utf-8'), history.serialize() if history else b'',
+                SETTINGS.WORKER_TO_SCHEDULER_CHANNEL, message]
+        updated = yield from self._run_script(COMPLETE_SCRIPT_CODE, keys=keys, args=args)
+        return bool(updated)
+
+    @asyncio.coroutine
+    def ack_stream_task(self, stream, entry_id):
+        """ Task is completed, remove it from pending entries of consumer group """
+        return (yield from self._run_script(STREAM_ACK_SCRIPT_CODE, keys=[stream], args=[SETTINGS.WORKER_CONSUMER_GROUP, entry_id]))
+
+    @asyncio.coroutine
+    def hold_lease(self, key, owner, ttl):
+        """ hold_lease -- acquire free lease or renew our lease
+
+        :param key: (bytes) lease key
+        :param owner: (bytes) unique id of lease holder
+        :param ttl: (int) lease time to live, in seconds
+        :returns: (bool) True if we hold lease
+        """
+        result = yield from self._run_script(LEASE_SCRIPT_CODE, keys=[key], args=[owner, str(ttl * 1000).encode('utf-8')])
+        return bool(result)
+
+    @asyncio.coroutine
+    def hold_leadership(self, owner, ttl):
+        """ hold_leadership -- become leader scheduler or renew leadership
+
+        :param owner: (bytes) unique id of scheduler
+        :param ttl: (int) lease time to live, in seconds
+        :returns: (int) fencing token, 0 if other scheduler is leader
+        """
+        return (yield from self._run_script(LEADER_SCRIPT_CODE,
+                                            keys=[SETTINGS.SCHEDULER_LEADER_KEY, SETTINGS.SCHEDULER_LEADER_FENCE_KEY],
+                                            args=[owner, str(ttl * 1000).encode('utf-8')]))
+
+    @asyncio.coroutine
+    def release_lease(self, key, owner):
+        result = yield from self._run_script(RELEASE_LEASE_SCRIPT_CODE, keys=[key], args=[owner])
+        return bool(result)
+
+    @asyncio.coroutine
+    def heartbeat(self, key, member, ttl):
+        """ heartbeat -- mark member as alive, returns count of alive members
+
+        :param ttl: (int) member is dead if there was no heartbeat for ttl seconds
+        """
+        return (yield from self._run_script(HEARTBEAT_SCRIPT_CODE, keys=[key], args=[member, now(), str(ttl * 1000).encode('utf-8')]))
+
+    @asyncio.coroutine
+    def leave(self, key, member):
+        """ leave -- remove member from alive members, see `heartbeat` """
+        yield from self.connection.zrem(key, [member])
+
+    @asyncio.coroutine
+    def ping_dispatcher(self):
+        # Publish message about new scheduled task, dispatcher re-arms its timer
+        yield from self.connection.publish(SETTINGS.SCHEDULER_TO_DISPATCHER_CHANNEL, b'')
 
     @asyncio.coroutine
     def create_scheduler_task_history(self, task, last_run, next_run, scheduled_task_id):
@@ -87,3 +700,92 @@ class TaskStorage():
         if values and len(keys) == len(values):
             return dict(zip(keys, values))
         return dict(zip(keys, [None]*len(keys)))
+
+
+class StreamTaskQueue(object):
+    """ Consumer side of dispatched streams. Blocking XREADGROUP has no
+    support in asyncio_redis (and is not allowed in lua-scripts), so it is
+    called through own synchronous connection in own single thread executor,
+    blocked read doesn't take threads of default executor (DNS lookups and
+    others) and connection is used by one thread only. """
+    _connection = None
+    _settings = {
+        'host': 'localhost',
+        'port': 6379,
+        'db': 0,
+    }
+
+    STREAMS = (SETTINGS.DISPATCHED_PRIORITY_STREAM, SETTINGS.DISPATCHED_STREAM)
+
+    def __init__(self, loop, consumer):
+        self.loop = loop
+        self.log = logging.getLogger('storage.redis.task')
+        self.consumer = consumer
+        self._autoclaim_last_run = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def connection(self):
+        if not self._connection:
+            self._connection = redis.StrictRedis(**self._settings)
+        return self._connection
+
+    @asyncio.coroutine
+    def create_groups(self):
+        yield from self.loop.run_in_executor(self._executor, self._create_groups)
+
+    @asyncio.coroutine
+    def claim(self, count):
+        """ claim -- read up to `count` tasks for this consumer, tasks of dead
+        consumers first, then priority stream, then regular stream.
+
+        :returns: list of (stream, entry_id, task_id, reclaimed)
+        """
+        return (yield from self.loop.run_in_executor(self._executor, self._claim, count))
+
+    def close(self):
+        """ Stop executor, blocked read ends within WORKER_BPOP_TIMEOUT """
+        self._executor.shutdown(wait=False)
+
+    def _create_groups(self):
+        for stream in self.STREAMS:
+            try:
+                self.connection.xgroup_create(stream, SETTINGS.WORKER_CONSUMER_GROUP, id='0', mkstream=True)
+            except redis.ResponseError:
+                # BUSYGROUP, group already exists
+                pass
+
+    def _claim(self, count):
+        entries = []
+        time_now = int(now())
+        if time_now - self._autoclaim_last_run > SETTINGS.WORKER_STREAM_CLAIM_IDLE * 1000 / 2:
+            self._autoclaim_last_run = time_now
+            # Take over tasks from dead workers
+            for stream in self.STREAMS:
+                if len(entries) >= count:
+                    break
+                reply = self.connection.xautoclaim(stream, SETTINGS.WORKER_CONSUMER_GROUP, self.consumer,
+                                                   min_idle_time=SETTINGS.WORKER_STREAM_CLAIM_IDLE * 1000,
+                                                   start_id='0-0', count=count - len(entries))
+                claimed = [(stream, entry_id, fields[b'task'], True) for entry_id, fields in reply[1] if fields]
+                if claimed:
+                    self.log.info('Took over {} tasks of dead workers from {}'.format(len(claimed), stream))
+                    entries.extend(claimed)
+
+        # Drain priority stream first without blocking, block on both only if there is nothing to do
+        for stream in self.STREAMS:
+            if len(entries) >= count:
+                return entries
+            entries.extend(self._read({stream: '>'}, count - len(entries)))
+        if not entries:
+            entries.extend(self._read({stream: '>' for stream in self.STREAMS}, count,
+                                      block=SETTINGS.WORKER_BPOP_TIMEOUT * 1000))
+        return entries
+
+    def _read(self, streams, count, block=None):
+        reply = self.connection.xreadgroup(SETTINGS.WORKER_CONSUMER_GROUP, self.consumer, streams, count=count, block=block)
+        entries = []
+        for stream, messages in reply or []:
+            for entry_id, fields in messages:
+                entries.append((stream, entry_id, fields[b'task'], False))
+        return entries
@@ -8,6 +8,7 @@ import ujson
 from storage.redis import TaskStorage
 from sensors.tests.base import AsyncTestCase, async, mock_coroutine
 from sensors.settings import SETTINGS
+from sensors.utils import get_shard
 
 
 class RedisTaskStorageTestCase(AsyncTestCase):
@@ -15,6 +16,14 @@ class RedisTaskStorageTestCase(AsyncTestCase):
     def setUp(self):
         super(RedisTaskStorageTestCase, self).setUp()
 
+    def test_get_scheduled_queue(self):
+        self.assertEquals(TaskStorage.get_scheduled_queue(0), SETTINGS.SCHEDULED_QUEUE)
+        self.assertEquals(TaskStorage.get_scheduled_queue(3), b'queue:scheduled:3')
+
+        self.assertEquals(get_shard('A1', 1), 0)
+        self.assertEquals(get_shard('A1', 8), get_shard('A1', 8))
+        self.assertSetEqual({get_shard('A{}'.format(i), 4) for i in range(100)}, {0, 1, 2, 3})
+
     @async
     def test_get_metric_last_values(self):
         connection = yield from asyncio_redis.Pool.create(host='localhost', port=6379, db=2, encoder=asyncio_redis.encoders.BytesEncoder(), poolsize=3)